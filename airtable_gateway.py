@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import random
+import time
+from urllib.parse import quote
+
+import aiohttp
+
+import metrics
+
+AIRTABLE_API_URL = "https://api.airtable.com/v0"
+USERS_TABLE = "Users"
+ORDERS_TABLE = "Orders"
+
+# Statuses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class AirtableError(Exception):
+    """
+    Raised when Airtable rejects a request or stays unavailable after all retries.
+    """
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def formula_value(value) -> str:
+    """
+    Quote a value for use inside an Airtable formula.
+    """
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+class AirtableGateway:
+    """
+    Async Airtable client used by all bot handlers.
+
+    All requests share one keep-alive connection pool. Every request has a
+    timeout and is retried with exponential backoff and full jitter on
+    network errors, 429 (after its Retry-After), 5xx and unreadable
+    responses. Creates (POST) are only retried when Airtable cannot have
+    processed them: connection failures and 429.
+    """
+
+    def __init__(self, base_id: str, api_key: str, api_url: str = AIRTABLE_API_URL,
+                 timeout: float = 10.0, retries: int = 3, pool_size: int = 20,
+                 backoff_base: float = 0.5, backoff_cap: float = 8.0):
+        self.base_id = base_id
+        self.api_key = api_key
+        self.api_url = api_url.rstrip("/")
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.pool_size = pool_size
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # The session must be created inside the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={"Authorization": f"Bearer {self.api_key}"}
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    async def _request(self, method: str, table: str, record_id: str = None, params=None, json=None):
+        metrics.airtable_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            return await self._send(method, table, record_id, params, json)
+        except AirtableError:
+            metrics.airtable_errors.inc(method=method, table=table)
+            raise
+        finally:
+            metrics.airtable_seconds.observe(time.perf_counter() - started, method=method, table=table)
+            metrics.airtable_in_flight.dec()
+
+    def _retry_after(self, resp, attempt: int) -> float:
+        """
+        Seconds to wait before the next attempt: Retry-After of a 429 if given, else the backoff.
+        """
+        if resp is not None and resp.status == 429:
+            try:
+                return min(float(resp.headers.get("Retry-After", "")), 60.0)
+            except ValueError:
+                pass
+        return self._backoff(attempt)
+
+    async def _send(self, method: str, table: str, record_id: str, params, json):
+        url = f"{self.api_url}/{self.base_id}/{quote(table)}"
+        if record_id:
+            url += f"/{record_id}"
+        session = self._get_session()
+        for attempt in range(self.retries + 1):
+            resp = None
+            retry = True
+            try:
+                async with session.request(method, url, params=params, json=json) as resp:
+                    if resp.status in RETRY_STATUSES:
+                        # Proxies answer these with HTML; the body is not needed
+                        error = AirtableError(f"Airtable {method} {table} returned {resp.status}", resp.status)
+                        # A create may have gone through before a 5xx; only a 429 is sure not to have
+                        retry = method != "POST" or resp.status == 429
+                    else:
+                        try:
+                            payload = await resp.json(content_type=None)
+                        except ValueError as e:
+                            payload = e
+                        if resp.status >= 400:
+                            raise AirtableError(f"Airtable {method} {table} returned {resp.status}: {payload}", resp.status)
+                        if not isinstance(payload, dict):
+                            error = AirtableError(
+                                f"Airtable {method} {table} returned an unreadable {resp.status} body: {payload!r}",
+                                resp.status
+                            )
+                            retry = method != "POST"
+                        else:
+                            return payload
+            except aiohttp.ClientConnectorError as e:
+                # Nothing was sent, so any request can be repeated
+                error = AirtableError(f"Airtable {method} {table} failed: {e!r}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = AirtableError(f"Airtable {method} {table} failed: {e!r}")
+                # The request may have reached Airtable; repeating a create could duplicate the records
+                retry = method != "POST"
+            if attempt == self.retries or not retry:
+                raise error
+            delay = self._retry_after(resp, attempt)
+            logging.warning(f"{error}; retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    async def get_all(self, table: str, formula: str = None, fields=None) -> list:
+        """
+        Fetch all records of a table matching the formula, following pagination.
+        """
+        # A list of pairs, since fields[] is repeated once per field
+        params = []
+        if formula:
+            params.append(("filterByFormula", formula))
+        for field in fields or ():
+            params.append(("fields[]", field))
+        records = []
+        offset = None
+        while True:
+            query = params + [("offset", offset)] if offset else params
+            payload = await self._request("GET", table, params=query)
+            records.extend(payload.get("records", []))
+            offset = payload.get("offset")
+            if not offset:
+                return records
+
+    async def insert(self, table: str, fields: dict) -> dict:
+        return await self._request("POST", table, json={"fields": fields})
+
+    async def update(self, table: str, record_id: str, fields: dict) -> dict:
+        return await self._request("PATCH", table, record_id=record_id, json={"fields": fields})
+
+    async def update_many(self, table: str, records: list) -> list:
+        """
+        Update up to 10 records ({"id": ..., "fields": {...}}) in one request.
+        """
+        payload = await self._request("PATCH", table, json={"records": records})
+        return payload.get("records", [])
+
+    async def upsert_many(self, table: str, records: list, merge_on: list) -> list:
+        """
+        Create or update up to 10 records in one request, matched on the `merge_on` fields.
+        Unlike a create, this can be repeated safely (and is retried like any update).
+        """
+        payload = await self._request("PATCH", table, json={
+            "performUpsert": {"fieldsToMergeOn": merge_on},
+            "records": [{"fields": fields} for fields in records],
+        })
+        return payload.get("records", [])
+
+    async def _find_one(self, table: str, field: str, value):
+        records = await self.get_all(table, formula=f"{{{field}}} = {formula_value(value)}")
+        return records[0] if records else None
+
+    # Operations used by the bot
+
+    async def find_user(self, user_id):
+        """
+        Return the Users record with the given Telegram user id, or None.
+        """
+        return await self._find_one(USERS_TABLE, "User ID", user_id)
+
+    async def find_user_by_referral_code(self, referral_code: str):
+        return await self._find_one(USERS_TABLE, "Referral Code", referral_code)
+
+    async def find_users_by_referrer_code(self, referral_code: str) -> list:
+        return await self.get_all(USERS_TABLE, formula=f"{{Referrer Code}} = {formula_value(referral_code)}")
+
+    async def all_users(self, fields=None) -> list:
+        return await self.get_all(USERS_TABLE, fields=fields)
+
+    async def users_modified_since(self, since: str) -> list:
+        """
+        Users records created or modified after an ISO 8601 UTC timestamp.
+        """
+        value = formula_value(since)
+        return await self.get_all(
+            USERS_TABLE, formula=f"OR(IS_AFTER(LAST_MODIFIED_TIME(), {value}), IS_AFTER(CREATED_TIME(), {value}))"
+        )
+
+    async def insert_user(self, fields: dict) -> dict:
+        return await self.insert(USERS_TABLE, fields)
+
+    async def update_user(self, record_id: str, fields: dict) -> dict:
+        return await self.update(USERS_TABLE, record_id, fields)
+
+    async def upsert_orders(self, records: list) -> list:
+        return await self.upsert_many(ORDERS_TABLE, records, ["Order ID"])
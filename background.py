@@ -0,0 +1,52 @@
+import asyncio
+import logging
+import random
+
+
+async def flush_loop(flush_once, describe, batch_size: int, interval: float, max_backoff: float,
+                     wakeup: asyncio.Event = None, expected=()):
+    """
+    Call `flush_once()` until cancelled.
+
+    It runs again right away while it returns full batches (`batch_size`),
+    otherwise after `interval` seconds, or as soon as `wakeup` is set.
+    Failures back off exponentially with jitter, up to `max_backoff`, and are
+    logged as "Failed to <describe()>". Anything but cancellation keeps the
+    loop alive; errors other than the `expected` exception types get a
+    traceback.
+    """
+    failures = 0
+    while True:
+        if wakeup is not None:
+            wakeup.clear()
+        try:
+            flushed = await flush_once()
+            failures = 0
+        except Exception as e:
+            failures += 1
+            delay = random.uniform(0, min(max_backoff, interval * 2 ** failures))
+            logging.error(f"Failed to {describe()}, retrying in {delay:.1f}s: {e}", exc_info=not isinstance(e, expected))
+            await asyncio.sleep(delay)
+            continue
+        if flushed >= batch_size:
+            continue
+        if wakeup is None:
+            await asyncio.sleep(interval)
+        else:
+            try:
+                await asyncio.wait_for(wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def cancel_task(task):
+    """
+    Cancel a background task (if any) and wait until it has stopped.
+    """
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
@@ -0,0 +1,129 @@
+import logging
+from typing import NamedTuple, Optional
+
+# Telegram's limit for callback_data
+MAX_CALLBACK_BYTES = 64
+SEPARATOR = ":"
+
+
+class LocationChoice(NamedTuple):
+    prefix = "loc"
+    location: str
+
+
+class ProductTypeChoice(NamedTuple):
+    prefix = "prod"
+    product_type: str
+    location: Optional[str] = None
+
+
+class CollectionChoice(NamedTuple):
+    prefix = "coll"
+    collection_id: str
+    location: Optional[str] = None
+
+
+class ItemChoice(NamedTuple):
+    prefix = "item"
+    item_id: int
+    collection_id: str
+    location: Optional[str] = None
+
+
+def pack(prefix: str, payload: tuple = ()) -> str:
+    """
+    Pack a prefix and payload fields into callback data: "item:12:elf_bar_ep8000:kagran".
+    None is packed as an empty field.
+    """
+    values = ["" if value is None else str(value) for value in payload]
+    if any(SEPARATOR in value for value in values):
+        raise ValueError(f"Callback field contains '{SEPARATOR}': {values}")
+    data = SEPARATOR.join([prefix, *values])
+    if len(data.encode()) > MAX_CALLBACK_BYTES:
+        raise ValueError(f"Callback data longer than {MAX_CALLBACK_BYTES} bytes: {data}")
+    return data
+
+
+def button_data(payload) -> str:
+    return pack(payload.prefix, payload)
+
+
+class Route(NamedTuple):
+    handler: object
+    payload_type: Optional[type]
+    converters: tuple
+
+    @property
+    def name(self) -> str:
+        return self.handler.__name__
+
+
+class CallbackRouter:
+    """
+    Dispatches callback queries by their prefix with one dict lookup.
+
+    Callback data is "<prefix>[:field...]"; the fields are converted into the
+    route's payload type (a NamedTuple with str/int fields, optional fields may
+    be empty). Data with an unknown prefix, the wrong number of fields or an
+    unparsable field is rejected before any handler runs.
+    """
+
+    def __init__(self):
+        self._routes = {}
+
+    def route(self, prefix: str, payload_type: type = None):
+        """
+        Decorator registering `handler(callback, state, payload)` for a prefix.
+        """
+        def register(handler):
+            if prefix in self._routes:
+                raise ValueError(f"Callback prefix {prefix} registered twice")
+            converters = ()
+            if payload_type is not None:
+                annotations = payload_type.__annotations__
+                converters = tuple(
+                    (int if annotations[field] is int else str, field in payload_type._field_defaults)
+                    for field in payload_type._fields
+                )
+            self._routes[prefix] = Route(handler, payload_type, converters)
+            return handler
+        return register
+
+    def resolve(self, data: str):
+        """
+        Return (route, payload) for callback data, or None if it is not valid.
+        """
+        if not data:
+            return None
+        prefix, _, rest = data.partition(SEPARATOR)
+        route = self._routes.get(prefix)
+        if route is None:
+            return None
+        if route.payload_type is None:
+            return (route, None) if not rest else None
+        values = rest.split(SEPARATOR) if rest else []
+        if len(values) != len(route.converters):
+            return None
+        fields = []
+        for value, (convert, optional) in zip(values, route.converters):
+            if value == "":
+                if not optional:
+                    return None
+                fields.append(None)
+                continue
+            try:
+                fields.append(convert(value))
+            except ValueError:
+                return None
+        return route, route.payload_type._make(fields)
+
+    def __call__(self, callback) -> dict:
+        """
+        Filter for the single callback_query handler: passes `route` and `payload` on.
+        """
+        resolved = self.resolve(callback.data)
+        if resolved is None:
+            logging.debug(f"Rejected callback data {callback.data!r} from {callback.from_user.id}")
+            return False
+        route, payload = resolved
+        return {"route": route, "payload": payload}
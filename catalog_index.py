@@ -0,0 +1,106 @@
+from types import MappingProxyType
+from typing import Mapping, NamedTuple
+
+# Product type chosen in the bot -> catalog section holding its collections
+PRODUCT_TYPES = {
+    "vape": "hqd_collections",
+    "liquid": "liquid_collections",
+}
+
+
+class UnknownItemError(KeyError):
+    """
+    Raised when an item id is not part of the catalog.
+    """
+
+
+class UnknownCollectionError(KeyError):
+    """
+    Raised when a collection id is not part of the catalog.
+    """
+
+
+class CatalogEntry(NamedTuple):
+    collection: Mapping
+    item: Mapping
+    price: float
+    product_type: str
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(val) for key, val in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(val) for val in value)
+    return value
+
+
+class CatalogIndex:
+    """
+    Immutable index over config['catalog'].
+
+    Maps item id -> (collection, item, price) and collection id -> collection,
+    so handlers resolve clicks and prices without scanning the collections.
+    A new index is built for every catalog version and published as a whole.
+    """
+
+    __slots__ = ("_collections", "_items", "_by_type")
+
+    def __init__(self, catalog: dict):
+        collections = {}
+        items = {}
+        by_type = {}
+        for product_type, section in PRODUCT_TYPES.items():
+            group = []
+            for collection in catalog.get(section, []):
+                frozen = _freeze(collection)
+                collections[frozen["id"]] = frozen
+                group.append(frozen)
+                for item in frozen.get("items", ()):
+                    items[str(item["id"])] = CatalogEntry(frozen, item, frozen["price"], product_type)
+            by_type[product_type] = tuple(group)
+        object.__setattr__(self, "_collections", MappingProxyType(collections))
+        object.__setattr__(self, "_items", MappingProxyType(items))
+        object.__setattr__(self, "_by_type", MappingProxyType(by_type))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CatalogIndex is immutable; publish a new index instead.")
+
+    def collections_for(self, product_type: str) -> tuple:
+        """
+        Collections shown for a product type ("vape" or "liquid"), in catalog order.
+        """
+        return self._by_type.get(product_type, ())
+
+    def collection(self, collection_id: str) -> Mapping:
+        try:
+            return self._collections[collection_id]
+        except KeyError:
+            raise UnknownCollectionError(collection_id) from None
+
+    def item(self, item_id) -> CatalogEntry:
+        try:
+            return self._items[str(item_id)]
+        except KeyError:
+            raise UnknownItemError(str(item_id)) from None
+
+    def __contains__(self, item_id) -> bool:
+        return str(item_id) in self._items
+
+
+_current = None
+
+
+def current_catalog() -> CatalogIndex:
+    """
+    Return the currently published catalog index.
+    """
+    return _current
+
+
+def publish_catalog(index: CatalogIndex):
+    """
+    Atomically replace the published catalog index.
+    """
+    global _current
+    _current = index
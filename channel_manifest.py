@@ -0,0 +1,60 @@
+import json
+import logging
+import os
+
+
+class ChannelManifest:
+    """
+    Posts that send_catalog.py has published to the channel.
+
+    Maps a post key ("price_list", "collection:<id>", "navigation", ...) to
+    its message id and the sha256 of the text and image it was last
+    published with, so a later run only edits what changed. Saved after every
+    change, so an interrupted run does not lose track of sent posts.
+    """
+
+    def __init__(self, path: str, channel_id: int):
+        self.path = path
+        self.channel_id = channel_id
+        self._posts = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f"Failed to load channel manifest {path}: {e}")
+                return
+            # Message ids are only meaningful in the channel they were sent to
+            if data.get('channel_id') == channel_id:
+                self._posts = data.get('posts', {})
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'channel_id': self.channel_id, 'posts': self._posts}, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key: str):
+        return self._posts.get(key)
+
+    def keys(self, prefix: str = "") -> list:
+        return [key for key in self._posts if key.startswith(prefix)]
+
+    def record(self, key: str, message_id: int, text_sha256: str, image_sha256: str = None):
+        self._posts[key] = {
+            'message_id': message_id,
+            'text_sha256': text_sha256,
+            'image_sha256': image_sha256,
+        }
+        self.save()
+
+    def forget(self, key: str):
+        if self._posts.pop(key, None) is not None:
+            self.save()
+
+    def clear(self):
+        self._posts = {}
+        self.save()
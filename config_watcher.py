@@ -0,0 +1,271 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import pickle
+import time
+
+from background import cancel_task
+from callbacks import MAX_CALLBACK_BYTES, CollectionChoice, ItemChoice, ProductTypeChoice, button_data
+from catalog_index import PRODUCT_TYPES, CatalogIndex
+
+# Bump when the snapshot layout changes
+SNAPSHOT_VERSION = 1
+
+# Settings that only take effect after a restart (bot sessions, manager chats)
+RESTART_KEYS = ("api_key", "manager_bot_token", "manager_id")
+
+
+class ConfigError(ValueError):
+    """
+    Raised when config.json cannot be used.
+    """
+
+
+def _check_callback(payload, what: str):
+    try:
+        button_data(payload)
+    except ValueError:
+        raise ConfigError(f"{what} does not fit into {MAX_CALLBACK_BYTES} bytes of callback data") from None
+
+
+def validate_config(config) -> CatalogIndex:
+    """
+    Check the sections the bot relies on and build the catalog index.
+    Raises ConfigError describing the first problem found.
+    """
+    if not isinstance(config, dict):
+        raise ConfigError("config must be a JSON object")
+    locations = config.get('locations')
+    if not isinstance(locations, dict) or not locations:
+        raise ConfigError("'locations' must be a non-empty object")
+    for key, location in locations.items():
+        if ":" in key or not isinstance(location, dict) or not location.get('name'):
+            raise ConfigError(f"location {key!r} needs a name and must not contain ':'")
+    # Buttons carry the location in their callback data; the longest key has to fit into every one of them
+    longest_location = max(locations, key=lambda key: len(key.encode()))
+    for product_type in PRODUCT_TYPES:
+        _check_callback(ProductTypeChoice(product_type, longest_location), f"location {longest_location!r}")
+    catalog = config.get('catalog')
+    if not isinstance(catalog, dict):
+        raise ConfigError("'catalog' must be an object")
+    collection_ids = set()
+    item_ids = set()
+    for section in PRODUCT_TYPES.values():
+        for collection in catalog.get(section, []):
+            collection_id = collection.get('id')
+            if not collection_id or ":" in str(collection_id) or collection_id in collection_ids:
+                raise ConfigError(f"collection id {collection_id!r} in {section} is missing, duplicated or contains ':'")
+            if not isinstance(collection.get('price'), (int, float)):
+                raise ConfigError(f"collection {collection_id} has no numeric price")
+            _check_callback(CollectionChoice(collection_id, longest_location),
+                            f"collection id {collection_id!r} with location {longest_location!r}")
+            collection_ids.add(collection_id)
+            for item in collection.get('items', []):
+                item_id = str(item.get('id', ""))
+                if not item_id or item_id in item_ids or not item.get('name'):
+                    raise ConfigError(f"item {item_id!r} in {collection_id} is missing, duplicated or has no name")
+                _check_callback(ItemChoice(item_id, collection_id, longest_location),
+                                f"item id {item_id!r} with location {longest_location!r}")
+                item_ids.add(item_id)
+    for entry in config.get('postavka', []):
+        for loc, delivery in entry.get('deliveries', {}).items():
+            if loc not in locations:
+                raise ConfigError(f"shipment {entry.get('date')} delivers to unknown location {loc!r}")
+            for item_id, qty in delivery.get('items', {}).items():
+                if str(item_id) not in item_ids or not isinstance(qty, int):
+                    raise ConfigError(f"shipment {entry.get('date')} has unknown item {item_id!r} or bad quantity")
+    return CatalogIndex(catalog)
+
+
+def _parse(raw: bytes) -> dict:
+    try:
+        return json.loads(raw)
+    except ValueError as e:
+        raise ConfigError(f"invalid JSON: {e}") from None
+
+
+def load_config(path: str):
+    """
+    Read and validate a config file. Returns (config, catalog index, sha256).
+    Blocking; run it in a thread.
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    config = _parse(raw)
+    return config, validate_config(config), hashlib.sha256(raw).hexdigest()
+
+
+def _read_snapshot(snapshot_path: str):
+    try:
+        with open(snapshot_path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"Ignoring unreadable config snapshot {snapshot_path}: {e}")
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    return snapshot
+
+
+def _write_snapshot(snapshot_path: str, snapshot: dict):
+    directory = os.path.dirname(snapshot_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Worker processes may write at the same time; each uses its own temporary file
+    tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, snapshot_path)
+
+
+def load_config_snapshot(path: str, snapshot_path: str):
+    """
+    Startup variant of load_config: returns (config, sha256).
+
+    The parsed and validated config is kept in a binary snapshot. While the
+    size and mtime of the file match the snapshot, the file is not read at
+    all; a touched but identical file is recognised by its hash. Otherwise
+    the file is parsed and validated (raising ConfigError) and the snapshot
+    is rewritten.
+    """
+    st = os.stat(path)
+    stat = (st.st_mtime_ns, st.st_size)
+    snapshot = _read_snapshot(snapshot_path)
+    if snapshot is not None and snapshot["stat"] == stat:
+        return snapshot["config"], snapshot["sha256"]
+    with open(path, 'rb') as f:
+        raw = f.read()
+    digest = hashlib.sha256(raw).hexdigest()
+    if snapshot is not None and snapshot["sha256"] == digest:
+        config = snapshot["config"]
+    else:
+        config = _parse(raw)
+        validate_config(config)
+    try:
+        _write_snapshot(snapshot_path, {"version": SNAPSHOT_VERSION, "stat": stat, "sha256": digest, "config": config})
+    except OSError as e:
+        logging.warning(f"Failed to write config snapshot {snapshot_path}: {e}")
+    return config, digest
+
+
+class ConfigWatcher:
+    """
+    Polls config.json and applies changed versions while the bot is running.
+
+    The file is read and validated in a worker thread, where
+    `prepare(config, sha256)` also runs for blocking work derived from it
+    (e.g. booking shipments). `apply(config, catalog, prepared)` then runs
+    on the event loop with prepare's result and must swap the derived
+    structures in without awaiting, so handlers see either the old or the
+    new version. An invalid file is reported and the running version is
+    kept. `report(text)` is awaited with the outcome of every reload.
+    `running` is the (config, sha256) the bot was started with, if already
+    known.
+    """
+
+    def __init__(self, path: str, apply, report=None, interval: float = 5.0, running=None, prepare=None):
+        self.path = path
+        self.apply = apply
+        self.prepare = prepare
+        self.report = report
+        self.interval = interval
+        self._stat = self._file_stat()
+        self._config, self._digest = running or self._read_running()
+        self._task = None
+        self.reloads = 0
+        self.failures = 0
+        self.last_reload_seconds = 0.0
+
+    def _file_stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _read_running(self):
+        # The version the bot was started with, to skip no-op reloads and spot restart-only changes
+        try:
+            with open(self.path, 'rb') as f:
+                raw = f.read()
+            return json.loads(raw), hashlib.sha256(raw).hexdigest()
+        except (OSError, ValueError):
+            return {}, None
+
+    def stats(self) -> dict:
+        return {
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "last_reload_seconds": self.last_reload_seconds,
+        }
+
+    async def _report(self, text: str):
+        if self.report is None:
+            return
+        try:
+            await self.report(text)
+        except Exception as e:
+            logging.error(f"Failed to report config reload: {e}")
+
+    def _load(self):
+        """
+        Read, validate and prepare a changed config file (blocking). Returns None if it is unchanged.
+        """
+        config, catalog, digest = load_config(self.path)
+        if digest == self._digest:
+            return None
+        prepared = self.prepare(config, digest) if self.prepare is not None else None
+        return config, catalog, digest, prepared
+
+    async def reload(self) -> bool:
+        """
+        Load, validate and apply the config file now. Returns True if a new version was applied.
+        """
+        started = time.perf_counter()
+        try:
+            loaded = await asyncio.to_thread(self._load)
+            if loaded is None:
+                return False
+            config, catalog, digest, prepared = loaded
+            self.apply(config, catalog, prepared)
+            restart = [key for key in RESTART_KEYS if config.get(key) != self._config.get(key)]
+        except (OSError, ConfigError) as e:
+            self.failures += 1
+            logging.error(f"Config reload failed, keeping the running version: {e}")
+            await self._report(f"⚠️ Не удалось обновить config.json: {e}")
+            return False
+        except Exception as e:
+            self.failures += 1
+            logging.exception(f"Config reload failed, keeping the running version: {e}")
+            await self._report(f"⚠️ Не удалось обновить config.json: {e}")
+            return False
+        self._config, self._digest = config, digest
+        self.reloads += 1
+        self.last_reload_seconds = time.perf_counter() - started
+        logging.info(f"Config reloaded in {self.last_reload_seconds * 1000:.1f} ms")
+        text = f"✅ config.json обновлён за {self.last_reload_seconds * 1000:.0f} мс"
+        if restart:
+            logging.warning(f"Config keys changed that need a restart: {', '.join(restart)}")
+            text += f"\nДля применения {', '.join(restart)} нужен перезапуск."
+        await self._report(text)
+        return True
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            stat = self._file_stat()
+            if stat is None or stat == self._stat:
+                continue
+            self._stat = stat
+            await self.reload()
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        await cancel_task(self._task)
+        self._task = None
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from airtable_gateway import USERS_TABLE, AirtableError
+from background import cancel_task, flush_loop
+from sqlite_db import open_sqlite
+
+# Airtable accepts at most 10 records per update request
+MAX_BATCH_SIZE = 10
+
+
+def allowed_uses(discount: int, total_referrals: int) -> int:
+    """
+    Discount uses per month: one below the 50% tier; at 50% one more per referral beyond the fifth.
+    """
+    return 1 if discount < 50 else 1 + max(total_referrals - 5, 0)
+
+
+def current_month() -> str:
+    return datetime.now().strftime("%Y-%m")
+
+
+class DiscountLedger:
+    """
+    Monthly discount usage per user, kept locally and mirrored to Airtable.
+
+    A use is taken with one conditional UPDATE (`used < allowed`) in a local
+    SQLite transaction, so two quick taps, even handled by different worker
+    processes, cannot both pass the limit. The first use in a month seeds the
+    counter from the user's Airtable fields. Changed counters are written back
+    to the Users table in batches by a background task.
+    """
+
+    def __init__(self, path: str, gateway, interval: float = 5.0, max_backoff: float = 60.0):
+        self.gateway = gateway
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self._db = open_sqlite(path, synchronous="FULL")
+        # version > synced means the counter still has to be written to Airtable
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS discount_usage ("
+            " user_id TEXT NOT NULL,"
+            " month TEXT NOT NULL,"
+            " record_id TEXT NOT NULL,"
+            " used INTEGER NOT NULL,"
+            " version INTEGER NOT NULL DEFAULT 0,"
+            " synced INTEGER NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (user_id, month))"
+        )
+        self._task = None
+        self.taken = 0
+        self.refused = 0
+        self.refunded = 0
+        self.synced = 0
+
+    def stats(self) -> dict:
+        pending = self._db.execute("SELECT COUNT(*) FROM discount_usage WHERE version > synced").fetchone()[0]
+        return {
+            "taken": self.taken,
+            "refused": self.refused,
+            "refunded": self.refunded,
+            "synced": self.synced,
+            "pending": pending,
+        }
+
+    def take(self, user_id, record_id: str, allowed: int, fields: dict, month: str = None) -> bool:
+        """
+        Use the discount once this month if fewer than `allowed` uses were taken.
+        `fields` are the user's Airtable fields, used to seed a new month.
+        """
+        month = month or current_month()
+        seeded = 0
+        if str(fields.get("Discount Usage Month", ""))[:7] == month:
+            seeded = int(fields.get("Discount Usage Count", 0) or 0)
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._db.execute(
+                "INSERT OR IGNORE INTO discount_usage (user_id, month, record_id, used) VALUES (?, ?, ?, ?)",
+                (str(user_id), month, record_id, seeded)
+            )
+            taken = self._db.execute(
+                "UPDATE discount_usage SET used = used + 1, version = version + 1"
+                " WHERE user_id = ? AND month = ? AND used < ?",
+                (str(user_id), month, allowed)
+            ).rowcount == 1
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        if taken:
+            self.taken += 1
+        else:
+            self.refused += 1
+        return taken
+
+    def refund(self, user_id, month: str = None):
+        """
+        Give back a use whose order could not be placed.
+        """
+        self._db.execute(
+            "UPDATE discount_usage SET used = used - 1, version = version + 1"
+            " WHERE user_id = ? AND month = ? AND used > 0",
+            (str(user_id), month or current_month())
+        )
+        self.refunded += 1
+
+    async def flush_once(self) -> int:
+        """
+        Write up to 10 changed counters to Airtable. Returns the number written.
+        """
+        rows = self._db.execute(
+            "SELECT user_id, month, record_id, used, version FROM discount_usage"
+            " WHERE version > synced ORDER BY month DESC LIMIT ?",
+            (MAX_BATCH_SIZE,)
+        ).fetchall()
+        if not rows:
+            return 0
+        # Only the latest month of a user is mirrored
+        latest = {}
+        for user_id, month, record_id, used, version in rows:
+            latest.setdefault(user_id, (month, record_id, used))
+        records = [
+            {"id": record_id, "fields": {"Discount Usage Count": used, "Discount Usage Month": f"{month}-01"}}
+            for month, record_id, used in latest.values()
+        ]
+        try:
+            await self.gateway.update_many(USERS_TABLE, records)
+        except AirtableError as e:
+            if e.status is None or e.status >= 500 or e.status == 429:
+                raise
+            logging.error(f"Airtable rejected discount usage update, dropping it: {e}")
+        self._db.executemany(
+            "UPDATE discount_usage SET synced = ? WHERE user_id = ? AND month = ? AND synced < ?",
+            [(version, user_id, month, version) for user_id, month, _, _, version in rows]
+        )
+        self.synced += len(records)
+        return len(rows)
+
+    async def run(self):
+        # Changes made in the meantime are collected into the next batch
+        await flush_loop(self.flush_once, lambda: "sync discount usage", MAX_BATCH_SIZE,
+                         self.interval, self.max_backoff, expected=AirtableError)
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """
+        Stop the sync task and make one last attempt to write pending counters.
+        """
+        await cancel_task(self._task)
+        self._task = None
+        try:
+            while await self.flush_once():
+                pass
+        except Exception as e:
+            logging.error(f"Discount usage not fully synced on shutdown: {e}")
+        self._db.close()
@@ -0,0 +1,324 @@
+import asyncio
+import json
+import logging
+import random
+import sqlite3
+import time
+from urllib.parse import unquote, urlparse
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from sqlite_db import open_sqlite
+
+
+def _state_name(state):
+    return state.state if isinstance(state, State) else state
+
+
+def _key_prefix(key) -> str:
+    parts = [
+        "fsm", str(key.bot_id), str(key.chat_id), str(key.user_id),
+        str(key.thread_id or ""), str(getattr(key, "business_connection_id", None) or ""), key.destiny,
+    ]
+    return ":".join(parts)
+
+
+def _dump(data: dict) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM storage in a local SQLite database.
+
+    Survives restarts and can be shared by several bot processes on the same
+    host (WAL mode, one row per FSM key).
+    """
+
+    def __init__(self, path: str):
+        self._db = open_sqlite(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            " key TEXT PRIMARY KEY,"
+            " state TEXT,"
+            " data TEXT NOT NULL DEFAULT '{}')"
+        )
+
+    async def set_state(self, key, state=None) -> None:
+        self._db.execute(
+            "INSERT INTO fsm (key, state) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET state = excluded.state",
+            (_key_prefix(key), _state_name(state))
+        )
+        self._cleanup(key)
+
+    async def get_state(self, key):
+        row = self._db.execute("SELECT state FROM fsm WHERE key = ?", (_key_prefix(key),)).fetchone()
+        return row[0] if row else None
+
+    async def set_data(self, key, data) -> None:
+        self._db.execute(
+            "INSERT INTO fsm (key, data) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+            (_key_prefix(key), _dump(data))
+        )
+        self._cleanup(key)
+
+    async def get_data(self, key) -> dict:
+        row = self._db.execute("SELECT data FROM fsm WHERE key = ?", (_key_prefix(key),)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def _cleanup(self, key):
+        # Finished sessions (no state, no data) do not need a row
+        self._db.execute("DELETE FROM fsm WHERE key = ? AND state IS NULL AND data = '{}'", (_key_prefix(key),))
+
+    async def stats(self) -> dict:
+        sessions, size = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(key) + COALESCE(LENGTH(state), 0) + LENGTH(data)), 0) FROM fsm"
+        ).fetchone()
+        return {"sessions": sessions, "bytes": size, "bytes_per_session": size / sessions if sessions else 0.0}
+
+    async def close(self) -> None:
+        try:
+            self._db.close()
+        except sqlite3.ProgrammingError:
+            pass
+
+
+class RespError(Exception):
+    pass
+
+
+class RespClient:
+    """
+    Minimal client for the Redis serialization protocol (RESP2).
+
+    Only implements what the FSM storage needs, so it works with Redis and
+    compatible servers without an extra dependency.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 6379, db: int = 0, password: str = None):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self._roundtrip("AUTH", self.password)
+        if self.db:
+            await self._roundtrip("SELECT", self.db)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("RESP server closed the connection")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RespError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            payload = await self._reader.readexactly(length + 2)
+            return payload[:-2].decode()
+        if kind == b"*":
+            length = int(rest)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RespError(f"Unexpected RESP reply: {line!r}")
+
+    async def _roundtrip(self, *args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            value = str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(value), value))
+        self._writer.write(b"".join(parts))
+        await self._writer.drain()
+        return await self._read_reply()
+
+    async def execute(self, *args):
+        async with self._lock:
+            if self._writer is None:
+                await self._connect()
+            try:
+                return await self._roundtrip(*args)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # One reconnect attempt for dropped idle connections
+                await self._connect()
+                return await self._roundtrip(*args)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
+
+
+class RespStorage(BaseStorage):
+    """
+    FSM storage on a Redis-protocol server, shared by all bot processes.
+
+    State and data are kept under separate keys; an optional TTL lets
+    abandoned sessions expire.
+    """
+
+    def __init__(self, client: RespClient, ttl: int = None, stats_interval: float = 60.0,
+                 stats_sample: int = 50):
+        self.client = client
+        self.ttl = ttl
+        # stats() walks the keyspace over the connection the handlers use, so it is cached
+        self.stats_interval = stats_interval
+        self.stats_sample = stats_sample
+        self._stats = None
+        self._stats_at = 0.0
+        self._stats_lock = asyncio.Lock()
+
+    async def _set(self, name: str, value):
+        if value is None:
+            await self.client.execute("DEL", name)
+        elif self.ttl:
+            await self.client.execute("SET", name, value, "EX", self.ttl)
+        else:
+            await self.client.execute("SET", name, value)
+
+    async def set_state(self, key, state=None) -> None:
+        await self._set(f"{_key_prefix(key)}:state", _state_name(state))
+
+    async def get_state(self, key):
+        return await self.client.execute("GET", f"{_key_prefix(key)}:state")
+
+    async def set_data(self, key, data) -> None:
+        await self._set(f"{_key_prefix(key)}:data", _dump(data) if data else None)
+
+    async def get_data(self, key) -> dict:
+        raw = await self.client.execute("GET", f"{_key_prefix(key)}:data")
+        return json.loads(raw) if raw else {}
+
+    async def stats(self) -> dict:
+        """
+        Sessions and their size, recounted at most every `stats_interval`
+        seconds; scrapes in between get the last count.
+        """
+        async with self._stats_lock:
+            if self._stats is None or time.monotonic() - self._stats_at >= self.stats_interval:
+                self._stats = await self._count()
+                self._stats_at = time.monotonic()
+            return self._stats
+
+    async def _count(self) -> dict:
+        """
+        Count the sessions with SCAN; the value size is estimated from a sample of `stats_sample` keys.
+        """
+        names = []
+        cursor = "0"
+        while True:
+            cursor, batch = await self.client.execute("SCAN", cursor, "MATCH", "fsm:*", "COUNT", 1000)
+            names.extend(batch)
+            if cursor == "0":
+                break
+        sessions = len({name.rsplit(":", 1)[0] for name in names})
+        sample = random.sample(names, min(len(names), self.stats_sample))
+        values = 0
+        for name in sample:
+            values += await self.client.execute("STRLEN", name)
+        size = sum(len(name) for name in names) + (values * len(names) // len(sample) if sample else 0)
+        return {"sessions": sessions, "bytes": size, "bytes_per_session": size / sessions if sessions else 0.0}
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+class RespStandIn:
+    """
+    Tiny in-memory Redis-protocol server for local runs and load tests.
+
+    Supports the commands used by RespStorage (PING, GET, SET [EX], DEL,
+    STRLEN, SCAN, SELECT, AUTH); expiry is ignored.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self._server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(RespStandIn._encode(item) for item in value)
+        raw = value.encode()
+        return b"$%d\r\n%s\r\n" % (len(raw), raw)
+
+    def _command(self, name: str, args: list):
+        if name in ("PING", "SELECT", "AUTH"):
+            return b"+OK\r\n" if name != "PING" else b"+PONG\r\n"
+        if name == "GET":
+            return self._encode(self.data.get(args[0]))
+        if name == "SET":
+            self.data[args[0]] = args[1]
+            return b"+OK\r\n"
+        if name == "DEL":
+            return self._encode(sum(1 for key in args if self.data.pop(key, None) is not None))
+        if name == "STRLEN":
+            return self._encode(len(self.data.get(args[0], "").encode()))
+        if name == "SCAN":
+            prefix = args[args.index("MATCH") + 1].rstrip("*") if "MATCH" in args else ""
+            return self._encode(["0", [key for key in self.data if key.startswith(prefix)]])
+        return f"-ERR unknown command '{name}'\r\n".encode()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readline()
+                if not header:
+                    break
+                args = []
+                for _ in range(int(header[1:-2])):
+                    length = int((await reader.readline())[1:-2])
+                    args.append((await reader.readexactly(length + 2))[:-2].decode())
+                writer.write(self._command(args[0].upper(), args[1:]))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def create_storage(url: str) -> BaseStorage:
+    """
+    Build an FSM storage from a URL: "memory", "sqlite:///path/to/fsm.sqlite3"
+    or "redis://[:password@]host:port/db".
+    """
+    if url == "memory":
+        return MemoryStorage()
+    parsed = urlparse(url)
+    if parsed.scheme == "sqlite":
+        # sqlite:///relative/path or sqlite:////absolute/path
+        return SQLiteStorage(unquote(parsed.path[1:]))
+    if parsed.scheme == "redis":
+        db = int(parsed.path.lstrip("/") or 0)
+        client = RespClient(parsed.hostname or "localhost", parsed.port or 6379, db, parsed.password)
+        return RespStorage(client)
+    logging.error(f"Unknown FSM storage {url}, falling back to memory.")
+    return MemoryStorage()
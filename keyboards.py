@@ -0,0 +1,62 @@
+import logging
+import time
+
+
+class KeyboardCache:
+    """
+    Cache of prebuilt inline keyboards.
+
+    A keyboard is a pure function of its key (delivery type, location, product
+    type or collection) and of the current stock and catalog. `stamp` returns
+    a value that changes whenever either of them changes (the stock index
+    version and the catalog object); on a new stamp all keyboards are dropped
+    and rebuilt lazily on their next use.
+    """
+
+    def __init__(self, stamp):
+        self._stamp = stamp
+        self._current = None
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.build_seconds = 0.0
+        self.last_build_seconds = 0.0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "keyboards": len(self._entries),
+            "invalidations": self.invalidations,
+            "build_seconds": self.build_seconds,
+            "last_build_seconds": self.last_build_seconds,
+        }
+
+    def invalidate(self):
+        if self._entries:
+            self.invalidations += 1
+        self._entries.clear()
+
+    def get(self, key: tuple, build, *args):
+        """
+        Return the keyboard for key, building it with build(*args) on a miss.
+        """
+        stamp = self._stamp()
+        if stamp != self._current:
+            self.invalidate()
+            self._current = stamp
+        markup = self._entries.get(key)
+        if markup is not None:
+            self.hits += 1
+            return markup
+        self.misses += 1
+        started = time.perf_counter()
+        markup = build(*args)
+        self.last_build_seconds = time.perf_counter() - started
+        self.build_seconds += self.last_build_seconds
+        logging.debug(f"Built keyboard {key} in {self.last_build_seconds * 1000:.2f} ms")
+        self._entries[key] = markup
+        return markup
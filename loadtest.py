@@ -0,0 +1,479 @@
+"""
+Offline load test for main.py.
+
+Starts a fake Telegram Bot API server and an in-process Airtable stand-in
+(both with configurable latency), points the bot at them and drives many
+simulated users concurrently through the full order flow:
+
+    /start -> shop -> pickup/delivery -> prod -> coll -> item -> apply/skip
+
+Every item is stocked for all users in the test's own (temporary) stock
+ledger, so no order should be refused. A user counts as completed once the
+bot confirmed their order; orders the bot refused (e.g. sold out) are
+reported separately. Reports throughput and p50/p95/p99 latency per handler
+and per external call.
+
+    python loadtest.py --users 2000 --concurrency 200 --telegram-latency 0.05 --airtable-latency 0.15
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+from callbacks import CollectionChoice, ItemChoice, LocationChoice, ProductTypeChoice, button_data, pack
+from fsm_storage import RespStandIn
+
+FORMULA_RE = re.compile(r"\{(.+?)\} = '((?:[^'\\]|\\.)*)'")
+MODIFIED_SINCE_RE = re.compile(r"OR\(IS_AFTER\(LAST_MODIFIED_TIME\(\), '([^']+)'\).*")
+
+
+class LatencyStats:
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def record(self, label: str, seconds: float):
+        self.samples[label].append(seconds)
+
+    @staticmethod
+    def _percentile(values: list, q: float) -> float:
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def rows(self) -> list:
+        rows = []
+        for label, values in sorted(self.samples.items()):
+            values = sorted(values)
+            rows.append({
+                "label": label,
+                "count": len(values),
+                "p50_ms": self._percentile(values, 0.50) * 1000,
+                "p95_ms": self._percentile(values, 0.95) * 1000,
+                "p99_ms": self._percentile(values, 0.99) * 1000,
+                "max_ms": values[-1] * 1000,
+            })
+        return rows
+
+
+class FakeTelegram:
+    """
+    Minimal Bot API server answering the methods the bot uses.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        # Chats that received an order confirmation
+        self.confirmed = set()
+        self._message_ids = itertools.count(1)
+        self.app = web.Application(client_max_size=32 * 1024 * 1024)
+        self.app.router.add_post("/bot{token}/{method}", self._handle)
+
+    def _message(self, form, **extra) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(form.get("chat_id", 0)), "type": "private"},
+        }
+        if "text" in form:
+            message["text"] = form["text"]
+        message.update(extra)
+        return message
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        form = await request.post()
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == "getme":
+            token = request.match_info["token"]
+            result = {"id": int(token.split(":")[0]), "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method in ("sendmessage", "editmessagetext"):
+            result = self._message(form)
+            if method == "sendmessage" and form.get("text", "").startswith("✅"):
+                self.confirmed.add(result["chat"]["id"])
+        elif method == "sendphoto":
+            photo_id = next(self._message_ids)
+            result = self._message(form, caption=form.get("caption", ""), photo=[{
+                "file_id": f"photo-{photo_id}", "file_unique_id": f"unique-{photo_id}", "width": 800, "height": 800,
+            }])
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+class FakeAirtable:
+    """
+    In-process Airtable stand-in supporting the REST calls made by AirtableGateway.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.tables = defaultdict(dict)
+        # Record id -> last change, for LAST_MODIFIED_TIME() filters
+        self.modified = {}
+        self._ids = itertools.count(1)
+        self.app = web.Application()
+        self.app.router.add_get("/v0/{base}/{table}", self._list)
+        self.app.router.add_post("/v0/{base}/{table}", self._create)
+        self.app.router.add_patch("/v0/{base}/{table}", self._update_many)
+        self.app.router.add_patch("/v0/{base}/{table}/{record_id}", self._update)
+
+    def insert(self, table: str, fields: dict) -> dict:
+        record = {"id": f"rec{next(self._ids):014d}", "createdTime": "2025-01-01T00:00:00.000Z", "fields": dict(fields)}
+        self.tables[table][record["id"]] = record
+        self.modified[record["id"]] = time.time()
+        return record
+
+    def upsert(self, table: str, fields: dict, merge_on: list) -> dict:
+        key = [fields.get(field) for field in merge_on]
+        for record in self.tables[table].values():
+            if [record["fields"].get(field) for field in merge_on] == key:
+                record["fields"].update(fields)
+                self.modified[record["id"]] = time.time()
+                return record
+        return self.insert(table, fields)
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+
+    async def _list(self, request: web.Request) -> web.Response:
+        await self._delay()
+        records = list(self.tables[request.match_info["table"]].values())
+        formula = request.query.get("filterByFormula")
+        if formula:
+            match = FORMULA_RE.fullmatch(formula.strip())
+            since = MODIFIED_SINCE_RE.fullmatch(formula.strip())
+            if since:
+                cutoff = datetime.strptime(since.group(1), "%Y-%m-%dT%H:%M:%S.000Z").replace(tzinfo=timezone.utc).timestamp()
+                records = [r for r in records if self.modified.get(r["id"], 0) > cutoff]
+            elif match:
+                field, value = match.group(1), match.group(2).replace("\\'", "'").replace("\\\\", "\\")
+                records = [r for r in records if str(r["fields"].get(field, "")) == value]
+        return web.json_response({"records": records})
+
+    async def _create(self, request: web.Request) -> web.Response:
+        await self._delay()
+        table = request.match_info["table"]
+        body = await request.json()
+        if "records" in body:
+            return web.json_response({"records": [self.insert(table, r["fields"]) for r in body["records"]]})
+        return web.json_response(self.insert(table, body["fields"]))
+
+    async def _update(self, request: web.Request) -> web.Response:
+        await self._delay()
+        record = self.tables[request.match_info["table"]].get(request.match_info["record_id"])
+        if record is None:
+            return web.json_response({"error": "NOT_FOUND"}, status=404)
+        record["fields"].update((await request.json())["fields"])
+        self.modified[record["id"]] = time.time()
+        return web.json_response(record)
+
+    async def _update_many(self, request: web.Request) -> web.Response:
+        await self._delay()
+        table = self.tables[request.match_info["table"]]
+        body = await request.json()
+        if "performUpsert" in body:
+            return web.json_response({"records": [
+                self.upsert(request.match_info["table"], change["fields"], body["performUpsert"]["fieldsToMergeOn"])
+                for change in body["records"]
+            ]})
+        updated = []
+        for change in body["records"]:
+            record = table.get(change["id"])
+            if record is None:
+                return web.json_response({"error": "NOT_FOUND"}, status=404)
+            record["fields"].update(change["fields"])
+            self.modified[record["id"]] = time.time()
+            updated.append(record)
+        return web.json_response({"records": updated})
+
+
+async def serve(app: web.Application):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner, runner.addresses[0][1]
+
+
+def instrument(main, stats: LatencyStats):
+    """
+    Record handler latency and the latency of every Telegram and Airtable call.
+    """
+    from aiogram import BaseMiddleware
+    from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+    class HandlerTiming(BaseMiddleware):
+        async def __call__(self, handler, event, data):
+            started = time.perf_counter()
+            try:
+                return await handler(event, data)
+            finally:
+                stats.record(f"handler {main.metrics.handler_name(data)}", time.perf_counter() - started)
+
+    class TelegramTiming(BaseRequestMiddleware):
+        async def __call__(self, make_request, bot, method):
+            started = time.perf_counter()
+            try:
+                return await make_request(bot, method)
+            finally:
+                stats.record(f"telegram {method.__api_method__}", time.perf_counter() - started)
+
+    main.main_dp.message.middleware(HandlerTiming())
+    main.main_dp.callback_query.middleware(HandlerTiming())
+    main.main_bot.session.middleware(TelegramTiming())
+    main.manager_bot.session.middleware(TelegramTiming())
+
+    request = main.airtable._request
+
+    async def timed_request(method, table, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await request(method, table, *args, **kwargs)
+        finally:
+            stats.record(f"airtable {method} {table}", time.perf_counter() - started)
+
+    main.airtable._request = timed_request
+
+
+def seed_stock(main, quantity: int):
+    """
+    Book `quantity` units of every catalog item at every location into the
+    stock ledger of the test's temporary BOT_DATA_DIR.
+    """
+    catalog = main.current_catalog()
+    items = {
+        str(item["id"]): quantity
+        for product_type in ("vape", "liquid")
+        for collection in catalog.collections_for(product_type)
+        for item in collection["items"]
+    }
+    main.stock_ledger.book_shipments([
+        {"date": "loadtest", "deliveries": {location: {"items": items} for location in main.locations}}
+    ])
+
+
+class SimulatedUsers:
+    def __init__(self, main, telegram: FakeTelegram, stats: LatencyStats, discount_share: float):
+        from aiogram import types
+        self.main = main
+        self.telegram = telegram
+        self.types = types
+        self.stats = stats
+        self.discount_share = discount_share
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self.completed = 0
+        self.refused = 0
+        self.failed = 0
+        self.updates = 0
+        # Items that can actually be ordered, per pickup location and for delivery
+        catalog = main.current_catalog()
+        self.options = {}
+        for location in list(main.locations) + [None]:
+            self.options[location] = [
+                (product_type, collection["id"], item["id"])
+                for product_type in ("vape", "liquid")
+                for collection in catalog.collections_for(product_type)
+                for item in collection["items"]
+                if main.stock_index.item_available(item["id"], location)
+            ]
+        self.pickup_locations = [location for location in main.locations if self.options[location]]
+
+    def _user(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"}
+
+    def _chat_message(self, uid: int, text: str) -> dict:
+        return {
+            "message_id": next(self._message_ids), "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"}, "from": self._user(uid), "text": text,
+        }
+
+    async def _feed(self, label: str, data: dict):
+        update = self.types.Update.model_validate(
+            {"update_id": next(self._update_ids), **data}, context={"bot": self.main.main_bot}
+        )
+        started = time.perf_counter()
+        await self.main.main_dp.feed_update(self.main.main_bot, update)
+        self.stats.record(f"step {label}", time.perf_counter() - started)
+        self.updates += 1
+
+    async def message(self, uid: int, text: str, label: str):
+        await self._feed(label, {"message": self._chat_message(uid, text)})
+
+    async def click(self, uid: int, data: str, label: str):
+        message = self._chat_message(uid, "menu")
+        message["from"] = {"id": 1, "is_bot": True, "first_name": "Bench"}
+        await self._feed(label, {"callback_query": {
+            "id": str(next(self._update_ids)), "from": self._user(uid),
+            "chat_instance": str(uid), "message": message, "data": data,
+        }})
+
+    def seed(self, airtable: FakeAirtable, user_ids):
+        """
+        Pre-register a share of the users with a referral discount so that the
+        discount prompt and both discount handlers are exercised.
+        """
+        today = time.strftime("%Y-%m-%d")
+        for uid in user_ids:
+            if random.random() < self.discount_share:
+                airtable.insert("Users", {
+                    "User ID": str(uid), "Username": f"user{uid}", "Referral Code": f"ref{uid}",
+                    "Referrer Code": "", "Total Referrals": 1, "Discount": 10,
+                    "Discount Usage Count": 0, "Discount Usage Month": today, "Bonus Awarded": False,
+                })
+
+    async def run_user(self, uid: int, seeded_discount: bool):
+        try:
+            await self.message(uid, "/start", "/start")
+            await self.click(uid, pack("shop"), "shop")
+            if random.random() < 0.7 and self.pickup_locations:
+                location = random.choice(self.pickup_locations)
+                await self.click(uid, pack("pickup"), "pickup")
+                await self.click(uid, button_data(LocationChoice(location)), "loc")
+            else:
+                location = None
+                await self.click(uid, pack("delivery"), "delivery")
+                await self.message(uid, f"Teststraße {uid % 200 + 1}, 1010 Wien", "address")
+            product_type, collection_id, item_id = random.choice(self.options[location])
+            await self.click(uid, button_data(ProductTypeChoice(product_type, location)), "prod")
+            await self.click(uid, button_data(CollectionChoice(collection_id, location)), "coll")
+            await self.click(uid, button_data(ItemChoice(item_id, collection_id, location)), "item")
+            if seeded_discount:
+                choice = random.choice(["apply", "skip"])
+                await self.click(uid, pack(choice), choice)
+            if uid in self.telegram.confirmed:
+                self.completed += 1
+            else:
+                self.refused += 1
+                logging.warning(f"Simulated user {uid}: order was not confirmed")
+        except Exception as e:
+            self.failed += 1
+            logging.error(f"Simulated user {uid} failed: {e!r}")
+
+
+def print_report(title: str, rows: list):
+    print(f"\n{title}")
+    print(f"{'':<38}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for row in rows:
+        print(f"{row['label']:<38}{row['count']:>8}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}"
+              f"{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}")
+
+
+async def run(args):
+    random.seed(args.seed)
+    telegram = FakeTelegram(args.telegram_latency)
+    airtable = FakeAirtable(args.airtable_latency)
+    telegram_runner, telegram_port = await serve(telegram.app)
+    airtable_runner, airtable_port = await serve(airtable.app)
+    fsm_url = args.fsm_storage
+    resp_stand_in = None
+    if fsm_url == "resp":
+        # RespStorage against the in-process Redis-protocol stand-in
+        resp_stand_in = RespStandIn()
+        fsm_url = f"redis://127.0.0.1:{await resp_stand_in.start()}/0"
+    os.environ.update({
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{telegram_port}",
+        "AIRTABLE_API_URL": f"http://127.0.0.1:{airtable_port}/v0",
+        "BOT_DATA_DIR": tempfile.mkdtemp(prefix="bot-loadtest-"),
+        "FSM_STORAGE": fsm_url,
+    })
+    import main
+    logging.getLogger().setLevel(args.log_level)
+
+    stats = LatencyStats()
+    instrument(main, stats)
+    seed_stock(main, args.users)
+    simulated = SimulatedUsers(main, telegram, stats, args.discount_share)
+    user_ids = range(10_000_000, 10_000_000 + args.users)
+    simulated.seed(airtable, user_ids)
+    seeded = {int(r["fields"]["User ID"]) for r in airtable.tables["Users"].values()}
+
+    await main.on_startup()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(uid):
+        async with semaphore:
+            await simulated.run_user(uid, uid in seeded)
+
+    # Sessions are cleared once an order is placed, so FSM size is sampled while users are in flight
+    # (without the caching the RESP storage applies between metrics scrapes)
+    fsm_peak = {}
+    if hasattr(main.fsm_storage, "stats_interval"):
+        main.fsm_storage.stats_interval = 0.0
+
+    async def sample_fsm():
+        while True:
+            current = await main.fsm_storage.stats()
+            if current["sessions"] >= fsm_peak.get("sessions", 0):
+                fsm_peak.update(current)
+            await asyncio.sleep(0.25)
+
+    sampler = asyncio.create_task(sample_fsm()) if hasattr(main.fsm_storage, "stats") else None
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(uid) for uid in user_ids))
+    elapsed = time.perf_counter() - started
+    if sampler is not None:
+        sampler.cancel()
+        await asyncio.gather(sampler, return_exceptions=True)
+
+    # Follow-up messages are scheduled with long random delays; they are not part of the measurement
+    pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()
+               and task.get_coro().__name__ == "send_follow_up_message"]
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    await main.on_shutdown()
+    await main.main_bot.session.close()
+    await main.manager_bot.session.close()
+    await telegram_runner.cleanup()
+    await airtable_runner.cleanup()
+    if resp_stand_in is not None:
+        await resp_stand_in.stop()
+
+    summary = {
+        "users": args.users,
+        "completed": simulated.completed,
+        "refused": simulated.refused,
+        "failed": simulated.failed,
+        "updates": simulated.updates,
+        "elapsed_s": elapsed,
+        "updates_per_s": simulated.updates / elapsed if elapsed else 0.0,
+        "orders_in_airtable": len(airtable.tables["Orders"]),
+        "telegram_calls": dict(telegram.calls),
+        "fsm_storage": fsm_url,
+        "fsm_peak": fsm_peak,
+    }
+    rows = stats.rows()
+    print(json.dumps(summary, indent=2))
+    print_report("Steps (feed_update)", [r for r in rows if r["label"].startswith("step ")])
+    print_report("Handlers", [r for r in rows if r["label"].startswith("handler ")])
+    print_report("External calls", [r for r in rows if r["label"].startswith(("telegram ", "airtable "))])
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "latency": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100, help="users in flight at the same time")
+    parser.add_argument("--telegram-latency", type=float, default=0.03, help="seconds per Bot API call")
+    parser.add_argument("--airtable-latency", type=float, default=0.1, help="mean seconds per Airtable call")
+    parser.add_argument("--discount-share", type=float, default=0.3, help="share of users with a referral discount")
+    parser.add_argument("--fsm-storage", default="memory",
+                        help="memory, sqlite:///path, redis://host:port/db or resp (built-in RESP stand-in)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", help="also write the results to this file")
+    asyncio.run(run(parser.parse_args()))
@@ -1,27 +1,59 @@
-import json
+import time
+
+# Start of the startup time breakdown, see startup_profile
+process_started = time.perf_counter()
+
+import argparse
 import asyncio
 import logging
 import os
 import random
 import string
+from collections import defaultdict
 from datetime import datetime
 
-import pandas as pd
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, FSInputFile
-from aiogram.utils.deep_linking import create_start_link
-from airtable import Airtable  # Airtable client
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from dotenv import load_dotenv
 
+from airtable_gateway import AIRTABLE_API_URL, AirtableGateway
+from callbacks import CallbackRouter, CollectionChoice, ItemChoice, LocationChoice, ProductTypeChoice, button_data, pack
+from catalog_index import CatalogIndex, UnknownCollectionError, UnknownItemError, current_catalog, publish_catalog
+from config_watcher import ConfigWatcher, load_config_snapshot
+from discount_ledger import DiscountLedger, allowed_uses
+from fsm_storage import create_storage
+from keyboards import KeyboardCache
+from media_cache import MediaCache
+import metrics
+from notifier import ManagerNotifier
+from order_ids import OrderIdGenerator
+from order_pipeline import OrderPipeline
+from order_spool import OrderSpool
+from referral_index import ReferralIndex
+from startup import ReadinessGate, StartupProfile
+from stock_ledger import StockLedger
+from stock_report import StockReport
+from user_cache import UserCache
+from user_mirror import UserMirror
+
+# Per-phase startup timings, logged once the warm-up in on_startup is done
+startup_profile = StartupProfile(process_started)
+startup_profile.mark("imports")
+
 # Load environment variables
 load_dotenv()
 
-# Initialize configuration from config.json
-with open('config.json', 'r', encoding='utf-8') as f:
-    config = json.load(f)
+# Local runtime data (caches, queues)
+data_dir = os.environ.get("BOT_DATA_DIR", "data")
+
+# Initialize configuration from config.json (from a precompiled snapshot while the file is unchanged)
+config, config_digest = load_config_snapshot('config.json', os.path.join(data_dir, "config.snapshot"))
+startup_profile.mark("config")
 
 # Retrieve configuration values
 api_key = config.get('api_key')
@@ -45,13 +77,107 @@ airtable_base_id = os.environ.get("AIRTABLE_BASE_ID") or 'app3tQaubsx9JQK0z'
 if not all([airtable_api_key, airtable_base_id]):
     raise EnvironmentError("AIRTABLE_API_KEY and AIRTABLE_BASE_ID must be set in environment variables.")
 
-# Define Airtable tables
-orders_airtable = Airtable(airtable_base_id, 'Orders', airtable_api_key)
-users_airtable = Airtable(airtable_base_id, 'Users', airtable_api_key)  # Table for referral system
+# Shared async Airtable client for the Orders and Users (referral system) tables
+airtable = AirtableGateway(airtable_base_id, airtable_api_key, os.environ.get("AIRTABLE_API_URL") or AIRTABLE_API_URL)
+# Local copy of the Users table, kept in sync in the background; user reads are served from it
+user_mirror = UserMirror(os.path.join(data_dir, "users.sqlite3"), airtable)
+# Users lookups shared by all handlers; the short TTL keeps them close to the mirror
+users = UserCache(user_mirror, ttl=5.0)
+# Referral code -> referred users, so the dashboard needs no Airtable query
+referral_index = ReferralIndex(user_mirror, refresh_interval=60.0)
+
+# Catalog lookups (item -> collection/price, collection id -> collection)
+publish_catalog(CatalogIndex(catalog))
+startup_profile.mark("catalog")
+
+# Live stock: 'postavka' shipments minus ordered units, shared by all worker processes
+stock_ledger = StockLedger(os.path.join(data_dir, "stock.sqlite3"))
+stock_index = stock_ledger.open(config, config_digest)
+startup_profile.mark("stock")
+# Stock and sales reports for managers, cached until the ledger or the catalog changes
+stock_report = StockReport(stock_ledger, lambda: locations)
+# Catalog keyboards only change with stock availability or the catalog itself
+keyboards = KeyboardCache(lambda: (stock_index, stock_index.version, current_catalog()))
+
+# Set by supervisor.py when the bot runs as one of several worker processes
+worker_id = int(os.environ.get("BOT_WORKER_ID", 0))
+worker_count = int(os.environ.get("BOT_WORKER_COUNT", 1))
+
+# Time-ordered order ids; the worker id keeps ids of parallel workers apart
+order_ids = OrderIdGenerator(os.path.join(data_dir, "order_ids.sqlite3"), shard=worker_id)
+
+# Telegram file_ids of uploaded collection photos, shared with the other workers and send_catalog.py
+# (opened by the startup warm-up)
+media_cache = MediaCache(os.path.join(data_dir, "media_cache.sqlite3"), lazy=True)
+
+# Monthly discount usage, taken locally and mirrored to Airtable in batches
+discount_ledger = DiscountLedger(os.path.join(data_dir, "discounts.sqlite3"), airtable)
+
+# Orders are queued locally and pushed to Airtable in the background
+# (one spool per worker process, so each has a single flusher)
+spool_name = "order_spool.sqlite3" if worker_count == 1 else f"order_spool.{worker_id}.sqlite3"
+order_spool = OrderSpool(os.path.join(data_dir, spool_name), airtable)
+startup_profile.mark("storage")
+
+# Initialize bots (TELEGRAM_API_URL points them at a local Bot API server, e.g. for load tests)
+telegram_api_url = os.environ.get("TELEGRAM_API_URL")
+
+def create_bot(token: str) -> Bot:
+    if telegram_api_url:
+        return Bot(token=token, session=AiohttpSession(api=TelegramAPIServer.from_base(telegram_api_url)))
+    return Bot(token=token)
+
+main_bot = create_bot(api_key)
+manager_bot = create_bot(manager_bot_token)
+
+# Order notifications to all managers, sent concurrently under Telegram rate limits
+manager_notifier = ManagerNotifier(manager_bot, manager_id)
+
+async def report_order_failure(order_id: int, effect: str, error: Exception):
+    await manager_notifier.notify(f"⚠️ Заказ #{order_id}: не выполнено {effect}: {error}")
 
-# Initialize bots
-main_bot = Bot(token=api_key)
-manager_bot = Bot(token=manager_bot_token)
+# Side effects of confirmed orders (manager notifications, referral bonus), run after the customer reply
+# and kept in the order spool's database until done (see order_effects)
+order_pipeline = OrderPipeline(
+    os.path.join(data_dir, spool_name), lambda order_id, payload: order_effects(order_id, payload),
+    report=report_order_failure
+)
+
+def prepare_config(new_config: dict, digest: str):
+    """
+    Book the shipments of a changed config.json and build its stock index.
+    Runs in the config watcher's thread: booking takes a write transaction
+    that may wait for other workers.
+    """
+    return stock_ledger.build(new_config, digest)
+
+def apply_config(new_config: dict, new_catalog: CatalogIndex, stock):
+    """
+    Swap in a validated config.json: catalog, locations and the stock index
+    built by prepare_config. Nothing here awaits or blocks, so a handler sees
+    either the old or the new version; cached keyboards follow the new catalog.
+    """
+    global config, locations, postavka, catalog, branding, premium_emojis, orders_config, stock_index
+    new_stock_index = stock_ledger.install(*stock)
+    config = new_config
+    locations = new_config.get('locations', {})
+    postavka = new_config.get('postavka', [])
+    catalog = new_config.get('catalog', {})
+    branding = new_config.get('branding', {})
+    premium_emojis = new_config.get('premium_emojis', {})
+    orders_config = new_config.get('orders', [])
+    publish_catalog(new_catalog)
+    stock_index = new_stock_index
+
+async def report_config_reload(text: str):
+    # Every worker reloads on its own; one report is enough
+    if worker_id == 0:
+        await manager_notifier.notify(text)
+
+# Picks up edits of config.json (new shipments, prices, collections) without a restart
+config_watcher = ConfigWatcher(
+    'config.json', apply_config, report_config_reload, running=(config, config_digest), prepare=prepare_config
+)
 
 # Configure logging
 logging.basicConfig(
@@ -59,31 +185,42 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
-# Create dispatchers for each bot
-main_dp = Dispatcher()
-manager_dp = Dispatcher()
+# FSM storage shared by both dispatchers: "memory", "sqlite:///path" or "redis://host:port/db"
+fsm_storage = create_storage(os.environ.get("FSM_STORAGE") or f"sqlite:///{os.path.join(data_dir, 'fsm.sqlite3')}")
 
+# Create dispatchers for each bot
+main_dp = Dispatcher(storage=fsm_storage)
+manager_dp = Dispatcher(storage=fsm_storage)
+# All main bot buttons are dispatched by callback data prefix, see dispatch_callback
+callback_router = CallbackRouter()
 
-def get_item_price(item_id: str, catalog: dict) -> float:
-    """
-    Retrieve the price of an item based on its ID from the catalog.
-    """
-    item_id = str(item_id)
-    # Check in hqd_collections
-    for collection in catalog.get("hqd_collections", []):
-        for item in collection.get("items", []):
-            if str(item["id"]) == item_id:
-                return collection["price"]  # Return the price of the collection
+# Latency, in-flight and error metrics for both bots, served on /metrics
+metrics.instrument(main_dp, main_bot, "main")
+metrics.instrument(manager_dp, manager_bot, "manager")
+metrics.expose_stats("users", users.stats)
+metrics.expose_stats("user_mirror", user_mirror.stats)
+metrics.expose_stats("order_spool", order_spool.stats)
+metrics.expose_stats("order_ids", order_ids.stats)
+metrics.expose_stats("order_pipeline", order_pipeline.stats)
+metrics.expose_stats("keyboards", keyboards.stats)
+metrics.expose_stats("stock", stock_ledger.stats)
+metrics.expose_stats("stock_report", stock_report.stats)
+metrics.expose_stats("config", config_watcher.stats)
+metrics.expose_stats("referrals", referral_index.stats)
+metrics.expose_stats("discounts", discount_ledger.stats)
+metrics.expose_stats("startup", startup_profile.stats)
+# Persistent FSM storages report their sessions and bytes per session (the memory one does not)
+if hasattr(fsm_storage, "stats"):
+    metrics.expose_stats("fsm", fsm_storage.stats)
+# Updates wait (briefly) for the warm-up started in on_startup
+readiness = ReadinessGate(startup_profile)
+main_dp.update.outer_middleware(readiness)
+manager_dp.update.outer_middleware(readiness)
+# /metrics gets its own listener, local-only by default and never on the public webhook app (port 0 disables it)
+metrics_host = os.environ.get("METRICS_HOST", "127.0.0.1")
+metrics_port = int(os.environ.get("METRICS_PORT", 9100))
 
-    # Check in liquid_collections
-    for collection in catalog.get("liquid_collections", []):
-        for item in collection.get("items", []):
-            if str(item["id"]) == item_id:
-                return collection["price"]  # Return the price of the collection
 
-    # If item not found, return 0 or raise an error
-    logging.error(f"Item with ID {item_id} not found in catalog.")
-    return 0
 # Define FSM states
 class OrderStates(StatesGroup):
     greeting = State()
@@ -102,19 +239,7 @@ def create_back_button():
     Returns a back button that always sends the user
     to the general (main) menu.
     """
-    return [InlineKeyboardButton(text="↩️ Главное меню", callback_data="back_to_general")]
-
-def build_inventory(config):
-    """
-    Build the inventory dictionary from the 'postavka' configuration.
-    """
-    inventory = {key: {} for key in config["locations"].keys()}
-    for postavka_entry in config.get("postavka", []):
-        for loc, delivery in postavka_entry.get("deliveries", {}).items():
-            item_quantities = delivery.get("items", {})
-            for item_id, qty in item_quantities.items():
-                inventory[loc][item_id] = inventory[loc].get(item_id, 0) + qty
-    return inventory
+    return [InlineKeyboardButton(text="↩️ Главное меню", callback_data=pack("menu"))]
 
 def generate_referral_code(length=6):
     return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
@@ -125,7 +250,7 @@ async def register_user(user_id: int, username: str, referral_code: str = None):
     New columns:
       - Discount Usage Count, Discount Usage Month, Bonus Awarded.
     """
-    existing_user = users_airtable.get_all(formula=f"{{User ID}} = '{user_id}'")
+    existing_user = await users.get_user(user_id)
     if existing_user:
         return  # User already exists
 
@@ -144,36 +269,155 @@ async def register_user(user_id: int, username: str, referral_code: str = None):
         "Bonus Awarded": False  # Flag ensures bonus is applied only once per referred user
     }
     try:
-        users_airtable.insert(user_data)
+        await users.insert_user(user_data)
+        referral_index.add(user_id, username, referral_code)
         logging.info(f"User {username} registered successfully.")
     except Exception as e:
         logging.error(f"Failed to insert user data into Airtable: {e}")
 
 async def get_user_discount(user_id: int):
-    user_records = users_airtable.get_all(formula=f"{{User ID}} = '{user_id}'")
-    if user_records:
-        return user_records[0]['fields'].get("Discount", 0)
+    user_record = await users.get_user(user_id)
+    if user_record:
+        return user_record['fields'].get("Discount", 0)
     return 0
 
 def apply_discount(order_total, discount):
     return order_total * (1 - discount / 100)
 
+def describe_delivery(user_data: dict):
+    """
+    Return the location line shown in order messages and the responsible manager.
+    """
+    if user_data.get('delivery_type', 'pickup') == "pickup":
+        location = locations[user_data['location']]
+        return f"📍 Магазин: {location['name']}", location.get('manager', 'Менеджер')
+    return f"📍 Адрес доставки: {user_data.get('delivery_address', 'Не указан')}", "Менеджер доставки"
+
+def describe_order(user_data: dict, user: types.User, entry, order_total, discount, ts: int):
+    """
+    Values used by the order messages and the Airtable record.
+    """
+    location_info, manager_name = describe_delivery(user_data)
+    delivery_type = user_data.get('delivery_type', 'pickup')
+    return {
+        "item_id": entry.item['id'],
+        "location": user_data.get('location') if delivery_type == 'pickup' else None,
+        "current_time": datetime.fromtimestamp(ts).strftime("%Y-%m-%dT%H:%M:%S"),
+        "username": user.username or "Без username",
+        "user_fullname": user.full_name or "Без имени",
+        "location_info": location_info,
+        "order_total": order_total,
+        "collection": entry.collection,
+        "aroma_name": entry.item['name'],
+        "discount": discount,
+        "manager_name": manager_name,
+        "delivery_type": delivery_type,
+        "delivery_address": user_data.get('delivery_address', "")
+    }
+
+def load_order_draft(user_data: dict, user: types.User):
+    """
+    Expand the compact order draft kept in FSM state (ids and numbers only)
+    into the values used by the order messages. Returns None without a draft.
+    """
+    draft = user_data.get('draft')
+    if not draft:
+        return None
+    try:
+        entry = current_catalog().item(draft['item_id'])
+    except UnknownItemError:
+        logging.error(f"Item with ID {draft['item_id']} from order draft not found in catalog.")
+        return None
+    return describe_order(user_data, user, entry, draft['total'], draft['discount'], draft['ts'])
+
+def stock_location_name(stock_location: str) -> str:
+    return locations.get(stock_location, {}).get("name", stock_location)
+
+def render_manager_message(order_id: int, order: dict, stock_location: str, discount, total_val) -> str:
+    delivery_label, delivery_value = order['location_info'].split(': ', 1)
+    return (
+        f"🔔 *Заказ #{order_id}*\n"
+        "━━━━━━━━━━━━━━━\n"
+        f"📅 *Дата:* {order['current_time']}\n"
+        f"👤 *Клиент:*\n"
+        f"   • TG: @{order['username']}\n"
+        f"   • Имя: {order['user_fullname']}\n\n"
+        f"🛍 *Заказ:*\n"
+        f"   • Серия: {order['collection']['name']}\n"
+        f"   • Вкус: {order['aroma_name']}\n"
+        f"   • Скидка: {discount}%\n"
+        f"   • Итог: {total_val}\n"
+        f"📍 *Получение:*\n"
+        f"   • {delivery_label}: {delivery_value}\n"
+        f"   • Склад: {stock_location_name(stock_location)}\n"
+        "━━━━━━━━━━━━━━━"
+    )
+
+def render_customer_message(order: dict, discount, total_val) -> str:
+    return (
+        f"✅ *Отлично!*\n\n"
+        f"*Ваш выбор:*\n"
+        f"{order['location_info']}\n"
+        f"📦 *Коллекция:* {order['collection']['name']}\n"
+        f"🎨 *Вкус:* {order['aroma_name']}\n\n"
+        + (f"Скидка {discount}% применена.\n" if discount else "Скидка не применена.\n") +
+        f"Итоговая сумма заказа: {total_val}\n\n"
+        "Для нового заказа используйте команду /start"
+    )
+
+def order_record(order_id: int, order: dict, stock_location: str, user_id: int, discount, total_val) -> dict:
+    """
+    Fields of the order in the Airtable Orders table; Stock Location is the
+    store the unit was reserved at, which ships delivery orders.
+    """
+    is_delivery = order['delivery_type'] == 'delivery'
+    return {
+        "Order ID": order_id,
+        "Date": order['current_time'],
+        "User": f"<https://t.me/{order['username']}>",
+        "Delivery Type": order['delivery_type'],
+        "Location": "" if is_delivery else order['location_info'].split(': ', 1)[1],
+        "Delivery Address": order['delivery_address'] if is_delivery else "",
+        "Stock Location": stock_location_name(stock_location),
+        "Collection Name": order['collection']['name'],
+        "Flavor Name": order['aroma_name'],
+        "Manager": order['manager_name'],
+        "Discount Applied": discount,
+        "Status": False,
+        "User ID": user_id,
+        "Total": total_val
+    }
+
 async def send_follow_up_message(message: types.Message):
     await asyncio.sleep(random.randint(1, 30))
     await message.answer("🕐 Ваш заказ обрабатывается... Мы свяжемся с вами в течение 5 минут!")
 
-def update_referrer_bonus(referral_code: str):
+async def notify_managers(text: str):
+    failed = await manager_notifier.notify(text, parse_mode="Markdown")
+    if len(failed) == len(manager_notifier.chat_ids):
+        raise RuntimeError("no manager could be notified")
+
+async def reset_user_discount(record_id: str):
+    await users.update_user(record_id, {"Discount": 0, "Total Referrals": 0, "Bonus Awarded": False})
+    logging.info("User discount reset to 0 after applying discount (non-max discount).")
+
+# Referral code -> lock held while the referrer's Total Referrals is read and written back
+referrer_locks = defaultdict(asyncio.Lock)
+
+async def update_referrer_bonus(referral_code: str):
     """
     Update the referrer's bonus when a referred friend makes their first order.
     Increases Total Referrals and updates Discount accordingly.
     For referrals <= 5: discount = Total Referrals * 10 (max 50%).
     For referrals above 5: discount remains 50%, but each extra referral increases allowed monthly uses.
+    Updates of one referrer run one at a time, so concurrent orders of
+    several friends each count; the cache is written through, so each
+    update reads the previous one's total.
     """
-    try:
-        referrers = users_airtable.get_all(formula=f"{{Referral Code}} = '{referral_code}'")
-        if not referrers:
+    async with referrer_locks[referral_code]:
+        referrer = await users.get_user_by_referral_code(referral_code)
+        if not referrer:
             return
-        referrer = referrers[0]
         record_id = referrer['id']
         total_referrals = int(referrer['fields'].get("Total Referrals", 0))
         new_total = total_referrals + 1
@@ -182,26 +426,151 @@ def update_referrer_bonus(referral_code: str):
             "Total Referrals": new_total,
             "Discount": new_discount
         }
-        users_airtable.update(record_id, update_data)
-        logging.info(f"Referrer's bonus updated: {new_total} referrals, discount {new_discount}%")
-    except Exception as e:
-        logging.error(f"Failed to update referrer's bonus: {e}")
+        await users.update_user(record_id, update_data)
+    logging.info(f"Referrer's bonus updated: {new_total} referrals, discount {new_discount}%")
 
-def process_referral_bonus(user_id: int):
+async def process_referral_bonus(user_id: int, completed: list = None):
     """
     Checks if the ordering user was referred and, if so, updates the referrer's bonus.
     Ensures that the bonus is applied only once for the referred user.
+    The two Airtable updates run concurrently; `completed` records the ones
+    that succeeded, so a retry of this order does not repeat them.
+    """
+    completed = [] if completed is None else completed
+    user = await users.get_user(user_id)
+    if not user:
+        return
+    fields = user.get('fields', {})
+    ref_code = fields.get("Referrer Code", "")
+    bonus_awarded = fields.get("Bonus Awarded", False)
+    # Awarded by an earlier order, unless it was this order's previous attempt
+    if not ref_code or (bonus_awarded and not completed):
+        return
+    steps = {
+        "referrer": lambda: update_referrer_bonus(ref_code),
+        # Mark bonus as awarded so that subsequent orders do not trigger another bonus
+        "awarded": lambda: users.update_user(user['id'], {"Bonus Awarded": True}),
+    }
+    names = [name for name in steps if name not in completed]
+    results = await asyncio.gather(*(steps[name]() for name in names), return_exceptions=True)
+    for name, result in zip(names, results):
+        if isinstance(result, Exception):
+            raise result
+        completed.append(name)
+
+def order_effects(order_id: int, payload: dict) -> dict:
+    """
+    Side effects of a confirmed order for order_pipeline, built from the
+    payload place_order submits; the pipeline stores the payload, so they can
+    be resumed after a restart.
+    """
+    user_steps = []
+    if payload["reset_record_id"]:
+        user_steps.append(lambda: reset_user_discount(payload["reset_record_id"]))
+    user_steps.append(lambda: process_referral_bonus(payload["user_id"], payload["referral_completed"]))
+    return {
+        "manager_notification": [lambda: notify_managers(payload["manager_message"])],
+        # Both write the user's record (the reset clears Bonus Awarded), so they keep this order
+        "referral_bonus": user_steps,
+    }
+
+async def place_order(callback: types.CallbackQuery, state: FSMContext, order: dict, use_discount: bool = False):
     """
-    user_records = users_airtable.get_all(formula=f"{{User ID}} = '{user_id}'")
-    if user_records:
-        user = user_records[0]
-        fields = user.get('fields', {})
-        ref_code = fields.get("Referrer Code", "")
-        bonus_awarded = fields.get("Bonus Awarded", False)
-        if ref_code and not bonus_awarded:
-            update_referrer_bonus(ref_code)
-            # Mark bonus as awarded so that subsequent orders do not trigger another bonus
-            users_airtable.update(user['id'], {"Bonus Awarded": True})
+    Confirm an order and reply to the customer. Stock, the discount use and
+    the queued Airtable record are settled first; manager notifications and
+    user record updates run afterwards in order_pipeline.
+    """
+    user_id = callback.from_user.id
+    order_id = order_ids.next_id()
+    stock_location = stock_ledger.reserve(order["item_id"], order["location"], order_id)
+    if stock_location is None:
+        await callback.answer("Извините, этот товар сейчас недоступен.", show_alert=True)
+        return
+    discount = 0
+    user_record = None
+    if use_discount:
+        # Check and take the monthly discount use in one local transaction
+        user_record = await users.get_user(user_id)
+        if user_record:
+            fields = user_record.get('fields', {})
+            allowed = allowed_uses(int(fields.get("Discount", 0)), int(fields.get("Total Referrals", 0)))
+            if not discount_ledger.take(user_id, user_record['id'], allowed, fields):
+                stock_ledger.release(stock_location, order["item_id"], order_id)
+                await callback.answer("Скидка уже была использована максимально допустимое количество раз в этом месяце.", show_alert=True)
+                return
+        discount = order["discount"]
+    total_val = apply_discount(order["order_total"], discount) if discount else order["order_total"]
+    try:
+        order_spool.enqueue(order_record(order_id, order, stock_location, user_id, discount, total_val))
+        logging.info(f"Order {order_id} queued for Airtable.")
+    except Exception as e:
+        logging.error(f"Failed to queue order details: {e}")
+        stock_ledger.release(stock_location, order["item_id"], order_id)
+        if user_record:
+            discount_ledger.refund(user_id)
+        await callback.answer("Ошибка при сохранении заказа.", show_alert=True)
+        return
+
+    order_pipeline.submit(order_id, {
+        "user_id": user_id,
+        "manager_message": render_manager_message(order_id, order, stock_location, discount, total_val),
+        # If discount is less than 50, then its credit is consumed; for full discount, keep it available.
+        "reset_record_id": user_record['id'] if user_record and discount < 50 else None,
+        "referral_completed": [],
+    })
+    await state.clear()
+
+    # The prompt with the order buttons is replaced by the confirmation
+    # (Bot API methods are awaitable models, not coroutines, so gather needs them as futures)
+    sent_message, deleted = await asyncio.gather(
+        asyncio.ensure_future(callback.message.answer(
+            render_customer_message(order, discount, total_val), parse_mode="Markdown")),
+        asyncio.ensure_future(callback.message.delete()),
+        return_exceptions=True
+    )
+    if isinstance(deleted, Exception):
+        logging.error(f"Failed to delete message: {deleted}")
+    if isinstance(sent_message, Exception):
+        raise sent_message
+    asyncio.create_task(send_follow_up_message(sent_message))
+
+def build_locations_keyboard() -> InlineKeyboardMarkup:
+    keyboard = [
+        [InlineKeyboardButton(text=loc_data["name"], callback_data=button_data(LocationChoice(loc_key)))]
+        for loc_key, loc_data in locations.items()
+    ]
+    keyboard.append(create_back_button())
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def build_product_type_keyboard(location_key: str = None) -> InlineKeyboardMarkup:
+    keyboard = [
+        [
+            InlineKeyboardButton(text="📦 Устройство", callback_data=button_data(ProductTypeChoice("vape", location_key))),
+            InlineKeyboardButton(text="💧 Жидкость", callback_data=button_data(ProductTypeChoice("liquid", location_key)))
+        ]
+    ]
+    keyboard.append(create_back_button())
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def build_collections_keyboard(product_type: str, location_key: str = None) -> InlineKeyboardMarkup:
+    keyboard = []
+    for collection in current_catalog().collections_for(product_type):
+        is_available = stock_index.collection_available(collection['id'], location_key)
+        collection_name = f"🟢 {collection['name']}" if is_available else f"🔴 {collection['name']}"
+        choice = CollectionChoice(collection['id'], location_key)
+        keyboard.append([InlineKeyboardButton(text=collection_name, callback_data=button_data(choice))])
+    keyboard.append(create_back_button())
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def build_items_keyboard(collection_id: str, location_key: str = None) -> InlineKeyboardMarkup:
+    keyboard = []
+    for item in current_catalog().collection(collection_id).get("items", []):
+        is_available = stock_index.item_available(item['id'], location_key)
+        item_name = f"🟢 {item['name']}" if is_available else f"🔴 {item['name']}"
+        choice = ItemChoice(item['id'], collection_id, location_key)
+        keyboard.append([InlineKeyboardButton(text=item_name, callback_data=button_data(choice))])
+    keyboard.append(create_back_button())
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 # ----------------------------
 # MAIN BOT HANDLERS
@@ -220,12 +589,12 @@ async def cmd_start(message: types.Message, state: FSMContext):
     if referral_code:
         payload = referral_code
     else:
-        user_records = users_airtable.get_all(formula=f"{{User ID}} = {message.from_user.id}")
-        if user_records:
-            payload = user_records[0]['fields'].get("Referral Code", generate_referral_code())
+        user_record = await users.get_user(message.from_user.id)
+        if user_record:
+            payload = user_record['fields'].get("Referral Code", generate_referral_code())
         else:
             payload = generate_referral_code()
-    referral_link = await create_start_link(bot=main_bot, payload=str(payload), encode=True)
+    referral_link = await users.start_link(main_bot, str(payload))
 
     first_name = message.from_user.first_name or "Пользователь"
     welcome_text = (
@@ -245,30 +614,28 @@ async def cmd_start(message: types.Message, state: FSMContext):
 
     share_text = f"Приглашаю в магазин Vienna Vape: {referral_link}"
     main_menu_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🛍 Купить продукцию", callback_data="start_shopping")],
-        [InlineKeyboardButton(text="📊 Мой Кабинет", callback_data="dashboard")],
+        [InlineKeyboardButton(text="🛍 Купить продукцию", callback_data=pack("shop"))],
+        [InlineKeyboardButton(text="📊 Мой Кабинет", callback_data=pack("dash"))],
     ])
     await message.answer("Главное меню:", reply_markup=main_menu_keyboard)
     await state.set_state(OrderStates.greeting)
 
 @main_dp.message(Command("dashboard"))
 async def cmd_dashboard(message: types.Message):
-    user_records = users_airtable.get_all(formula=f"{{User ID}} = '{message.from_user.id}'")
-    if not user_records:
+    user_record = await users.get_user(message.from_user.id)
+    if not user_record:
         await register_user(message.from_user.id, message.from_user.username or "NoUsername", None)
-        user_records = users_airtable.get_all(formula=f"{{User ID}} = '{message.from_user.id}'")
-        if not user_records:
+        user_record = await users.get_user(message.from_user.id)
+        if not user_record:
             await message.answer("Ошибка регистрации. Пожалуйста, используйте команду /start.")
             return
-    user = user_records[0]['fields']
+    user = user_record['fields']
     referral_code = user.get("Referral Code", "N/A")
     referrals = user.get("Total Referrals", 0)
     discount = user.get("Discount", 0)
 
-    referred_users = users_airtable.get_all(formula=f"{{Referrer Code}} = '{referral_code}'")
-    referred_list = "\n".join(
-        [f"- @{record['fields'].get('Username', 'NoUsername')}" for record in referred_users]
-    ) or "Нет рефералов."
+    referred_users = await referral_index.referred_usernames(referral_code)
+    referred_list = "\n".join([f"- @{username}" for username in referred_users]) or "Нет рефералов."
 
     dashboard_message = (
         f"📊 *Мой Кабинет*\n\n"
@@ -284,30 +651,28 @@ async def cmd_dashboard(message: types.Message):
             text="🔗 Поделиться кабинетом",
             switch_inline_query=f"Приглашаю в магазин Vienna Vape: https://t.me/{main_bot.username}?start={referral_code}"
         )],
-        [InlineKeyboardButton(text="↩️ В главное меню", callback_data="back_to_general")]
+        [InlineKeyboardButton(text="↩️ В главное меню", callback_data=pack("menu"))]
     ])
     await message.answer(dashboard_message, parse_mode="Markdown", reply_markup=dashboard_keyboard)
 
-@main_dp.callback_query(lambda c: c.data == "dashboard")
-async def show_dashboard(callback: types.CallbackQuery, state: FSMContext):
+@callback_router.route("dash")
+async def show_dashboard(callback: types.CallbackQuery, state: FSMContext, payload=None):
     # Ищем пользователя по строковому идентификатору
-    user_records = users_airtable.get_all(formula=f"{{User ID}} = '{callback.from_user.id}'")
-    if not user_records:
+    user_record = await users.get_user(callback.from_user.id)
+    if not user_record:
         # Регистрируем пользователя, если он не найден
         await register_user(callback.from_user.id, callback.from_user.username or "NoUsername", None)
-        user_records = users_airtable.get_all(formula=f"{{User ID}} = '{callback.from_user.id}'")
-        if not user_records:
+        user_record = await users.get_user(callback.from_user.id)
+        if not user_record:
             await callback.message.answer("Ошибка регистрации. Пожалуйста, используйте команду /start.")
             return
-    user = user_records[0]['fields']
+    user = user_record['fields']
     referral_code = user.get("Referral Code", "N/A")
     referrals = user.get("Total Referrals", 0)
     discount = user.get("Discount", 0)
 
-    referred_users = users_airtable.get_all(formula=f"{{Referrer Code}} = '{referral_code}'")
-    referred_list = "\n".join(
-        [f"- @{record['fields'].get('Username', 'NoUsername')}" for record in referred_users]
-    ) or "Нет рефералов."
+    referred_users = await referral_index.referred_usernames(referral_code)
+    referred_list = "\n".join([f"- @{username}" for username in referred_users]) or "Нет рефералов."
 
     dashboard_message = (
         f"📊 *Мой Кабинет*\n\n"
@@ -323,25 +688,25 @@ async def show_dashboard(callback: types.CallbackQuery, state: FSMContext):
             text="🔗 Поделиться кабинетом",
             switch_inline_query=f"Приглашаю в магазин Vienna Vape: https://t.me/{main_bot.username}?start={referral_code}"
         )],
-        [InlineKeyboardButton(text="↩️ В главное меню", callback_data="back_to_general")]
+        [InlineKeyboardButton(text="↩️ В главное меню", callback_data=pack("menu"))]
     ])
     await callback.message.answer(dashboard_message, parse_mode="Markdown", reply_markup=dashboard_keyboard)
 
-@main_dp.callback_query(lambda c: c.data == "back_to_general")
-async def back_to_general(callback: types.CallbackQuery, state: FSMContext):
+@callback_router.route("menu")
+async def back_to_general(callback: types.CallbackQuery, state: FSMContext, payload=None):
     """
     Clears any FSM state and shows the general main menu.
     """
     await state.clear()
-    user_records = users_airtable.get_all(formula=f"{{User ID}} = {callback.from_user.id}")
-    if user_records:
-        referral_code = user_records[0]['fields'].get("Referral Code", "")
+    user_record = await users.get_user(callback.from_user.id)
+    if user_record:
+        referral_code = user_record['fields'].get("Referral Code", "")
     else:
         referral_code = ""
     share_text = f"Приглашаю в магазин Vienna Vape: https://t.me/{main_bot.username}?start={referral_code}"
     main_menu_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🛍 Купить продукцию", callback_data="start_shopping")],
-        [InlineKeyboardButton(text="📊 Мой Кабинет", callback_data="dashboard")],
+        [InlineKeyboardButton(text="🛍 Купить продукцию", callback_data=pack("shop"))],
+        [InlineKeyboardButton(text="📊 Мой Кабинет", callback_data=pack("dash"))],
     ])
     try:
         await callback.message.edit_text("Главное меню:", reply_markup=main_menu_keyboard)
@@ -349,12 +714,12 @@ async def back_to_general(callback: types.CallbackQuery, state: FSMContext):
         logging.error(f"Failed to display main menu: {e}")
         await callback.message.answer("Главное меню:", reply_markup=main_menu_keyboard)
 
-@main_dp.callback_query(lambda c: c.data == "start_shopping")
-async def show_delivery_options(callback: types.CallbackQuery, state: FSMContext):
+@callback_router.route("shop")
+async def show_delivery_options(callback: types.CallbackQuery, state: FSMContext, payload=None):
     keyboard = [
         [
-            InlineKeyboardButton(text="🏪 Самовывоз", callback_data="pickup"),
-            InlineKeyboardButton(text="🚚 Доставка", callback_data="delivery")
+            InlineKeyboardButton(text="🏪 Самовывоз", callback_data=pack("pickup")),
+            InlineKeyboardButton(text="🚚 Доставка", callback_data=pack("delivery"))
         ]
     ]
     reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
@@ -365,20 +730,15 @@ async def show_delivery_options(callback: types.CallbackQuery, state: FSMContext
         await callback.message.answer("Выберите способ получения:", reply_markup=reply_markup)
     await state.set_state(OrderStates.choosing_delivery)
 
-@main_dp.callback_query(lambda c: c.data == "pickup")
-async def show_locations(callback: types.CallbackQuery, state: FSMContext):
+@callback_router.route("pickup")
+async def show_locations(callback: types.CallbackQuery, state: FSMContext, payload=None):
     await state.update_data(delivery_type="pickup")
-    keyboard = [
-        [InlineKeyboardButton(text=loc_data["name"], callback_data=f"loc_{loc_key}")]
-        for loc_key, loc_data in locations.items()
-    ]
-    keyboard.append(create_back_button())
-    reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
+    reply_markup = keyboards.get(("locations",), build_locations_keyboard)
     await callback.message.edit_text("🏪 *Выберите ближайший магазин для самовывоза:*", reply_markup=reply_markup, parse_mode="Markdown")
     await state.set_state(OrderStates.choosing_location)
 
-@main_dp.callback_query(lambda c: c.data == "delivery")
-async def request_address(callback: types.CallbackQuery, state: FSMContext):
+@callback_router.route("delivery")
+async def request_address(callback: types.CallbackQuery, state: FSMContext, payload=None):
     await state.update_data(delivery_type="delivery")
     await callback.message.edit_text("📍 *Пожалуйста, укажите адрес доставки:*\n(Укажите улицу, дом, квартиру и другие необходимые детали)", parse_mode="Markdown")
     await state.set_state(OrderStates.waiting_for_address)
@@ -386,17 +746,13 @@ async def request_address(callback: types.CallbackQuery, state: FSMContext):
 @main_dp.message(OrderStates.waiting_for_address)
 async def process_address(message: types.Message, state: FSMContext):
     await state.update_data(delivery_address=message.text)
-    await show_product_type_selection(message, state)
+    await show_product_type_selection(message, state, None)
 
-async def show_product_type_selection(event, state: FSMContext):
-    keyboard = [
-        [
-            InlineKeyboardButton(text="📦 Устройство", callback_data="product_vape"),
-            InlineKeyboardButton(text="💧 Жидкость", callback_data="product_liquid")
-        ]
-    ]
-    keyboard.append(create_back_button())
-    reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
+async def show_product_type_selection(event, state: FSMContext, location_key: str = None):
+    """
+    location_key is the pickup store, None for delivery; it is carried in the buttons.
+    """
+    reply_markup = keyboards.get(("product_types", location_key), build_product_type_keyboard, location_key)
     if isinstance(event, types.CallbackQuery):
         try:
             await event.message.delete()
@@ -407,43 +763,29 @@ async def show_product_type_selection(event, state: FSMContext):
         await event.answer("Выберите тип продукта:", reply_markup=reply_markup)
     await state.set_state(OrderStates.choosing_product_type)
 
-@main_dp.callback_query(lambda c: c.data in ["product_liquid", "product_vape"])
-async def process_product_type(callback: types.CallbackQuery, state: FSMContext):
-    product_type = "liquid" if callback.data == "product_liquid" else "vape"
-    await state.update_data(product_type=product_type)
-    await show_collection_types(callback, state)
+@callback_router.route("prod", ProductTypeChoice)
+async def process_product_type(callback: types.CallbackQuery, state: FSMContext, payload: ProductTypeChoice):
+    if payload.product_type not in ("vape", "liquid") or (payload.location and payload.location not in locations):
+        await callback.answer("Кнопка устарела. Используйте /start.", show_alert=True)
+        return
+    await state.update_data(product_type=payload.product_type)
+    await show_collection_types(callback, state, payload.product_type, payload.location)
 
-async def show_collection_types(event, state: FSMContext):
+async def location_header(state: FSMContext, location_key: str = None) -> str:
+    """
+    First line of the catalog messages; only delivery needs the address from FSM state.
+    """
+    if location_key:
+        return f"📍 *Выбранный магазин:* {locations[location_key]['name']}"
     user_data = await state.get_data()
-    inventory = build_inventory(config)
-    keyboard = []
-    location_key = user_data.get('location')
-    product_type = user_data.get('product_type')
-    if product_type == "liquid":
-        collections = catalog.get("liquid_collections", [])
-    else:
-        collections = catalog.get("hqd_collections", [])
-    for collection in collections:
-        is_available = False
-        for item in collection.get("items", []):
-            item_id = str(item["id"])
-            if user_data.get('delivery_type') == 'pickup':
-                if location_key in inventory and item_id in inventory[location_key] and inventory[location_key][item_id] > 0:
-                    is_available = True
-                    break
-            else:
-                for loc in inventory.values():
-                    if item_id in loc and loc[item_id] > 0:
-                        is_available = True
-                        break
-        collection_name = f"🟢 {collection['name']}" if is_available else f"🔴 {collection['name']}"
-        keyboard.append([InlineKeyboardButton(text=collection_name, callback_data=f"type_{collection['id']}")])
-    keyboard.append(create_back_button())
-    reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
-    if user_data.get('delivery_type') == 'delivery':
-        message_text = f"📍 *Адрес доставки:* {user_data['delivery_address']}\n\nВыберите тип продукции:"
-    else:
-        message_text = f"📍 *Выбранный магазин:* {locations[user_data['location']]['name']}\n\nВыберите тип продукции:"
+    return f"📍 *Адрес доставки:* {user_data.get('delivery_address', 'Не указан')}"
+
+async def show_collection_types(event, state: FSMContext, product_type: str, location_key: str = None):
+    reply_markup = keyboards.get(
+        ("collections", product_type, location_key), build_collections_keyboard, product_type, location_key
+    )
+    header = await location_header(state, location_key)
+    message_text = f"{header}\n\nВыберите тип продукции:"
     if isinstance(event, types.CallbackQuery):
         try:
             await event.message.delete()
@@ -454,49 +796,29 @@ async def show_collection_types(event, state: FSMContext):
         await event.answer(text=message_text, reply_markup=reply_markup, parse_mode="Markdown")
     await state.set_state(OrderStates.choosing_collection_type)
 
-@main_dp.callback_query(lambda c: c.data.startswith('loc_'))
-async def process_location(callback: types.CallbackQuery, state: FSMContext):
-    location_key = callback.data.replace('loc_', '')
-    await state.update_data(location=location_key)
-    await show_product_type_selection(callback, state)
+@callback_router.route("loc", LocationChoice)
+async def process_location(callback: types.CallbackQuery, state: FSMContext, payload: LocationChoice):
+    if payload.location not in locations:
+        await callback.answer("Магазин не найден.", show_alert=True)
+        return
+    await state.update_data(location=payload.location)
+    await show_product_type_selection(callback, state, payload.location)
 
-@main_dp.callback_query(lambda c: c.data.startswith('type_'))
-async def process_collection_type(callback: types.CallbackQuery, state: FSMContext):
-    collection_id = callback.data.replace('type_', '')
-    await state.update_data(collection=collection_id)
-    user_data = await state.get_data()
-    product_type = user_data.get('product_type')
-    if product_type == "liquid":
-        collections = catalog.get("liquid_collections", [])
-    else:
-        collections = catalog.get("hqd_collections", [])
-    collection = next((c for c in collections if c["id"] == collection_id), None)
-    if not collection:
+@callback_router.route("coll", CollectionChoice)
+async def process_collection_type(callback: types.CallbackQuery, state: FSMContext, payload: CollectionChoice):
+    collection_id, location_key = payload.collection_id, payload.location
+    try:
+        collection = current_catalog().collection(collection_id)
+    except UnknownCollectionError:
         await callback.answer("Коллекция не найдена.", show_alert=True)
         return
+    if location_key and location_key not in locations:
+        await callback.answer("Магазин не найден.", show_alert=True)
+        return
     await state.update_data(collection_type=collection_id)
-    inventory = build_inventory(config)
-    keyboard = []
-    location_key = user_data.get('location')
-    for item in collection.get("items", []):
-        item_id = str(item['id'])
-        is_available = False
-        if user_data.get('delivery_type') == 'pickup':
-            if location_key in inventory and item_id in inventory[location_key] and inventory[location_key][item_id] > 0:
-                is_available = True
-        else:
-            for loc in inventory.values():
-                if item_id in loc and loc[item_id] > 0:
-                    is_available = True
-                    break
-        item_name = f"🟢 {item['name']}" if is_available else f"🔴 {item['name']}"
-        keyboard.append([InlineKeyboardButton(text=item_name, callback_data=f"aroma_{item['id']}")])
-    keyboard.append(create_back_button())
-    reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
-    if user_data.get('delivery_type') == 'delivery':
-        message_text = f"📍 *Адрес доставки:* {user_data['delivery_address']}\n\nВыберите вкус из коллекции *{collection['name']}*:"
-    else:
-        message_text = f"📍 *Выбранный магазин:* {locations[user_data['location']]['name']}\n\nВыберите вкус из коллекции *{collection['name']}*:"
+    reply_markup = keyboards.get(("items", collection_id, location_key), build_items_keyboard, collection_id, location_key)
+    header = await location_header(state, location_key)
+    message_text = f"{header}\n\nВыберите вкус из коллекции *{collection['name']}*:"
     try:
         await callback.message.delete()
     except Exception as e:
@@ -507,324 +829,82 @@ async def process_collection_type(callback: types.CallbackQuery, state: FSMConte
         logging.error(f"Image file not found: {image_path}")
         await callback.answer("Изображение коллекции не найдено.", show_alert=True)
         return
-    photo = FSInputFile(image_path)
-    await main_bot.send_photo(
-        chat_id=callback.message.chat.id,
-        photo=photo,
+    await media_cache.send_photo(
+        main_bot,
+        callback.message.chat.id,
+        image_path,
         caption=message_text,
         reply_markup=reply_markup,
         parse_mode="Markdown"
     )
     await state.set_state(OrderStates.choosing_aroma)
 
-@main_dp.callback_query(lambda c: c.data.startswith('aroma_'))
-async def process_aroma(callback: types.CallbackQuery, state: FSMContext):
+@callback_router.route("item", ItemChoice)
+async def process_aroma(callback: types.CallbackQuery, state: FSMContext, payload: ItemChoice):
     """
     After the user selects an aroma, check if they have a discount (>0).
     If yes, ask whether to apply the discount.
     """
     user_data = await state.get_data()
     delivery_type = user_data.get('delivery_type', 'pickup')
-    location_info = ""
-    inventory = build_inventory(config)
-    product_type = user_data.get('product_type')
-    if delivery_type == "pickup":
-        location_key = user_data['location']
-        location_info = f"📍 Магазин: {locations[location_key]['name']}"
-        manager_name = locations[location_key].get('manager', 'Менеджер')
-    else:
-        location_info = f"📍 Адрес доставки: {user_data.get('delivery_address', 'Не указан')}"
-        manager_name = "Менеджер доставки"
-    if product_type == "liquid":
-        collections = catalog.get("liquid_collections", [])
-    else:
-        collections = catalog.get("hqd_collections", [])
-    collection = next((c for c in collections if c["id"] == user_data.get('collection_type')), None)
-    if not collection:
+    try:
+        entry = current_catalog().item(payload.item_id)
+    except UnknownItemError:
+        logging.error(f"Item with ID {payload.item_id} not found in catalog.")
+        await callback.answer("Аромат не найден.", show_alert=True)
+        return
+    if entry.collection['id'] != payload.collection_id:
         await callback.answer("Коллекция не найдена.", show_alert=True)
         return
-    aroma_id = callback.data.replace('aroma_', '')
-    aroma = next((item for item in collection.get("items", []) if str(item["id"]) == aroma_id), None)
-    if not aroma:
-        await callback.answer("Аромат не найден.", show_alert=True)
+    # The button must belong to the order being assembled (same store or delivery)
+    order_location = user_data.get('location') if delivery_type == "pickup" else None
+    if payload.location != order_location:
+        await callback.answer("Кнопка устарела. Используйте /start.", show_alert=True)
         return
-    item_id = str(aroma['id'])
-    is_available = False
-    if delivery_type == "pickup":
-        location_key = user_data['location']
-        if location_key in inventory and item_id in inventory[location_key] and inventory[location_key][item_id] > 0:
-            is_available = True
-    else:
-        for loc in inventory.values():
-            if item_id in loc and loc[item_id] > 0:
-                is_available = True
-                break
+    aroma = entry.item
+    is_available = stock_index.item_available(aroma['id'], payload.location)
     if not is_available:
         await callback.answer("Извините, этот товар сейчас недоступен.", show_alert=True)
         return
-    current_time = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-    username = callback.from_user.username or "Без username"
-    user_fullname = callback.from_user.full_name or "Без имени"
-    base_customer_message = (
-        f"✅ *Отлично!*\n\n"
-        f"*Ваш выбор:*\n"
-        f"{location_info}\n"
-        f"📦 *Коллекция:* {collection['name']}\n"
-        f"🎨 *Вкус:* {aroma['name']}\n\n"
-    )
-    print(aroma)
-    item_id = aroma['id']  # Assuming you have the item ID from the selected aroma
-    order_total = get_item_price(item_id, catalog)  # Get the price from the catalog
+    now = datetime.now()
+    order_total = entry.price
     discount = await get_user_discount(callback.from_user.id)
     if discount > 0:
         discount_prompt = f"У вас есть скидка {discount}%. Хотите применить её к вашему заказу?"
         discount_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Да, применить скидку", callback_data="apply_discount")],
-            [InlineKeyboardButton(text="Нет, не применять", callback_data="skip_discount")]
+            [InlineKeyboardButton(text="Да, применить скидку", callback_data=pack("apply"))],
+            [InlineKeyboardButton(text="Нет, не применять", callback_data=pack("skip"))]
         ])
-        # Save all necessary information in state for later use.
-        await state.update_data(
-            current_time=current_time,
-            username=username,
-            user_fullname=user_fullname,
-            location_info=location_info,
-            order_total=order_total,
-            collection=collection,
-            aroma_name=aroma['name'],
-            discount=discount,
-            manager_name=manager_name,
-            delivery_type=delivery_type,
-            delivery_address=user_data.get('delivery_address', "")
-        )
+        # Keep a compact draft in state; names and texts are rebuilt from the catalog later.
+        await state.update_data(draft={
+            "item_id": aroma['id'],
+            "total": order_total,
+            "discount": discount,
+            "ts": int(now.timestamp())
+        })
         await callback.message.answer(discount_prompt, parse_mode="Markdown", reply_markup=discount_keyboard)
         return
-    else:
-        total_val = order_total
-    order_id = str(abs(hash(current_time + username)))[-8:]
-    manager_message = (
-        f"🔔 *Заказ #{order_id}*\n"
-        "━━━━━━━━━━━━━━━\n"
-        f"📅 *Дата:* {current_time}\n"
-        f"👤 *Клиент:*\n"
-        f"   • TG: @{username}\n"
-        f"   • Имя: {user_fullname}\n\n"
-        f"🛍 *Заказ:*\n"
-        f"   • Серия: {collection['name']}\n"
-        f"   • Вкус: {aroma['name']}\n"
-        f"   • Скидка: 0%\n"
-        f"   • Итог: {total_val}\n"
-        f"📍 *Получение:*\n"
-        f"   • {location_info.split(': ', 1)[0]}: {location_info.split(': ', 1)[1]}\n"
-        "━━━━━━━━━━━━━━━"
-    )
-    customer_message = (
-        base_customer_message +
-        "Скидка не применена.\n"
-        f"Итоговая сумма заказа: {total_val}\n\n"
-        "Для нового заказа используйте команду /start"
-    )
-    try:
-        await callback.message.delete()
-    except Exception as e:
-        logging.error(f"Failed to delete message: {e}")
-    sent_message = await callback.message.answer(customer_message, parse_mode="Markdown")
-    asyncio.create_task(send_follow_up_message(sent_message))
-    order_details = {
-        "Order ID": int(order_id),
-        "Date": current_time,
-        "User": f"<https://t.me/{username}>",
-        "Delivery Type": delivery_type,
-        "Location": location_info.split(': ', 1)[1] if delivery_type != 'delivery' else "",
-        "Delivery Address": user_data.get('delivery_address', "") if delivery_type == 'delivery' else "",
-        "Collection Name": collection['name'],
-        "Flavor Name": aroma['name'],
-        "Manager": manager_name,
-        "Discount Applied": 0,
-        "Status": False,
-        "User ID": callback.from_user.id,
-        "Total": total_val
-    }
-    try:
-        orders_airtable.insert(order_details)
-        logging.info("Order details inserted into Airtable successfully.")
-    except Exception as e:
-        logging.error(f"Failed to insert order details into Airtable: {e}")
-        await callback.answer("Ошибка при сохранении заказа.", show_alert=True)
-        return
-    try:
-        for manager_id in config.get("manager_id", []):
-            await manager_bot.send_message(manager_id, manager_message, parse_mode="Markdown")
-        logging.info('Notification sent to manager.')
-    except Exception as e:
-        logging.error(f"Failed to send notification to manager: {e}")
-        await callback.answer("Не удалось уведомить менеджера.", show_alert=True)
-        return
-    process_referral_bonus(callback.from_user.id)
-    await state.clear()
+    order = describe_order(user_data, callback.from_user, entry, order_total, 0, int(now.timestamp()))
+    await place_order(callback, state, order)
 
-@main_dp.callback_query(lambda c: c.data == "apply_discount")
-async def apply_discount_handler(callback: types.CallbackQuery, state: FSMContext):
-    # Check discount monthly usage limit
-    user_records = users_airtable.get_all(formula=f"{{User ID}} = '{callback.from_user.id}'")
-    if user_records:
-        user_record = user_records[0]
-        fields = user_record.get('fields', {})
-        discount_value = int(fields.get("Discount", 0))
-        total_referrals = int(fields.get("Total Referrals", 0))
-        # Allowed uses: if discount < 50 then only 1 per month; if equals 50 then allowed uses = 1 + (Total Referrals - 5)
-        allowed_uses = 1 if discount_value < 50 else (1 + max(total_referrals - 5, 0))
-        usage_count = int(fields.get("Discount Usage Count", 0))
-        usage_month = fields.get("Discount Usage Month", "")
-        current_month = datetime.now().strftime("%Y-%m-%d")
-        if usage_month != current_month:
-            usage_count = 0
-            users_airtable.update(user_record['id'], {"Discount Usage Count": 0, "Discount Usage Month": current_month})
-        if usage_count >= allowed_uses:
-            await callback.answer("Скидка уже была использована максимально допустимое количество раз в этом месяце.", show_alert=True)
-            return
-        # Increment usage count
-        new_usage_count = usage_count + 1
-        users_airtable.update(user_record['id'], {"Discount Usage Count": new_usage_count, "Discount Usage Month": current_month})
-    data = await state.get_data()
-    discount = data.get("discount", 0)
-    order_total = data.get("order_total", 1000)
-    total_val = apply_discount(order_total, discount)
-    order_id = str(abs(hash(data.get("current_time") + data.get("username"))))[-8:]
-    manager_message = (
-        f"🔔 *Заказ #{order_id}*\n"
-        "━━━━━━━━━━━━━━━\n"
-        f"📅 *Дата:* {data.get('current_time')}\n"
-        f"👤 *Клиент:*\n"
-        f"   • TG: @{data.get('username')}\n"
-        f"   • Имя: {data.get('user_fullname')}\n\n"
-        f"🛍 *Заказ:*\n"
-        f"   • Серия: {data.get('collection')['name']}\n"
-        f"   • Вкус: {data.get('aroma_name')}\n"
-        f"   • Скидка: {discount}%\n"
-        f"   • Итог: {total_val}\n"
-        f"📍 *Получение:*\n"
-        f"   • {data.get('location_info').split(': ',1)[0]}: {data.get('location_info').split(': ',1)[1]}\n"
-        "━━━━━━━━━━━━━━━"
-    )
-    customer_message = (
-        f"✅ *Отлично!*\n\n"
-        f"*Ваш выбор:*\n"
-        f"{data.get('location_info')}\n"
-        f"📦 *Коллекция:* {data.get('collection')['name']}\n"
-        f"🎨 *Вкус:* {data.get('aroma_name')}\n\n"
-        f"Скидка {discount}% применена.\n"
-        f"Итоговая сумма заказа: {total_val}\n\n"
-        "Для нового заказа используйте команду /start"
-    )
-    order_details = {
-        "Order ID": int(order_id),
-        "Date": data.get("current_time"),
-        "User": f"<https://t.me/{data.get('username')}>",
-        "Delivery Type": data.get("delivery_type", ""),
-        "Location": data.get("location_info").split(': ',1)[1] if data.get("delivery_type") != 'delivery' else "",
-        "Delivery Address": data.get("delivery_address", "") if data.get("delivery_type") == 'delivery' else "",
-        "Collection Name": data.get("collection")['name'],
-        "Flavor Name": data.get("aroma_name"),
-        "Manager": data.get("manager_name"),
-        "Discount Applied": discount,
-        "Status": False,
-        "User ID": callback.from_user.id,
-        "Total": total_val
-    }
-    try:
-        orders_airtable.insert(order_details)
-        logging.info("Order with discount inserted into Airtable successfully.")
-    except Exception as e:
-        logging.error(f"Failed to insert order details into Airtable: {e}")
-        await callback.answer("Ошибка при сохранении заказа.", show_alert=True)
+@callback_router.route("apply")
+async def apply_discount_handler(callback: types.CallbackQuery, state: FSMContext, payload=None):
+    data = load_order_draft(await state.get_data(), callback.from_user)
+    if not data:
+        await callback.answer("Заказ не найден. Пожалуйста, оформите его заново через /start.", show_alert=True)
         return
-    # If discount is less than 50, then its credit is consumed; for full discount, keep it available.
-    if discount < 50:
-        try:
-            users_airtable.update(user_record['id'], {"Discount": 0, "Total Referrals": 0, "Bonus Awarded": False})
-            logging.info("User discount reset to 0 after applying discount (non-max discount).")
-        except Exception as e:
-            logging.error(f"Failed to reset user discount in Airtable: {e}")
-    try:
-        await callback.message.delete()
-    except Exception as e:
-        logging.error(f"Failed to delete discount confirmation message: {e}")
-    await callback.message.answer(customer_message, parse_mode="Markdown")
-    try:
-        await manager_bot.send_message(manager_id, manager_message, parse_mode="Markdown")
-    except Exception as e:
-        await callback.answer("Не удалось уведомить менеджера.", show_alert=True)
-    process_referral_bonus(callback.from_user.id)
-    await state.clear()
+    await place_order(callback, state, data, use_discount=True)
 
-@main_dp.callback_query(lambda c: c.data == "skip_discount")
-async def skip_discount_handler(callback: types.CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    order_total = data.get("order_total", 1000)
-    total_val = order_total
-    
-    current_time = data.get("current_time") or "default_time"
-    username = data.get("username") or "default_username"
-    
-    order_id = str(abs(hash(current_time + username)))[-8:]
-    manager_message = (
-        f"🔔 *Заказ #{order_id}*\n"
-        "━━━━━━━━━━━━━━━\n"
-        f"📅 *Дата:* {current_time}\n"
-        f"👤 *Клиент:*\n"
-        f"   • TG: @{username}\n"
-        f"   • Имя: {data.get('user_fullname')}\n\n"
-        f"🛍 *Заказ:*\n"
-        f"   • Серия: {data.get('collection')['name']}\n"
-        f"   • Вкус: {data.get('aroma_name')}\n"
-        f"   • Скидка: 0%\n"
-        f"   • Итог: {total_val}\n"
-        f"📍 *Получение:*\n"
-        f"   • {data.get('location_info').split(': ',1)[0]}: {data.get('location_info').split(': ',1)[1]}\n"
-        "━━━━━━━━━━━━━━━"
-    )
-    customer_message = (
-        f"✅ *Отлично!*\n\n"
-        f"*Ваш выбор:*\n"
-        f"{data.get('location_info')}\n"
-        f"📦 *Коллекция:* {data.get('collection')['name']}\n"
-        f"🎨 *Вкус:* {data.get('aroma_name')}\n\n"
-        "Скидка не применена.\n"
-        f"Итоговая сумма заказа: {total_val}\n\n"
-        "Для нового заказа используйте команду /start"
-    )
-    order_details = {
-        "Order ID": int(order_id),
-        "Date": current_time,
-        "User": f"<https://t.me/{username}>",
-        "Delivery Type": data.get("delivery_type", ""),
-        "Location": data.get("location_info").split(': ',1)[1] if data.get("delivery_type") != 'delivery' else "",
-        "Delivery Address": data.get("delivery_address", "") if data.get("delivery_type") == "delivery" else "",
-        "Collection Name": data.get("collection")['name'],
-        "Flavor Name": data.get("aroma_name"),
-        "Manager": data.get("manager_name"),
-        "Discount Applied": 0,
-        "Status": False,
-        "User ID": callback.from_user.id,
-        "Total": total_val
-    }
-    try:
-        orders_airtable.insert(order_details)
-        logging.info("Order without discount inserted into Airtable successfully.")
-    except Exception as e:
-        logging.error(f"Failed to insert order details into Airtable: {e}")
-        await callback.answer("Ошибка при сохранении заказа.", show_alert=True)
+@callback_router.route("skip")
+async def skip_discount_handler(callback: types.CallbackQuery, state: FSMContext, payload=None):
+    data = load_order_draft(await state.get_data(), callback.from_user)
+    if not data:
+        await callback.answer("Заказ не найден. Пожалуйста, оформите его заново через /start.", show_alert=True)
         return
-    await callback.message.answer(customer_message, parse_mode="Markdown")
-    try:
-        await manager_bot.send_message(manager_id, manager_message, parse_mode="Markdown")
-    except Exception as e:
-        logging.error(f"Failed to send notification to manager: {e}")
-    process_referral_bonus(callback.from_user.id)
-    await state.clear()
+    await place_order(callback, state, data)
 
-@main_dp.callback_query(lambda c: c.data == "back")
-async def process_back(callback: types.CallbackQuery, state: FSMContext):
+@callback_router.route("back")
+async def process_back(callback: types.CallbackQuery, state: FSMContext, payload=None):
     current_state = await state.get_state()
     try:
         await callback.message.delete()
@@ -833,21 +913,170 @@ async def process_back(callback: types.CallbackQuery, state: FSMContext):
     if current_state in [OrderStates.choosing_collection_type.state, OrderStates.choosing_product_type.state]:
         await show_delivery_options(callback, state)
     elif current_state == OrderStates.choosing_aroma.state:
-        await process_collection_type(callback, state)
+        user_data = await state.get_data()
+        location_key = user_data.get('location') if user_data.get('delivery_type') == 'pickup' else None
+        await process_collection_type(callback, state, CollectionChoice(user_data['collection_type'], location_key))
     elif current_state in [OrderStates.waiting_for_address.state, OrderStates.choosing_location.state]:
         await show_delivery_options(callback, state)
     else:
         await cmd_start(callback.message, state)
 
-async def main():
+@main_dp.callback_query(callback_router)
+async def dispatch_callback(callback: types.CallbackQuery, state: FSMContext, route, payload):
+    await route.handler(callback, state, payload)
+
+@main_dp.callback_query()
+async def reject_callback(callback: types.CallbackQuery):
+    # Unknown or malformed callback data (e.g. buttons from an older version)
+    await callback.answer("Кнопка устарела. Используйте /start.")
+
+# ----------------------------
+# MANAGER BOT HANDLERS
+# ----------------------------
+
+# Reports are only shown to the managers from config.json
+is_manager = F.from_user.id.in_(set(manager_id))
+
+@manager_dp.message(Command("stock"), is_manager)
+async def cmd_stock(message: types.Message):
+    # /stock [location]: units in stock per location and collection
+    args = message.text.split(maxsplit=1)[1:]
+    location_key = None
+    if args:
+        location_key = stock_report.find_location(args[0])
+        if location_key is None:
+            names = ", ".join(location['name'] for location in locations.values())
+            await message.answer(f"Неизвестная точка. Доступны: {names}")
+            return
+    # Reports are built in a worker thread; a cold or changed ledger takes a moment
+    await message.answer(await asyncio.to_thread(stock_report.stock, location_key), parse_mode="HTML")
+
+@manager_dp.message(Command("sales"), is_manager)
+async def cmd_sales(message: types.Message):
+    # /sales [days]: received, sold, sell-through and days of cover per collection
+    args = message.text.split()[1:]
+    if args and not (args[0].isdigit() and 0 < int(args[0]) <= 366):
+        await message.answer("Использование: /sales [дней, 1-366]")
+        return
+    days = int(args[0]) if args else 30
+    await message.answer(await asyncio.to_thread(stock_report.sales, days), parse_mode="HTML")
+
+startup_profile.mark("handlers")
+
+async def load_bot_username():
     # Retrieve the main bot's username for referral link generation.
     me = await main_bot.get_me()
     main_bot.username = me.username
     logging.info(f"Main bot username set to: {main_bot.username}")
-    await asyncio.gather(
-        main_dp.start_polling(main_bot),
-        manager_dp.start_polling(manager_bot)
-    )
+
+async def load_users():
+    # The first sync is done by whichever worker holds the mirror's sync lease
+    user_mirror.start()
+    if not await user_mirror.wait_fresh():
+        logging.warning("User mirror not loaded yet, reading users from Airtable")
+    try:
+        await referral_index.load()
+    finally:
+        # Periodic refreshes (and retries, if this load failed)
+        referral_index.start()
+
+async def on_startup():
+    order_spool.start()
+    order_pipeline.start()
+    stock_ledger.start()
+    config_watcher.start()
+    discount_ledger.start()
+    startup_profile.mark("startup")
+    # Updates are accepted right away and held by the readiness gate until the required phases are done;
+    # the others finish in the background, and their components use the slower path until then.
+    # Referral links need the bot username, so handlers wait for it however long it takes
+    readiness.start({
+        "bot_username": load_bot_username,
+        "media_cache": lambda: asyncio.to_thread(media_cache.load),
+        "users": load_users,
+        "stock_report": lambda: asyncio.to_thread(stock_report.load),
+    }, required={"bot_username"})
+
+async def on_shutdown():
+    await readiness.stop()
+    await order_pipeline.stop()
+    await order_spool.stop()
+    await config_watcher.stop()
+    await referral_index.stop()
+    await user_mirror.stop()
+    await discount_ledger.stop()
+    await stock_ledger.stop()
+    stock_report.close()
+    order_ids.close()
+    media_cache.close()
+    await airtable.close()
+    await fsm_storage.close()
+
+async def start_metrics():
+    """
+    Serve /metrics if enabled; returns the runner to clean up, or None.
+    """
+    if not metrics_port:
+        return None
+    # Each worker process of the supervisor gets its own port
+    return await metrics.serve_metrics(metrics_host, metrics_port + worker_id)
+
+async def run_polling():
+    # A webhook left over from webhook mode would make getUpdates fail
+    await main_bot.delete_webhook()
+    await manager_bot.delete_webhook()
+    runner = await start_metrics()
+    try:
+        await asyncio.gather(
+            main_dp.start_polling(main_bot),
+            manager_dp.start_polling(manager_bot)
+        )
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+async def run_webhook(host: str, port: int, base_url: str = None, secret: str = "", max_concurrency: int = 100):
+    """
+    Serve both bots from one aiohttp app: /webhook/main and /webhook/manager.
+    Without base_url the webhooks are not registered with Telegram (local testing).
+    """
+    from webhook import WebhookServer, feed_dispatcher
+    server = WebhookServer(max_concurrency)
+    server.add_bot("/webhook/main", secret, feed_dispatcher(main_dp, main_bot))
+    server.add_bot("/webhook/manager", secret, feed_dispatcher(manager_dp, manager_bot))
+    if base_url:
+        for path, bot, dp in (("/webhook/main", main_bot, main_dp), ("/webhook/manager", manager_bot, manager_dp)):
+            await bot.set_webhook(
+                f"{base_url.rstrip('/')}{path}",
+                secret_token=secret or None,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+    runner = await start_metrics()
+    try:
+        await server.serve(host, port)
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+        await main_bot.session.close()
+        await manager_bot.session.close()
+
+async def main(args):
+    await on_startup()
+    try:
+        if args.mode == "webhook":
+            await run_webhook(args.host, args.port, args.webhook_url, args.secret, args.max_concurrency)
+        else:
+            await run_polling()
+    finally:
+        await on_shutdown()
+
+def parse_args():
+    from webhook import add_server_arguments, check_server_arguments
+    parser = argparse.ArgumentParser(description="Vienna Vape bots")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    check_server_arguments(parser, args)
+    return args
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,151 @@
+import hashlib
+import logging
+import os
+import sqlite3
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, InputMediaPhoto
+
+from sqlite_db import open_sqlite
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaCache:
+    """
+    Persistent cache of Telegram file_ids for local images.
+
+    The first send of an image uploads the file and records the file_id that
+    Telegram returns, together with the content hash of the file. Later sends
+    reuse the file_id as long as the file on disk is unchanged. file_ids are
+    only valid for the bot that uploaded them, so entries are kept per bot.
+    Entries live in SQLite (WAL), shared by all bot workers and send_catalog.py;
+    every write is a single-row upsert, so concurrent writers never lose
+    each other's file_ids.
+    """
+
+    def __init__(self, path: str, lazy: bool = False):
+        self.path = path
+        self._db = None
+        if not lazy:
+            self.load()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = open_sqlite(self.path)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS media ("
+                " bot_id TEXT NOT NULL,"
+                " image_path TEXT NOT NULL,"
+                " file_id TEXT NOT NULL,"
+                " sha256 TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " mtime_ns INTEGER NOT NULL,"
+                " PRIMARY KEY (bot_id, image_path))"
+            )
+            self._db = db
+        return self._db
+
+    def load(self):
+        """
+        Open the cache; with lazy=True this is left to the caller (e.g. startup warm-up).
+        """
+        self._connection()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _fingerprint(self, image_path: str, entry=None) -> dict:
+        stat = os.stat(image_path)
+        # Only re-hash when size or mtime changed since the entry was written
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            sha256 = entry['sha256']
+        else:
+            sha256 = file_sha256(image_path)
+        return {'sha256': sha256, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def get(self, bot_id: int, image_path: str):
+        """
+        Return the cached file_id for the image, or None if it is unknown or the file changed.
+        """
+        row = self._connection().execute(
+            "SELECT file_id, sha256, size, mtime_ns FROM media WHERE bot_id = ? AND image_path = ?",
+            (str(bot_id), image_path)
+        ).fetchone()
+        if not row:
+            return None
+        entry = dict(zip(('file_id', 'sha256', 'size', 'mtime_ns'), row))
+        if self._fingerprint(image_path, entry)['sha256'] != entry['sha256']:
+            self.invalidate(bot_id, image_path, entry['file_id'])
+            return None
+        return entry['file_id']
+
+    def remember(self, bot_id: int, image_path: str, file_id: str):
+        entry = self._fingerprint(image_path)
+        self._connection().execute(
+            "INSERT INTO media (bot_id, image_path, file_id, sha256, size, mtime_ns) VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT(bot_id, image_path) DO UPDATE SET file_id = excluded.file_id, sha256 = excluded.sha256,"
+            " size = excluded.size, mtime_ns = excluded.mtime_ns",
+            (str(bot_id), image_path, file_id, entry['sha256'], entry['size'], entry['mtime_ns'])
+        )
+
+    def invalidate(self, bot_id: int, image_path: str, file_id: str = None):
+        """
+        Forget the image's file_id; with `file_id`, only if no other process replaced it meanwhile.
+        """
+        if file_id is None:
+            self._connection().execute(
+                "DELETE FROM media WHERE bot_id = ? AND image_path = ?", (str(bot_id), image_path)
+            )
+        else:
+            self._connection().execute(
+                "DELETE FROM media WHERE bot_id = ? AND image_path = ? AND file_id = ?",
+                (str(bot_id), image_path, file_id)
+            )
+
+    async def send_photo(self, bot, chat_id, image_path: str, **kwargs):
+        """
+        Send a local image, reusing the cached file_id when possible.
+        """
+        file_id = self.get(bot.id, image_path)
+        if file_id:
+            try:
+                return await bot.send_photo(chat_id, photo=file_id, **kwargs)
+            except TelegramBadRequest as e:
+                # Other bad requests (e.g. caption markup) would fail the upload too
+                if 'file' not in str(e).lower():
+                    raise
+                logging.warning(f"Cached file_id for {image_path} rejected, uploading again: {e}")
+                self.invalidate(bot.id, image_path, file_id)
+        message = await bot.send_photo(chat_id, photo=FSInputFile(image_path), **kwargs)
+        self.remember(bot.id, image_path, message.photo[-1].file_id)
+        return message
+
+    async def edit_photo(self, bot, chat_id, message_id: int, image_path: str, **kwargs):
+        """
+        Replace the photo (and caption) of a sent message, reusing the cached file_id when possible.
+        """
+        file_id = self.get(bot.id, image_path)
+        if file_id:
+            try:
+                return await bot.edit_message_media(
+                    InputMediaPhoto(media=file_id, **kwargs), chat_id=chat_id, message_id=message_id
+                )
+            except TelegramBadRequest as e:
+                if 'file' not in str(e).lower():
+                    raise
+                logging.warning(f"Cached file_id for {image_path} rejected, uploading again: {e}")
+                self.invalidate(bot.id, image_path, file_id)
+        message = await bot.edit_message_media(
+            InputMediaPhoto(media=FSInputFile(image_path), **kwargs), chat_id=chat_id, message_id=message_id
+        )
+        self.remember(bot.id, image_path, message.photo[-1].file_id)
+        return message
@@ -0,0 +1,303 @@
+import asyncio
+import bisect
+import logging
+import re
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import InputFile
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Label values beyond this many series per metric are folded into "other"
+MAX_SERIES = 200
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+
+    def _key(self, labels: dict) -> tuple:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        if key not in self._series and len(self._series) >= MAX_SERIES:
+            key = tuple("other" for _ in self.labelnames)
+        return key
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self._series.items():
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._series[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            # Per-bucket counts (not cumulative), then sum and count
+            series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _labels(self.labelnames, key, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    """
+    Holds all metrics and renders them in the Prometheus text format.
+
+    Collectors are callables (or coroutine functions, for stats that need
+    I/O) run at scrape time to refresh gauges that mirror other components
+    (queue depth, cache counters), so nothing is polled between scrapes.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    async def render(self) -> str:
+        for collector in self._collectors:
+            if asyncio.iscoroutinefunction(collector):
+                await collector()
+            else:
+                collector()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+handler_seconds = REGISTRY.register(Histogram(
+    "bot_handler_seconds", "Handler latency.", ("bot", "handler", "prefix")))
+update_seconds = REGISTRY.register(Histogram(
+    "bot_update_seconds", "Update processing latency including filters and middlewares.", ("bot", "event", "prefix")))
+updates_in_flight = REGISTRY.register(Gauge(
+    "bot_updates_in_flight", "Updates being processed.", ("bot",)))
+update_errors = REGISTRY.register(Counter(
+    "bot_update_errors_total", "Updates that raised an exception.", ("bot", "event", "prefix")))
+telegram_seconds = REGISTRY.register(Histogram(
+    "telegram_request_seconds", "Bot API request latency.", ("bot", "method", "upload")))
+telegram_in_flight = REGISTRY.register(Gauge(
+    "telegram_requests_in_flight", "Bot API requests in flight.", ("bot",)))
+telegram_errors = REGISTRY.register(Counter(
+    "telegram_request_errors_total", "Bot API requests that failed.", ("bot", "method")))
+airtable_seconds = REGISTRY.register(Histogram(
+    "airtable_request_seconds", "Airtable request latency including retries.", ("method", "table")))
+airtable_in_flight = REGISTRY.register(Gauge(
+    "airtable_requests_in_flight", "Airtable requests in flight.", ()))
+airtable_errors = REGISTRY.register(Counter(
+    "airtable_request_errors_total", "Airtable requests that failed after retries.", ("method", "table")))
+component_stats = REGISTRY.register(Gauge(
+    "bot_component_stat", "Numeric stats reported by caches and queues.", ("component", "stat")))
+
+
+def expose_stats(component: str, stats):
+    """
+    Publish the numeric values of a component's stats() dict at scrape time.
+    stats may be a coroutine function.
+    """
+    def publish(values: dict):
+        for stat, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                component_stats.set(value, component=component, stat=stat)
+
+    if asyncio.iscoroutinefunction(stats):
+        async def collect():
+            try:
+                publish(await stats())
+            except Exception as e:
+                # An unreachable backend must not fail the whole scrape
+                logging.warning(f"Failed to collect {component} stats: {e}")
+    else:
+        def collect():
+            publish(stats())
+    REGISTRY.add_collector(collect)
+
+
+def callback_prefix(data) -> str:
+    """
+    Low-cardinality label for callback data: the part before the first "_" or ":".
+    """
+    if not data:
+        return ""
+    prefix = re.split(r"[_:]", data, 1)[0]
+    return prefix if prefix.isalpha() and len(prefix) <= 16 else "other"
+
+
+def _event_labels(event) -> tuple:
+    callback = getattr(event, "callback_query", None)
+    if callback is not None:
+        return "callback_query", callback_prefix(callback.data)
+    if getattr(event, "message", None) is not None:
+        text = event.message.text or ""
+        return "message", text.split()[0][:32] if text.startswith("/") else ""
+    return getattr(event, "event_type", "other"), ""
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """
+    Outer middleware on dispatcher.update: total latency, in-flight and error counts.
+    """
+
+    def __init__(self, bot_name: str):
+        self.bot_name = bot_name
+
+    async def __call__(self, handler, event, data):
+        event_type, prefix = _event_labels(event)
+        updates_in_flight.inc(bot=self.bot_name)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            update_errors.inc(bot=self.bot_name, event=event_type, prefix=prefix)
+            raise
+        finally:
+            update_seconds.observe(time.perf_counter() - started, bot=self.bot_name, event=event_type, prefix=prefix)
+            updates_in_flight.dec(bot=self.bot_name)
+
+
+def handler_name(data: dict) -> str:
+    """
+    Name of the handler serving an event; callback queries report the routed handler.
+    """
+    route = data.get("route")
+    return route.name if route is not None else data["handler"].callback.__name__
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Inner middleware on message/callback_query observers, where the matched handler is known.
+    """
+
+    def __init__(self, bot_name: str):
+        self.bot_name = bot_name
+
+    async def __call__(self, handler, event, data):
+        name = handler_name(data)
+        prefix = callback_prefix(getattr(event, "data", None))
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, bot=self.bot_name, handler=name, prefix=prefix)
+
+
+class RequestMetricsMiddleware(BaseRequestMiddleware):
+    """
+    Bot session middleware timing every Bot API call; uploads are labelled separately.
+    """
+
+    def __init__(self, bot_name: str):
+        self.bot_name = bot_name
+
+    async def __call__(self, make_request, bot, method):
+        api_method = method.__api_method__
+        upload = "true" if any(isinstance(value, InputFile) for value in method.__dict__.values()) else "false"
+        telegram_in_flight.inc(bot=self.bot_name)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            telegram_errors.inc(bot=self.bot_name, method=api_method)
+            raise
+        finally:
+            telegram_seconds.observe(time.perf_counter() - started, bot=self.bot_name, method=api_method, upload=upload)
+            telegram_in_flight.dec(bot=self.bot_name)
+
+
+def instrument(dispatcher, bot, bot_name: str):
+    """
+    Attach the update, handler and Bot API middlewares for one bot.
+    """
+    dispatcher.update.outer_middleware(UpdateMetricsMiddleware(bot_name))
+    dispatcher.message.middleware(HandlerMetricsMiddleware(bot_name))
+    dispatcher.callback_query.middleware(HandlerMetricsMiddleware(bot_name))
+    bot.session.middleware(RequestMetricsMiddleware(bot_name))
+
+
+async def metrics_handler(request):
+    # aiohttp.web is only needed once metrics are served
+    from aiohttp import web
+    return web.Response(text=await REGISTRY.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def serve_metrics(host: str, port: int):
+    """
+    Serve /metrics on its own port, apart from the public webhook app.
+    Returns the aiohttp AppRunner; call cleanup() on it to stop.
+    """
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,54 @@
+import asyncio
+import logging
+
+from rate_limit import SendScheduler, TokenBucket
+
+
+class ManagerNotifier:
+    """
+    Sends order notifications to all managers concurrently.
+
+    Every chat has its own SendScheduler, and all of them share a global
+    bucket for the bot, so a burst of orders stays within Telegram's limits.
+    A 429 pauses the chat for the retry_after Telegram asks for before the
+    message is retried; one slow chat does not hold up the others.
+    """
+
+    def __init__(self, bot, chat_ids, global_rate: float = 25.0, per_chat_rate: float = 1.0,
+                 per_chat_burst: float = 3.0, retries: int = 3):
+        self.bot = bot
+        self.chat_ids = list(chat_ids)
+        self.retries = retries
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self._global = TokenBucket(global_rate)
+        self._per_chat = {}
+
+    def _scheduler(self, chat_id) -> SendScheduler:
+        scheduler = self._per_chat.get(chat_id)
+        if scheduler is None:
+            scheduler = self._per_chat[chat_id] = SendScheduler(
+                self.per_chat_rate, self.per_chat_burst, retries=self.retries, global_bucket=self._global
+            )
+        return scheduler
+
+    async def send(self, chat_id, text: str, **kwargs):
+        """
+        Send one message under the rate limits, honouring retry_after on 429.
+        """
+        return await self._scheduler(chat_id).call(lambda: self.bot.send_message(chat_id, text, **kwargs))
+
+    async def notify(self, text: str, **kwargs) -> list:
+        """
+        Send the message to every manager. Returns the chat ids that could not be notified.
+        """
+        results = await asyncio.gather(
+            *(self.send(chat_id, text, **kwargs) for chat_id in self.chat_ids),
+            return_exceptions=True
+        )
+        failed = []
+        for chat_id, result in zip(self.chat_ids, results):
+            if isinstance(result, BaseException):
+                logging.error(f"Failed to send notification to manager {chat_id}: {result}")
+                failed.append(chat_id)
+        return failed
@@ -0,0 +1,159 @@
+import asyncio
+import json
+import logging
+import random
+import time
+
+from sqlite_db import open_sqlite
+
+
+class OrderPipeline:
+    """
+    Runs the side effects of confirmed orders in the background.
+
+    The customer already has their confirmation when an order is submitted.
+    Its effects are built by `build(order_id, payload)` as {name: [step, ...]},
+    where a step is a function returning a coroutine, and run concurrently
+    with each other. The steps of one effect run in sequence, for effects
+    whose writes depend on each other. A failed step is retried with backoff,
+    without repeating the steps before it. An effect that still fails is
+    logged and passed to `report(order_id, effect, error)`.
+
+    The payload (JSON; steps may record their progress in it) and the steps
+    done so far are kept in a local SQLite table until all effects have
+    finished, so effects cut short by a shutdown or a crash are resumed by
+    the next start(). A step that was running at that moment runs again.
+    """
+
+    def __init__(self, path: str, build, report=None, retries: int = 3, base_delay: float = 1.0,
+                 max_delay: float = 30.0):
+        self.build = build
+        self.report = report
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._db = open_sqlite(path, synchronous="FULL")
+        # progress: {effect: steps done} of the effects that have not finished yet
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS order_effects ("
+            " order_id INTEGER PRIMARY KEY,"
+            " payload TEXT NOT NULL,"
+            " progress TEXT NOT NULL,"
+            " submitted_at REAL NOT NULL)"
+        )
+        self._tasks = {}
+        self.submitted = 0
+        self.resumed = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.last_seconds = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "submitted": self.submitted,
+            "resumed": self.resumed,
+            "in_flight": len(self._tasks),
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+            "last_seconds": self.last_seconds,
+        }
+
+    def _save(self, order_id, payload: dict, progress: dict):
+        if progress:
+            self._db.execute(
+                "UPDATE order_effects SET payload = ?, progress = ? WHERE order_id = ?",
+                (json.dumps(payload, ensure_ascii=False), json.dumps(progress), order_id)
+            )
+        else:
+            self._db.execute("DELETE FROM order_effects WHERE order_id = ?", (order_id,))
+
+    async def _run_effect(self, order_id, name: str, steps: list, payload: dict, progress: dict):
+        for step in steps[progress[name]:]:
+            for attempt in range(self.retries + 1):
+                try:
+                    await step()
+                    break
+                except Exception as e:
+                    if attempt == self.retries:
+                        raise
+                    self.retried += 1
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                    logging.warning(f"Order {order_id}: '{name}' failed, retrying in {delay:.1f}s: {e}")
+                    self._save(order_id, payload, progress)
+                    await asyncio.sleep(delay)
+            progress[name] += 1
+            self._save(order_id, payload, progress)
+
+    async def _run(self, order_id, payload: dict, progress: dict):
+        started = time.perf_counter()
+        effects = self.build(order_id, payload)
+        names = [name for name in effects if name in progress]
+        results = await asyncio.gather(
+            *(self._run_effect(order_id, name, effects[name], payload, progress) for name in names),
+            return_exceptions=True
+        )
+        for name, result in zip(names, results):
+            if isinstance(result, asyncio.CancelledError):
+                continue
+            del progress[name]
+            if isinstance(result, Exception):
+                self.failed += 1
+                logging.error(f"Order {order_id}: '{name}' failed after {self.retries} retries: {result}")
+                if self.report is not None:
+                    try:
+                        await self.report(order_id, name, result)
+                    except Exception as e:
+                        logging.error(f"Failed to report order {order_id} side effect failure: {e}")
+            else:
+                self.completed += 1
+        self._save(order_id, payload, progress)
+        self.last_seconds = time.perf_counter() - started
+
+    def _start(self, order_id, payload: dict, progress: dict):
+        task = asyncio.create_task(self._run(order_id, payload, progress))
+        self._tasks[task] = order_id
+        task.add_done_callback(lambda t: self._tasks.pop(t, None))
+        return task
+
+    def submit(self, order_id, payload: dict):
+        """
+        Record and start the side effects of an order; returns immediately.
+        """
+        self.submitted += 1
+        progress = {name: 0 for name in self.build(order_id, payload)}
+        self._db.execute(
+            "INSERT OR REPLACE INTO order_effects (order_id, payload, progress, submitted_at) VALUES (?, ?, ?, ?)",
+            (order_id, json.dumps(payload, ensure_ascii=False), json.dumps(progress), time.time())
+        )
+        return self._start(order_id, payload, progress)
+
+    def start(self):
+        """
+        Resume the side effects left unfinished by the previous run.
+        """
+        rows = self._db.execute("SELECT order_id, payload, progress FROM order_effects ORDER BY order_id").fetchall()
+        if rows:
+            logging.warning(f"Resuming side effects of {len(rows)} orders: {', '.join(str(row[0]) for row in rows)}")
+        for order_id, payload, progress in rows:
+            self.resumed += 1
+            self._start(order_id, json.loads(payload), json.loads(progress))
+
+    async def stop(self, timeout: float = 15.0):
+        """
+        Give running side effects `timeout` seconds to finish, then cancel them;
+        the next start() resumes the cancelled ones.
+        """
+        if self._tasks:
+            done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+            if pending:
+                order_ids = sorted(self._tasks[task] for task in pending)
+                logging.warning(
+                    f"Cancelled side effects of {len(pending)} orders on shutdown, kept for the next start: "
+                    f"{', '.join(str(order_id) for order_id in order_ids)}"
+                )
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+        self._db.close()
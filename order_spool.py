@@ -0,0 +1,160 @@
+import asyncio
+import json
+import logging
+import time
+
+from airtable_gateway import AirtableError
+from background import cancel_task, flush_loop
+from sqlite_db import open_sqlite
+
+# Airtable accepts at most 10 records per create or upsert request
+MAX_BATCH_SIZE = 10
+
+
+class OrderSpool:
+    """
+    Durable write-behind queue for Orders records.
+
+    Checkout handlers enqueue the order into a local SQLite (WAL) database and
+    return immediately. A single background flusher pushes queued orders to
+    Airtable in batches of up to 10 records, oldest first, and only removes
+    them once Airtable has accepted them. Records are upserted on their Order
+    ID, so a batch sent again after a timeout or a 5xx (which Airtable may
+    have processed anyway) does not create duplicate orders. Records Airtable
+    rejects as invalid are moved to a dead-letter table instead of blocking
+    the queue.
+    """
+
+    def __init__(self, path: str, gateway, batch_size: int = MAX_BATCH_SIZE,
+                 interval: float = 1.0, max_backoff: float = 60.0):
+        self.gateway = gateway
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self._db = open_sqlite(path, synchronous="FULL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS order_spool ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " fields TEXT NOT NULL,"
+            " enqueued_at REAL NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " last_error TEXT)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS order_spool_dead ("
+            " seq INTEGER PRIMARY KEY,"
+            " fields TEXT NOT NULL,"
+            " enqueued_at REAL NOT NULL,"
+            " failed_at REAL NOT NULL,"
+            " error TEXT)"
+        )
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.flushed = 0
+        self.failures = 0
+        self.last_flush_latency = None
+        self.last_error = None
+
+    def enqueue(self, fields: dict) -> int:
+        """
+        Durably queue one order and return its spool sequence number.
+        """
+        cursor = self._db.execute(
+            "INSERT INTO order_spool (fields, enqueued_at) VALUES (?, ?)",
+            (json.dumps(fields, ensure_ascii=False), time.time())
+        )
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    def depth(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM order_spool").fetchone()[0]
+
+    def stats(self) -> dict:
+        depth, oldest = self._db.execute("SELECT COUNT(*), MIN(enqueued_at) FROM order_spool").fetchone()
+        dead = self._db.execute("SELECT COUNT(*) FROM order_spool_dead").fetchone()[0]
+        return {
+            "depth": depth,
+            "oldest_age": time.time() - oldest if oldest else 0.0,
+            "dead": dead,
+            "flushed": self.flushed,
+            "failures": self.failures,
+            "last_flush_latency": self.last_flush_latency,
+            "last_error": self.last_error,
+        }
+
+    def _batch(self, limit: int) -> list:
+        return self._db.execute(
+            "SELECT seq, fields, enqueued_at FROM order_spool ORDER BY seq LIMIT ?", (limit,)
+        ).fetchall()
+
+    async def _push(self, rows: list):
+        started = time.monotonic()
+        await self.gateway.upsert_orders([json.loads(fields) for _, fields, _ in rows])
+        self.last_flush_latency = time.monotonic() - started
+        self._db.executemany("DELETE FROM order_spool WHERE seq = ?", [(seq,) for seq, _, _ in rows])
+        self.flushed += len(rows)
+
+    def _bury(self, row, error: Exception):
+        seq, fields, enqueued_at = row
+        logging.error(f"Order spool entry {seq} rejected by Airtable, moved to dead letters: {error}")
+        self._db.execute("BEGIN IMMEDIATE")
+        self._db.execute(
+            "INSERT INTO order_spool_dead (seq, fields, enqueued_at, failed_at, error) VALUES (?, ?, ?, ?, ?)",
+            (seq, fields, enqueued_at, time.time(), str(error))
+        )
+        self._db.execute("DELETE FROM order_spool WHERE seq = ?", (seq,))
+        self._db.execute("COMMIT")
+
+    async def flush_once(self) -> int:
+        """
+        Push the oldest batch to Airtable. Returns the number of orders flushed.
+        """
+        rows = self._batch(self.batch_size)
+        if not rows:
+            return 0
+        try:
+            await self._push(rows)
+            return len(rows)
+        except AirtableError as e:
+            self.failures += 1
+            self.last_error = str(e)
+            self._db.execute(
+                "UPDATE order_spool SET attempts = attempts + 1, last_error = ? WHERE seq = ?",
+                (str(e), rows[0][0])
+            )
+            if e.status is None or e.status >= 500 or e.status == 429:
+                raise
+        # Airtable rejected the batch as invalid: isolate the bad record(s) one by one
+        flushed = 0
+        for row in rows:
+            try:
+                await self._push([row])
+                flushed += 1
+            except AirtableError as e:
+                if e.status is None or e.status >= 500 or e.status == 429:
+                    raise
+                self._bury(row, e)
+        return flushed
+
+    async def run(self):
+        """
+        Flush the spool until cancelled, backing off while Airtable is unavailable.
+        """
+        await flush_loop(self.flush_once, lambda: f"flush order spool ({self.depth()} queued)", self.batch_size,
+                         self.interval, self.max_backoff, wakeup=self._wakeup, expected=AirtableError)
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """
+        Stop the flusher and make one last attempt to drain the queue.
+        """
+        await cancel_task(self._task)
+        self._task = None
+        try:
+            while await self.flush_once():
+                pass
+        except Exception as e:
+            logging.error(f"Order spool not fully drained on shutdown ({self.depth()} queued): {e}")
+        self._db.close()
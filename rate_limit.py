@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter
+
+
+class TokenBucket:
+    """
+    Async token bucket.
+
+    Refills at `rate` tokens per second up to `capacity`. Waiters are served
+    strictly in arrival order, so callers that acquire in sequence also get
+    their turn in sequence.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1.0):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """
+        Hand out no tokens for the given time, e.g. after a Telegram retry_after.
+        """
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0.0
+        self._updated = now + seconds
+
+
+class SendScheduler:
+    """
+    Runs Bot API calls for one chat as fast as its rate limit allows.
+
+    Calls wait for a token and then run concurrently (up to
+    `max_concurrency` in flight). A 429 pauses the whole bucket for the
+    retry_after Telegram asks for, and the call is retried. Ordered calls
+    (e.g. new channel posts, whose position and message id matter) start
+    only after the previous ordered call has finished, so they reach the
+    chat in submission order; unordered calls (edits, deletions) overtake
+    them freely. Telegram allows about 20 messages per minute in a group or
+    channel, hence the defaults. Schedulers of several chats can also share
+    a bot-wide `global_bucket`, which every call takes a token from as well.
+    """
+
+    def __init__(self, rate: float = 20 / 60, burst: float = 20, max_concurrency: int = 8, retries: int = 5,
+                 global_bucket: TokenBucket = None):
+        self.retries = retries
+        self._bucket = TokenBucket(rate, burst)
+        self._global = global_bucket
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._ordered_tail = None
+        self.calls = 0
+        self.retried = 0
+        self.throttled_seconds = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "retried": self.retried,
+            "throttled_seconds": self.throttled_seconds,
+        }
+
+    async def _send(self, make_request):
+        for attempt in range(self.retries + 1):
+            await self._bucket.acquire()
+            if self._global is not None:
+                await self._global.acquire()
+            try:
+                async with self._semaphore:
+                    result = await make_request()
+                self.calls += 1
+                return result
+            except TelegramRetryAfter as e:
+                if attempt == self.retries:
+                    raise
+                self.retried += 1
+                self.throttled_seconds += e.retry_after
+                logging.warning(f"Telegram asked to retry after {e.retry_after}s")
+                self._bucket.pause(e.retry_after)
+            except TelegramNetworkError as e:
+                if attempt == self.retries:
+                    raise
+                self.retried += 1
+                logging.warning(f"Network error, retrying: {e}")
+                await asyncio.sleep(2 ** attempt)
+
+    async def call(self, make_request, ordered: bool = False):
+        """
+        Run `make_request()` under the rate limit and return its result.
+        `make_request` creates the request coroutine and is called again on every retry.
+        """
+        if not ordered:
+            return await self._send(make_request)
+        previous = self._ordered_tail
+        done = asyncio.get_running_loop().create_future()
+        self._ordered_tail = done
+        try:
+            if previous is not None:
+                await previous
+            return await self._send(make_request)
+        finally:
+            done.set_result(None)
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import time
+
+from background import cancel_task
+
+# Users fields the index is built from
+INDEX_FIELDS = ("User ID", "Username", "Referrer Code")
+
+
+class ReferralIndex:
+    """
+    In-memory referral graph: referral code -> users who registered with it.
+
+    Loaded in bulk from the Users table at startup and refreshed periodically
+    (other worker processes register users too); registrations in this
+    process are added immediately. Until the first load has finished the
+    index is cold and lookups go to Airtable.
+    """
+
+    def __init__(self, gateway, refresh_interval: float = 600.0):
+        self.gateway = gateway
+        self.refresh_interval = refresh_interval
+        self._referred = {}
+        # Registrations made while a load is reading the table
+        self._pending = None
+        self._task = None
+        self.ready = False
+        self.loaded_at = None
+        self.local_hits = 0
+        self.remote_lookups = 0
+
+    def stats(self) -> dict:
+        return {
+            "ready": int(self.ready),
+            "codes": len(self._referred),
+            "referred": sum(len(users) for users in self._referred.values()),
+            "age": time.time() - self.loaded_at if self.loaded_at else 0.0,
+            "local_hits": self.local_hits,
+            "remote_lookups": self.remote_lookups,
+        }
+
+    def add(self, user_id, username: str, referrer_code: str):
+        """
+        Record a registration with a referral code.
+        """
+        if referrer_code:
+            self._referred.setdefault(referrer_code, {})[str(user_id)] = username
+            if self._pending is not None:
+                self._pending.append((referrer_code, str(user_id), username))
+
+    async def load(self):
+        """
+        Rebuild the index from the whole Users table.
+        """
+        started = time.monotonic()
+        self._pending = []
+        try:
+            records = await self.gateway.all_users(fields=INDEX_FIELDS)
+        except BaseException:
+            self._pending = None
+            raise
+        referred = {}
+        for record in records:
+            fields = record.get('fields', {})
+            code = fields.get("Referrer Code")
+            if code:
+                referred.setdefault(code, {})[str(fields.get("User ID", record['id']))] = fields.get("Username", "NoUsername")
+        for code, user_id, username in self._pending:
+            referred.setdefault(code, {}).setdefault(user_id, username)
+        self._pending = None
+        self._referred = referred
+        self.ready = True
+        self.loaded_at = time.time()
+        logging.info(f"Referral index loaded: {len(records)} users in {time.monotonic() - started:.2f}s")
+
+    async def referred_usernames(self, referral_code: str) -> list:
+        """
+        Usernames of the users referred by a code; asks Airtable only while the index is cold.
+        """
+        if self.ready:
+            self.local_hits += 1
+            return list(self._referred.get(referral_code, {}).values())
+        self.remote_lookups += 1
+        records = await self.gateway.find_users_by_referrer_code(referral_code)
+        return [record['fields'].get('Username', 'NoUsername') for record in records]
+
+    async def run(self):
+        # A load done before start (startup warm-up) counts as the first one
+        if self.ready:
+            await asyncio.sleep(self.refresh_interval)
+        while True:
+            try:
+                await self.load()
+            except Exception as e:
+                logging.error(f"Failed to load referral index: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        await cancel_task(self._task)
+        self._task = None
@@ -1,9 +1,15 @@
+import argparse
 import asyncio
+import hashlib
 from aiogram import Bot, types
-from aiogram.types import FSInputFile
+from aiogram.exceptions import TelegramBadRequest
 import json
 import os
-from datetime import datetime
+import time
+
+from channel_manifest import ChannelManifest
+from media_cache import MediaCache, file_sha256
+from rate_limit import SendScheduler
 
 # Load config
 with open('config.json', 'r', encoding='utf-8') as file:
@@ -14,27 +20,50 @@ bot = Bot(token=config['manager_bot_token'])
 link_bot_start = "https://t.me/ViennVapebot?start=start"
 CHANNEL_ID = -1002267350500
 
+data_dir = os.environ.get("BOT_DATA_DIR", "data")
+
+# Telegram file_ids of uploaded collection photos, shared with the bot
+media_cache = MediaCache(os.path.join(data_dir, "media_cache.sqlite3"))
+
+# Message ids and content hashes of the posts already in the channel
+manifest = ChannelManifest(os.path.join(data_dir, "channel_manifest.json"), CHANNEL_ID)
+
+# Channel posts go out concurrently within Telegram's per-chat limit; new posts keep their order
+scheduler = SendScheduler()
+
 # Use premium emojis from config
 PREMIUM_EMOJIS = config['premium_emojis']
 
-async def send_channel_description():
-    """Send channel description with branding"""
-    description = (
+# What a publish run did, printed at the end
+publish_counts = {'sent': 0, 'edited': 0, 'deleted': 0, 'unchanged': 0}
+
+def post_link(message_id):
+    return f"https://t.me/c/{str(CHANNEL_ID)[4:]}/{message_id}"
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def sorted_collections():
+    """Devices by number of puffs, then liquids in config order"""
+    catalog = config['catalog']
+    return sorted(catalog.get('hqd_collections', []), key=lambda x: x.get('puffs', 0)) + catalog.get('liquid_collections', [])
+
+def render_channel_description():
+    """Channel description with branding"""
+    return (
         f"<b>{PREMIUM_EMOJIS['info']} {config['branding']['channel_name']}</b>\n\n"
         f"{config['branding']['channel_description']}\n\n"
     )
-    return await bot.send_message(CHANNEL_ID, description, parse_mode="HTML")
 
-async def send_why_us():
-    """Send Why Choose Us section"""
-    why_us_text = (
+def render_why_us():
+    """Why Choose Us section"""
+    return (
         f"{PREMIUM_EMOJIS['info']} <b>ПОЧЕМУ МЫ?</b>\n\n"
         + "\n".join(config['menu_sections']['why_us'])
     )
-    return await bot.send_message(CHANNEL_ID, why_us_text, parse_mode="HTML")
 
-async def send_delivery_info():
-    """Send delivery information"""
+def render_delivery_info():
+    """Delivery information"""
     delivery = config['menu_sections']['delivery']
     delivery_text = (
         f"{PREMIUM_EMOJIS['delivery']} <b>ДОСТАВКА</b>\n\n"
@@ -44,178 +73,214 @@ async def send_delivery_info():
         "📍 <b>ПУНКТЫ САМОВЫВОЗА</b>\n"
         "<blockquote>\n"
     )
-    
+
     for location in config['locations'].values():
         delivery_text += f"• {location['name']}\n"
-    
+
     delivery_text += "</blockquote>\n"
-    
-    return await bot.send_message(CHANNEL_ID, delivery_text, parse_mode="HTML")
+    return delivery_text
 
-async def send_price_list():
+def render_price_list():
     """Enhanced price list with premium formatting"""
     price_list = (
         f"{PREMIUM_EMOJIS['price']} <b>Price list</b>\n\n"
     )
-    
-    sorted_collections = sorted(config['catalog']['collections'], 
-                              key=lambda x: x.get('puffs', 0))
-    
-    for collection in sorted_collections:
+
+    for collection in sorted_collections():
         base_price = int(collection['price'])
         tier1_price = base_price
         tier2_price = base_price - 1
         tier3_price = base_price - 2
-        
+
         price_list += (
             f"<b>{collection['name'].upper().replace('ELF BAR ', '')}</b>\n"
             f"""▫️ 1-5 pcs: {tier1_price}\n"""
             f"""▫️ 6-7 pcs: {tier2_price}\n"""
             f"""▫️ 8-10 pcs: {tier3_price}\n\n"""
         )
-    
+
     price_list += (
         "❕Цена формируется от общего количества\n"
         "❕The price is formed from the total quantity\n\n"
         "👇Для заказа пишите:\n\n"
         f"🐇 <a href='{link_bot_start}'>МЕНЕДЖЕР</a>\n\n"
     )
-    
-    price_msg = await bot.send_message(CHANNEL_ID, price_list, parse_mode="HTML")
-    return price_msg.message_id
-
-async def send_catalog(price_list_id):
-    """Enhanced catalog with premium formatting"""
-    message_ids = []
-    sorted_collections = sorted(config['catalog']['collections'], 
-                              key=lambda x: x.get('puffs', 0))
-    
-    for collection in sorted_collections:
-        tastes = "\n".join([f"• {item['name'].upper()}" for item in collection['items']])
-        specs = collection['description'].split('\n')
-        
-        message_text = (
-            f"🐰<b><i>{collection['name'].upper()}</i></b>\n\n"
-            f"{PREMIUM_EMOJIS['price']} <b>ЦЕНА:</b> <b>{collection['price']}</b>\n\n"
-            f"{PREMIUM_EMOJIS['info']} <b>ХАРАКТЕРИСТИКИ</b>\n"
-            f"<blockquote>• {specs[0]}\n• {specs[1]}\n• {specs[2]}\n• {specs[3]}\n• {specs[4]}</blockquote>\n\n"
-            f"{PREMIUM_EMOJIS['flavors']} <b>ДОСТУПНЫЕ ВКУСЫ</b>\n"
-            f"<blockquote>{tastes}</blockquote>\n\n"
-            "👇 <b>Для оформления заказа пишите</b>\n\n"
-            f"• 🐇 <a href='{link_bot_start}'>МЕНЕДЖЕРУ</a>\n"
-            f"• 🌐 <a href='https://t.me/c/{str(CHANNEL_ID)[4:]}/{price_list_id}'>К НАВИГАЦИИ</a>"
-        )
+    return price_list
 
-        try:
-            image_path = f"images/{collection['id']}.jpeg"
-            if os.path.exists(image_path):
-                msg = await bot.send_photo(
-                    CHANNEL_ID,
-                    photo=FSInputFile(image_path),
-                    caption=message_text,
-                    parse_mode="HTML"
-                )
-            else:
-                msg = await bot.send_message(
-                    CHANNEL_ID, 
-                    message_text, 
-                    parse_mode="HTML"
-                )
-            
-            message_ids.append((msg.message_id, collection['name']))
-            await asyncio.sleep(1)
-        except Exception as e:
-            print(f"Error sending message for {collection['name']}: {e}")
-    
-    return message_ids
+def render_collection(collection, price_list_id):
+    """Collection post with premium formatting; links back to the price list"""
+    tastes = "\n".join([f"• {item['name'].upper()}" for item in collection['items']])
+    specs = "\n".join(f"• {spec}" for spec in collection.get('description', '').split('\n') if spec)
 
-async def send_navigation_message(section_ids, price_list_id):
-    """Enhanced navigation with all sections"""
-    nav_text = (
-        f"{PREMIUM_EMOJIS['navigation']} <b>НАВИГАЦИЯ</b>\n\n"
-        f"<blockquote>{PREMIUM_EMOJIS['price']} <a href='https://t.me/c/{str(CHANNEL_ID)[4:]}/{price_list_id}'>ПРАЙС-ЛИСТ</a>\n\n"
-        f"{PREMIUM_EMOJIS['info']} <a href='https://t.me/c/{str(CHANNEL_ID)[4:]}/{section_ids['why_us_id']}'>ПОЧЕМУ МЫ?</a>\n\n"
-        f"{PREMIUM_EMOJIS['delivery']} <a href='https://t.me/c/{str(CHANNEL_ID)[4:]}/{section_ids['delivery_id']}'>ДОСТАВКА</a>\n\n"
-        f"{PREMIUM_EMOJIS['payment']} <a href='https://t.me/c/{str(CHANNEL_ID)[4:]}/{section_ids['payment_id']}'>СПОСОБЫ ОПЛАТЫ</a></blockquote>\n\n"
-        "<b>КОЛЛЕКЦИИ:</b>\n\n"
-    )
-    
-    nav_msg = await bot.send_message(
-        CHANNEL_ID, 
-        nav_text, 
-        parse_mode="HTML",
-        reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(
-                text=f"{PREMIUM_EMOJIS['order']} ЗАКАЗАТЬ",
-                url=link_bot_start
-            )]
-        ])
+    return (
+        f"🐰<b><i>{collection['name'].upper()}</i></b>\n\n"
+        f"{PREMIUM_EMOJIS['price']} <b>ЦЕНА:</b> <b>{collection['price']}</b>\n\n"
+        f"{PREMIUM_EMOJIS['info']} <b>ХАРАКТЕРИСТИКИ</b>\n"
+        f"<blockquote>{specs}</blockquote>\n\n"
+        f"{PREMIUM_EMOJIS['flavors']} <b>ДОСТУПНЫЕ ВКУСЫ</b>\n"
+        f"<blockquote>{tastes}</blockquote>\n\n"
+        "👇 <b>Для оформления заказа пишите</b>\n\n"
+        f"• 🐇 <a href='{link_bot_start}'>МЕНЕДЖЕРУ</a>\n"
+        f"• 🌐 <a href='{post_link(price_list_id)}'>К НАВИГАЦИИ</a>"
     )
-    return nav_msg.message_id
 
-async def update_navigation(message_ids, nav_message_id):
-    """Update navigation with all collection links"""
+def render_navigation(message_ids):
+    """Navigation with links to the sections and all collections"""
     nav_text = (
         f"{PREMIUM_EMOJIS['navigation']} <b>НАВИГАЦИЯ</b>\n\n"
-        f"<blockquote>🐇<a href='https://t.me/c/{str(CHANNEL_ID)[4:]}/{message_ids['price_list_id']}'>ПРАЙС-ЛИСТ</a>\n\n"
-        f"🐇<a href='https://t.me/c/{str(CHANNEL_ID)[4:]}/{message_ids['why_us_id']}'>ПОЧЕМУ МЫ?</a>\n\n"
-        f"🐇<a href='https://t.me/c/{str(CHANNEL_ID)[4:]}/{message_ids['delivery_id']}'>ДОСТАВКА</a></blockquote>\n\n"
+        f"<blockquote>🐇<a href='{post_link(message_ids['price_list_id'])}'>ПРАЙС-ЛИСТ</a>\n\n"
+        f"🐇<a href='{post_link(message_ids['why_us_id'])}'>ПОЧЕМУ МЫ?</a>\n\n"
+        f"🐇<a href='{post_link(message_ids['delivery_id'])}'>ДОСТАВКА</a></blockquote>\n\n"
         "<b>УСТРОЙСТВА</b>\n<blockquote>\n"
     )
 
     for msg_id, name in message_ids['collections']:
-        nav_text += f"<a href='https://t.me/c/{str(CHANNEL_ID)[4:]}/{msg_id}'>{name.upper().replace('ELF BAR ', '')}</a>\n"
+        nav_text += f"<a href='{post_link(msg_id)}'>{name.upper().replace('ELF BAR ', '')}</a>\n"
 
     nav_text += "</blockquote>\n\n"
     nav_text += f"{PREMIUM_EMOJIS['manager']} Для заказа пишите <a href='{link_bot_start}'>МЕНЕДЖЕРУ</a>"
+    return nav_text
+
+def navigation_markup():
+    return types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text=f"{PREMIUM_EMOJIS['order']} ЗАКАЗАТЬ", url=link_bot_start)]
+    ])
+
+async def delete_post(key):
+    """Delete a post that is no longer in config.json"""
+    entry = manifest.get(key)
+    try:
+        await scheduler.call(lambda: bot.delete_message(CHANNEL_ID, entry['message_id']))
+    except TelegramBadRequest as e:
+        # Already deleted by hand, or too old to be deleted by a bot
+        print(f"Could not delete {key} (message {entry['message_id']}): {e}")
+    manifest.forget(key)
+    publish_counts['deleted'] += 1
+
+async def publish_post(key, text, image_path=None, reply_markup=None):
+    """Send a post the manifest does not know yet, or edit it if its text or image changed. Returns the message id."""
+    text_sha256 = content_hash(text)
+    image_sha256 = file_sha256(image_path) if image_path else None
+    entry = manifest.get(key)
+    if entry and (entry['image_sha256'] is None) != (image_sha256 is None):
+        # A text post cannot be edited into a photo post or back
+        await delete_post(key)
+        entry = None
+    if entry:
+        if entry['text_sha256'] == text_sha256 and entry['image_sha256'] == image_sha256:
+            publish_counts['unchanged'] += 1
+            return entry['message_id']
+        try:
+            message_id = entry['message_id']
+            if image_sha256 != entry['image_sha256']:
+                await scheduler.call(lambda: media_cache.edit_photo(
+                    bot, CHANNEL_ID, message_id, image_path, caption=text, parse_mode="HTML"))
+            elif image_path:
+                await scheduler.call(lambda: bot.edit_message_caption(
+                    chat_id=CHANNEL_ID, message_id=message_id, caption=text, parse_mode="HTML"))
+            else:
+                await scheduler.call(lambda: bot.edit_message_text(
+                    text, chat_id=CHANNEL_ID, message_id=message_id, parse_mode="HTML", reply_markup=reply_markup))
+        except TelegramBadRequest as e:
+            if 'not modified' in str(e):
+                pass
+            elif 'not found' in str(e):
+                print(f"Message of {key} is gone, sending it again")
+                entry = None
+            else:
+                raise
+        if entry:
+            manifest.record(key, entry['message_id'], text_sha256, image_sha256)
+            publish_counts['edited'] += 1
+            return entry['message_id']
+    # New posts are ordered: they appear in the channel in the order they were published
+    if image_path:
+        msg = await scheduler.call(lambda: media_cache.send_photo(
+            bot, CHANNEL_ID, image_path, caption=text, parse_mode="HTML"), ordered=True)
+    else:
+        msg = await scheduler.call(lambda: bot.send_message(
+            CHANNEL_ID, text, parse_mode="HTML", reply_markup=reply_markup), ordered=True)
+    manifest.record(key, msg.message_id, text_sha256, image_sha256)
+    publish_counts['sent'] += 1
+    return msg.message_id
+
+async def publish_collection(collection, price_list_id):
+    image_path = f"images/{collection['id']}.jpeg"
+    return await publish_post(
+        f"collection:{collection['id']}",
+        render_collection(collection, price_list_id),
+        image_path if os.path.exists(image_path) else None
+    )
 
-    msg = await bot.edit_message_text(
-        nav_text,
-        chat_id=CHANNEL_ID,
-        message_id=nav_message_id,
-        parse_mode="HTML",
-        reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text=f"{PREMIUM_EMOJIS['order']} ЗАКАЗАТЬ", url=link_bot_start)]
-        ])
+async def publish_catalog(price_list_id):
+    """Publish changed and new collections, delete removed ones. Returns [(message_id, name)] in catalog order."""
+    message_ids = []
+    collections = sorted_collections()
+    current = {f"collection:{collection['id']}" for collection in collections}
+    removed = [key for key in manifest.keys("collection:") if key not in current]
+    results = await asyncio.gather(
+        *(delete_post(key) for key in removed),
+        *(publish_collection(collection, price_list_id) for collection in collections),
+        return_exceptions=True
     )
-    
-    await bot.pin_chat_message(
-        chat_id=CHANNEL_ID,
-        message_id=msg.message_id,
-        disable_notification=True
+
+    for key, result in zip(removed, results):
+        if isinstance(result, Exception):
+            print(f"Error deleting {key}: {result}")
+
+    for collection, result in zip(collections, results[len(removed):]):
+        if isinstance(result, Exception):
+            print(f"Error publishing {collection['name']}: {result}")
+        else:
+            message_ids.append((result, collection['name']))
+
+    return message_ids
+
+async def publish_navigation(message_ids):
+    """Edit the pinned navigation post if any link changed; pin it whenever it was sent again"""
+    entry = manifest.get('navigation')
+    nav_message_id = await publish_post('navigation', render_navigation(message_ids), reply_markup=navigation_markup())
+    # publish_post also sends a new message when the old one was deleted or cannot be edited
+    if entry is None or entry['message_id'] != nav_message_id:
+        await scheduler.call(lambda: bot.pin_chat_message(
+            chat_id=CHANNEL_ID,
+            message_id=nav_message_id,
+            disable_notification=True
+        ))
+
+async def main(full=False):
+    """Bring the channel in line with config.json"""
+    started = time.perf_counter()
+    if full:
+        # Post everything again below the old posts
+        manifest.clear()
+    # The sections go out together; collection captions link to the price list, so they wait for its id
+    _, why_us_id, delivery_id, price_list_id = await asyncio.gather(
+        publish_post('description', render_channel_description()),
+        publish_post('why_us', render_why_us()),
+        publish_post('delivery', render_delivery_info()),
+        publish_post('price_list', render_price_list()),
     )
+    catalogs = await publish_catalog(price_list_id)
 
-async def main():
-    """Main function to execute all channel updates"""
-    await send_channel_description()
-    why_us_msg = await send_why_us()
-    delivery_msg = await send_delivery_info()
-    price_list_id = await send_price_list()
-    catalogs = await send_catalog(price_list_id)
-    
-    # Store all message IDs
-    section_ids = {
-        'why_us_id': why_us_msg.message_id,
-        'delivery_id': delivery_msg.message_id,
-        'payment_id': price_list_id,    # You might want to create a separate payment section
-        'price_list_id': price_list_id
-    }
-    
     message_ids = {
         'collections': catalogs,
         'price_list_id': price_list_id,
-        'why_us_id': why_us_msg.message_id,
-        'delivery_id': delivery_msg.message_id,
-        'payment_id': price_list_id
+        'why_us_id': why_us_id,
+        'delivery_id': delivery_id,
     }
-    
-    # Send navigation message with actual IDs
-    nav_message_id = await send_navigation_message(section_ids, price_list_id)
-    
-    # Update navigation if needed (optional)
-    await update_navigation(message_ids, nav_message_id)
-    
+    await publish_navigation(message_ids)
+
+    print(
+        f"Channel updated: {publish_counts['sent']} sent, {publish_counts['edited']} edited, "
+        f"{publish_counts['deleted']} deleted, {publish_counts['unchanged']} unchanged "
+        f"in {time.perf_counter() - started:.1f}s ({scheduler.retried} retries, "
+        f"{scheduler.throttled_seconds:.0f}s throttled by Telegram)"
+    )
     await bot.session.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Publish the catalog to the channel")
+    parser.add_argument("--full", action="store_true",
+                        help="post everything again instead of editing the posts from the last run")
+    asyncio.run(main(parser.parse_args().full))
@@ -0,0 +1,20 @@
+import os
+import sqlite3
+
+
+def open_sqlite(path: str, synchronous: str = "NORMAL", timeout: float = 5.0) -> sqlite3.Connection:
+    """
+    Open (and create) a local SQLite database in WAL mode, shared by the bot workers.
+
+    The connection is in autocommit mode, so every statement commits on its
+    own and transactions are opened explicitly (BEGIN IMMEDIATE). Use
+    synchronous="FULL" for data that must survive a power loss (orders,
+    stock, discount uses); caches can stay with NORMAL.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=timeout)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(f"PRAGMA synchronous={synchronous}")
+    return db
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import random
+import time
+
+from aiogram import BaseMiddleware
+
+from background import cancel_task
+
+
+class StartupProfile:
+    """
+    Per-phase timings of a process start.
+
+    Sequential phases (imports, config, stock...) are closed with mark();
+    warm-up tasks that run concurrently are timed individually with timed().
+    The breakdown is logged once by report() and exposed through stats().
+    """
+
+    def __init__(self, started: float = None):
+        self.started = started or time.perf_counter()
+        self._last = self.started
+        self.phases = {}
+        self.ready_seconds = 0.0
+
+    def mark(self, phase: str):
+        """
+        Close the phase that ran since the previous mark.
+        """
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    async def timed(self, phase: str, awaitable):
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.phases[phase] = time.perf_counter() - started
+
+    def ready(self):
+        self.ready_seconds = time.perf_counter() - self.started
+
+    def stats(self) -> dict:
+        return {**{f"{phase}_seconds": seconds for phase, seconds in self.phases.items()},
+                "ready_seconds": self.ready_seconds}
+
+    def report(self):
+        breakdown = ", ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in self.phases.items())
+        logging.info(f"Ready {self.ready_seconds * 1000:.0f} ms after start: {breakdown}")
+
+
+class ReadinessGate(BaseMiddleware):
+    """
+    Outer update middleware that holds updates until the required startup
+    warm-up tasks are done.
+
+    Warm-up tasks (bot username, caches) run concurrently while polling or
+    the webhook server is already accepting updates. Required tasks, which
+    handlers cannot work without, are retried until they succeed, and
+    updates arriving earlier wait for them; one held for longer than
+    `timeout` seconds is logged, not let through. Optional tasks keep running
+    after the gate opens; until one finishes (or if it fails, which is
+    logged) the component behind it uses its slower path.
+    """
+
+    def __init__(self, profile: StartupProfile, timeout: float = 10.0, max_retry_delay: float = 30.0):
+        self.profile = profile
+        self.timeout = timeout
+        self.max_retry_delay = max_retry_delay
+        # Created on the running loop by start()
+        self._ready = None
+        self._task = None
+        self._stopped = False
+        self.held = 0
+
+    @property
+    def is_ready(self) -> bool:
+        return self._ready is None or self._ready.is_set()
+
+    async def _run_required(self, name: str, factory):
+        attempt = 0
+        while True:
+            try:
+                return await factory()
+            except Exception as e:
+                delay = random.uniform(0, min(self.max_retry_delay, 2 ** attempt))
+                attempt += 1
+                logging.error(f"Required startup warm-up '{name}' failed, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+
+    async def warm_up(self, tasks: dict, required=()):
+        """
+        Run the {phase: factory} warm-up tasks concurrently and open the gate
+        once the phases named in `required` have succeeded; they are retried
+        until then. A factory returns the awaitable of its phase.
+        """
+        phases = {
+            name: asyncio.ensure_future(self.profile.timed(
+                name, self._run_required(name, factory) if name in required else factory()
+            ))
+            for name, factory in tasks.items()
+        }
+        try:
+            await asyncio.gather(*(phases[name] for name in phases if name in required))
+        except asyncio.CancelledError:
+            for phase in phases.values():
+                phase.cancel()
+            raise
+        self.profile.ready()
+        self._ready.set()
+        results = await asyncio.gather(*phases.values(), return_exceptions=True)
+        for name, result in zip(phases, results):
+            if isinstance(result, Exception):
+                logging.error(f"Startup warm-up '{name}' failed: {result}")
+        self.profile.report()
+
+    def start(self, tasks: dict, required=()):
+        self._ready = asyncio.Event()
+        self._stopped = False
+        self._task = asyncio.create_task(self.warm_up(tasks, set(required)))
+
+    async def stop(self):
+        await cancel_task(self._task)
+        self._task = None
+        if self._ready is not None and not self._ready.is_set():
+            # Updates still held are dropped rather than handled half warmed up
+            self._stopped = True
+            self._ready.set()
+
+    async def __call__(self, handler, event, data):
+        if not self.is_ready:
+            self.held += 1
+            waited = 0.0
+            while not self._ready.is_set():
+                try:
+                    await asyncio.wait_for(self._ready.wait(), self.timeout)
+                except asyncio.TimeoutError:
+                    waited += self.timeout
+                    logging.warning(f"Update held for {waited:.0f}s, startup warm-up not finished yet")
+            if self._stopped:
+                return None
+        return await handler(event, data)
@@ -0,0 +1,98 @@
+import logging
+
+
+class StockIndex:
+    """
+    Long-lived in-memory stock index, filled from the stock ledger's levels.
+
+    Quantities are kept in a dense location x item matrix. Next to it the
+    index maintains "in stock" counters per item and per collection, so that
+    availability questions from the handlers are answered with O(1) lookups
+    instead of replaying every shipment on each click.
+    """
+
+    def __init__(self, location_keys, collections):
+        self.locations = list(location_keys)
+        self._loc_pos = {key: pos for pos, key in enumerate(self.locations)}
+        self._item_pos = {}
+        self._item_collection = []
+        self._qty = [[] for _ in self.locations]
+        # Number of locations where the item has a positive quantity
+        self._item_locations = []
+        # Number of items of the collection in stock anywhere / per location
+        self._collection_any = {}
+        self._collection_at = {}
+        # Bumped every time an availability flag flips
+        self.version = 0
+        for collection in collections:
+            self._collection_any[collection['id']] = 0
+            self._collection_at[collection['id']] = [0] * len(self.locations)
+            for item in collection.get('items', []):
+                self._add_item(str(item['id']), collection['id'])
+
+    def _add_item(self, item_id, collection_id=None):
+        pos = self._item_pos.get(item_id)
+        if pos is not None:
+            return pos
+        pos = len(self._item_collection)
+        self._item_pos[item_id] = pos
+        self._item_collection.append(collection_id)
+        self._item_locations.append(0)
+        for row in self._qty:
+            row.append(0)
+        return pos
+
+    def _set(self, row, col, qty):
+        old = self._qty[row][col]
+        self._qty[row][col] = qty
+        if (old > 0) == (qty > 0):
+            return
+        step = 1 if qty > 0 else -1
+        before = self._item_locations[col]
+        self._item_locations[col] = before + step
+        collection_id = self._item_collection[col]
+        if collection_id is not None:
+            self._collection_at[collection_id][row] += step
+            if before == 0 or self._item_locations[col] == 0:
+                self._collection_any[collection_id] += step
+        self.version += 1
+
+    def adjust(self, location, item_id, delta):
+        """
+        Change the quantity of an item at a location and return the new quantity.
+        """
+        row = self._loc_pos.get(location)
+        if row is None:
+            logging.warning(f"Stock change for unknown location {location} ignored.")
+            return 0
+        col = self._add_item(str(item_id))
+        qty = self._qty[row][col] + delta
+        self._set(row, col, qty)
+        return qty
+
+    def quantity(self, location, item_id):
+        row = self._loc_pos.get(location)
+        col = self._item_pos.get(str(item_id))
+        if row is None or col is None:
+            return 0
+        return self._qty[row][col]
+
+    def item_available(self, item_id, location=None):
+        """
+        True if the item is in stock at the location, or anywhere when no location is given.
+        """
+        if location is not None:
+            return self.quantity(location, item_id) > 0
+        col = self._item_pos.get(str(item_id))
+        return col is not None and self._item_locations[col] > 0
+
+    def collection_available(self, collection_id, location=None):
+        """
+        True if at least one item of the collection is in stock at the location,
+        or anywhere when no location is given.
+        """
+        if location is not None:
+            row = self._loc_pos.get(location)
+            counts = self._collection_at.get(collection_id)
+            return row is not None and counts is not None and counts[row] > 0
+        return self._collection_any.get(collection_id, 0) > 0
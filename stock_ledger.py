@@ -0,0 +1,279 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import defaultdict
+
+from background import cancel_task
+from sqlite_db import open_sqlite
+from stock_index import StockIndex
+
+
+def _shipment_contents(postavka) -> dict:
+    """
+    Group 'postavka' entries by date into {date: {location: {item_id: qty}}}.
+    """
+    contents = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+    for position, entry in enumerate(postavka):
+        key = str(entry.get('date') or f"#{position}")
+        for loc, delivery in entry.get('deliveries', {}).items():
+            for item_id, qty in delivery.get('items', {}).items():
+                contents[key][loc][str(item_id)] += int(qty)
+    return {key: {loc: dict(items) for loc, items in locs.items()} for key, locs in contents.items()}
+
+
+class StockLedger:
+    """
+    Live stock levels shared by all bot processes on the host.
+
+    SQLite (WAL) keeps the current level of every item per location (the
+    snapshot loaded on startup) and an append-only log of every movement:
+    shipments, reservations for orders and releases of failed orders. A
+    reservation decrements the level in one transaction guarded by
+    `qty > 0`, so two orders can never both take the last unit, even from
+    different worker processes. The in-memory StockIndex used for the
+    availability markers follows the movement log.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = open_sqlite(path, synchronous="FULL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS stock_levels ("
+            " location TEXT NOT NULL,"
+            " item_id TEXT NOT NULL,"
+            " qty INTEGER NOT NULL,"
+            " PRIMARY KEY (location, item_id))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS stock_movements ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " ts REAL NOT NULL,"
+            " location TEXT NOT NULL,"
+            " item_id TEXT NOT NULL,"
+            " delta INTEGER NOT NULL,"
+            " reason TEXT NOT NULL,"
+            " ref TEXT)"
+        )
+        # Shipments already booked, so that config.json can be re-read safely
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS stock_shipments ("
+            " key TEXT PRIMARY KEY,"
+            " contents TEXT NOT NULL)"
+        )
+        # sha256 of the config.json whose shipments are fully booked
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS stock_meta ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL)"
+        )
+        self.index = None
+        self._last_seq = 0
+        self._task = None
+        self.reserved = 0
+        self.released = 0
+        self.sold_out = 0
+
+    def open(self, config, digest: str = None) -> StockIndex:
+        """
+        Book new or changed shipments from config, then build the in-memory
+        index from the stored levels and start following the movement log.
+        Returns the index.
+        """
+        return self.install(*self.build(config, digest))
+
+    def build(self, config, digest: str = None):
+        """
+        Book new or changed shipments from config and build an index from the
+        stored levels. Returns (index, last movement seq) for install(). With
+        the `digest` of the config file, booking is skipped when that exact
+        file was booked before.
+
+        Runs on a connection of its own, so a config reload can do this in a
+        worker thread (booking may wait for other workers' transactions)
+        while the event loop keeps reserving stock.
+        """
+        db = open_sqlite(self.path, synchronous="FULL")
+        try:
+            row = db.execute("SELECT value FROM stock_meta WHERE key = 'config_digest'").fetchone()
+            if digest is None or row is None or row[0] != digest:
+                self._book(db, config.get('postavka', []))
+                if digest is None:
+                    db.execute("DELETE FROM stock_meta WHERE key = 'config_digest'")
+                else:
+                    db.execute(
+                        "INSERT INTO stock_meta (key, value) VALUES ('config_digest', ?)"
+                        " ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                        (digest,)
+                    )
+            db.execute("BEGIN")
+            try:
+                levels = db.execute("SELECT location, item_id, qty FROM stock_levels").fetchall()
+                last_seq = db.execute("SELECT COALESCE(MAX(seq), 0) FROM stock_movements").fetchone()[0]
+            finally:
+                db.execute("COMMIT")
+        finally:
+            db.close()
+        catalog = config.get('catalog', {})
+        collections = catalog.get('hqd_collections', []) + catalog.get('liquid_collections', [])
+        index = StockIndex(config['locations'].keys(), collections)
+        for location, item_id, qty in levels:
+            if qty:
+                index.adjust(location, item_id, qty)
+        return index, last_seq
+
+    def install(self, index: StockIndex, last_seq: int) -> StockIndex:
+        """
+        Switch to an index from build() and apply the movements written since it was built.
+        """
+        self.index = index
+        self._last_seq = last_seq
+        self.sync()
+        return index
+
+    @staticmethod
+    def _move(db, location: str, item_id: str, delta: int, reason: str, ref: str = None):
+        db.execute(
+            "INSERT INTO stock_levels (location, item_id, qty) VALUES (?, ?, ?)"
+            " ON CONFLICT(location, item_id) DO UPDATE SET qty = qty + excluded.qty",
+            (location, item_id, delta)
+        )
+        db.execute(
+            "INSERT INTO stock_movements (ts, location, item_id, delta, reason, ref) VALUES (?, ?, ?, ?, ?, ?)",
+            (time.time(), location, item_id, delta, reason, ref)
+        )
+
+    def book_shipments(self, postavka) -> int:
+        """
+        Record shipments that are not in the ledger yet. A shipment whose
+        quantities were edited in config is booked as a correction of the
+        difference. Returns the number of movements written.
+        """
+        written = self._book(self._db, postavka)
+        if written and self.index is not None:
+            self.sync()
+        return written
+
+    def _book(self, db, postavka) -> int:
+        written = 0
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            booked = {
+                key: json.loads(contents)
+                for key, contents in db.execute("SELECT key, contents FROM stock_shipments")
+            }
+            for key, contents in _shipment_contents(postavka).items():
+                previous = booked.get(key, {})
+                if contents == previous:
+                    continue
+                reason = "shipment" if key not in booked else "shipment correction"
+                for loc in set(contents) | set(previous):
+                    items = contents.get(loc, {})
+                    old_items = previous.get(loc, {})
+                    for item_id in set(items) | set(old_items):
+                        delta = items.get(item_id, 0) - old_items.get(item_id, 0)
+                        if delta:
+                            self._move(db, loc, item_id, delta, reason, key)
+                            written += 1
+                db.execute(
+                    "INSERT INTO stock_shipments (key, contents) VALUES (?, ?)"
+                    " ON CONFLICT(key) DO UPDATE SET contents = excluded.contents",
+                    (key, json.dumps(contents, sort_keys=True))
+                )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        if written:
+            logging.info(f"Booked {written} stock movements from shipments.")
+        return written
+
+    def sync(self) -> int:
+        """
+        Apply movements written since the last sync (by any process) to the index.
+        """
+        rows = self._db.execute(
+            "SELECT seq, location, item_id, delta FROM stock_movements WHERE seq > ? ORDER BY seq",
+            (self._last_seq,)
+        ).fetchall()
+        for seq, location, item_id, delta in rows:
+            self.index.adjust(location, item_id, delta)
+            self._last_seq = seq
+        return len(rows)
+
+    def reserve(self, item_id, location: str = None, ref: str = None):
+        """
+        Take one unit of an item for an order. Without a location (delivery)
+        the unit comes from the store holding the most of it. Returns the
+        location the unit was taken from, or None if it is sold out.
+        """
+        item_id = str(item_id)
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            if location is None:
+                row = self._db.execute(
+                    "SELECT location FROM stock_levels WHERE item_id = ? AND qty > 0 ORDER BY qty DESC LIMIT 1",
+                    (item_id,)
+                ).fetchone()
+                location = row[0] if row else None
+            taken = location is not None and self._db.execute(
+                "UPDATE stock_levels SET qty = qty - 1 WHERE location = ? AND item_id = ? AND qty > 0",
+                (location, item_id)
+            ).rowcount == 1
+            if taken:
+                self._db.execute(
+                    "INSERT INTO stock_movements (ts, location, item_id, delta, reason, ref) VALUES (?, ?, ?, -1, ?, ?)",
+                    (time.time(), location, item_id, "order", ref)
+                )
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self.sync()
+        if not taken:
+            self.sold_out += 1
+            return None
+        self.reserved += 1
+        return location
+
+    def release(self, location: str, item_id, ref: str = None):
+        """
+        Return a reserved unit, e.g. when the order could not be saved.
+        """
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._move(self._db, location, str(item_id), 1, "release", ref)
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self.sync()
+        self.released += 1
+
+    def stats(self) -> dict:
+        return {
+            "reserved": self.reserved,
+            "released": self.released,
+            "sold_out": self.sold_out,
+            "last_seq": self._last_seq,
+        }
+
+    async def run(self, interval: float = 2.0):
+        """
+        Follow movements written by other worker processes until cancelled.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.sync()
+            except sqlite3.Error as e:
+                logging.error(f"Failed to sync stock ledger: {e}")
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        await cancel_task(self._task)
+        self._task = None
+        self._db.close()
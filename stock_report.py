@@ -0,0 +1,257 @@
+import html
+import logging
+import threading
+import time
+
+from catalog_index import PRODUCT_TYPES, current_catalog
+from sqlite_db import open_sqlite
+
+# Columns read from the stock_movements table of the ledger
+COLUMNS = ("seq", "ts", "location", "item_id", "delta", "reason")
+# Telegram rejects longer messages
+MAX_MESSAGE_LENGTH = 4096
+# Collection of items that are no longer in the catalog
+OTHER = "—"
+DAY = 86400
+
+
+class StockReport:
+    """
+    Stock and sales reports for the manager bot, computed from the stock ledger.
+
+    The movement log (shipments from 'postavka', order reservations and
+    releases) is kept as a pandas DataFrame that only reads the movements
+    written since the last report, and every report is a handful of vectorized
+    group-bys over it. Rendered reports are cached until new movements arrive
+    or the catalog or locations are replaced by a config reload; sales reports
+    also expire every hour, as their window moves.
+
+    Reports are built on their own connection to the ledger file, so they can
+    run in a worker thread (asyncio.to_thread) without blocking the event
+    loop; one report is built at a time.
+    """
+
+    def __init__(self, ledger, locations_fn, catalog_fn=current_catalog):
+        self.ledger = ledger
+        # Current config['locations'], which a config reload replaces
+        self.locations_fn = locations_fn
+        self.catalog_fn = catalog_fn
+        self._db = None
+        self._lock = threading.Lock()
+        self._movements = None
+        self._last_seq = 0
+        self._version = None
+        self._catalog = None
+        # Item id -> collection id, and collection id -> name in catalog order
+        self._item_collections = {}
+        self._collection_names = {}
+        self._texts = {}
+        self.hits = 0
+        self.misses = 0
+        self.last_seconds = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "movements": 0 if self._movements is None else len(self._movements),
+            "cached": len(self._texts),
+            "hits": self.hits,
+            "misses": self.misses,
+            "last_seconds": self.last_seconds,
+        }
+
+    def _movements_after(self, seq: int) -> list:
+        if self._db is None:
+            self._db = open_sqlite(self.ledger.path)
+        return self._db.execute(
+            "SELECT seq, ts, location, item_id, delta, reason FROM stock_movements WHERE seq > ? ORDER BY seq",
+            (seq,)
+        ).fetchall()
+
+    def load(self):
+        """
+        Import pandas and read the movement log, so the first report is fast.
+        """
+        with self._lock:
+            self._refresh()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _refresh(self):
+        """
+        Append movements written since the last report (by any process) and
+        drop the cached reports if anything they depend on changed.
+        """
+        import numpy as np
+        import pandas as pd
+
+        catalog = self.catalog_fn()
+        if catalog is not None and catalog is not self._catalog:
+            self._item_collections, self._collection_names = self._collection_map(catalog)
+            self._catalog = catalog
+            if self._movements is not None:
+                self._movements["collection"] = self._collections_of(self._movements["item_id"])
+        rows = self._movements_after(self._last_seq)
+        if rows:
+            new = pd.DataFrame.from_records(rows, columns=COLUMNS)
+            reason = new["reason"]
+            # Units that arrived (shipments and their corrections) and units that left with orders
+            new["received"] = np.where(reason.str.startswith("shipment"), new["delta"], 0)
+            new["sold"] = np.where(reason.isin(("order", "release")), -new["delta"], 0)
+            new["collection"] = self._collections_of(new["item_id"])
+            if self._movements is None:
+                self._movements = new
+            else:
+                self._movements = pd.concat([self._movements, new], ignore_index=True)
+            self._last_seq = int(rows[-1][0])
+        locations = self.locations_fn()
+        version = (self._last_seq, id(catalog), id(locations))
+        if version != self._version:
+            self._version = version
+            self._texts = {}
+
+    @staticmethod
+    def _collection_map(catalog):
+        """
+        Item id -> collection id, and collection ids with their names in catalog order.
+        """
+        items = {}
+        names = {}
+        for product_type in PRODUCT_TYPES:
+            for collection in catalog.collections_for(product_type):
+                names[collection["id"]] = collection["name"]
+                for item in collection.get("items", ()):
+                    items[str(item["id"])] = collection["id"]
+        return items, names
+
+    def _collections_of(self, item_ids):
+        return item_ids.map(self._item_collections).fillna(OTHER)
+
+    def _frame(self):
+        """
+        The movement log, or None while it is empty.
+        """
+        if self._movements is None or self._movements.empty:
+            return None
+        return self._movements
+
+    def _collection_order(self, index) -> list:
+        names = self._collection_names
+        return [cid for cid in names if cid in index] + [cid for cid in index if cid not in names]
+
+    def _collection_name(self, collection_id) -> str:
+        return self._collection_names.get(collection_id, collection_id)
+
+    def _cached(self, key, render) -> str:
+        with self._lock:
+            self._refresh()
+            text = self._texts.get(key)
+            if text is not None:
+                self.hits += 1
+                return text
+            self.misses += 1
+            started = time.perf_counter()
+            text = render()
+            self.last_seconds = time.perf_counter() - started
+            logging.debug(f"Rendered {key[0]} report in {self.last_seconds * 1000:.1f} ms")
+            self._texts[key] = text
+            return text
+
+    def find_location(self, query: str):
+        """
+        Location key matching a key or a name (case-insensitive), or None.
+        """
+        query = query.strip().lower()
+        for key, location in self.locations_fn().items():
+            if query in (key.lower(), location.get("name", "").lower()):
+                return key
+        return None
+
+    def stock(self, location: str = None) -> str:
+        """
+        Units in stock per location and collection, for one location or all of them.
+        """
+        return self._cached(("stock", location), lambda: self._render_stock(location))
+
+    def sales(self, days: int = 30) -> str:
+        """
+        Received and sold units, sell-through and days of cover per collection,
+        with the sales rate taken over the last `days` days.
+        """
+        now = time.time()
+        return self._cached(("sales", days, int(now // 3600)), lambda: self._render_sales(days, now))
+
+    def _render_stock(self, location: str = None) -> str:
+        locations = self.locations_fn()
+        df = self._frame()
+        if df is not None and location is not None:
+            df = df[df["location"] == location]
+        if df is None or df.empty:
+            return "Нет данных об остатках."
+        levels = df.groupby(["location", "collection"], sort=False)["delta"].sum()
+        levels = levels[levels != 0]
+        totals = levels.groupby(level="location", sort=False).sum()
+        lines = []
+        for loc in [key for key in locations if key in totals.index] + [key for key in totals.index if key not in locations]:
+            name = locations.get(loc, {}).get("name", loc)
+            lines.append(f"📍 {name}: {int(totals[loc])} шт.")
+            by_collection = levels.loc[loc]
+            for collection_id in self._collection_order(by_collection.index):
+                lines.append(f"  {self._collection_name(collection_id)[:24]:<24} {int(by_collection[collection_id]):>5}")
+            lines.append("")
+        return render_pre("📦 Остатки", lines)
+
+    def _render_sales(self, days: int, now: float) -> str:
+        import numpy as np
+
+        df = self._frame()
+        if df is None:
+            return "Нет данных о продажах."
+        since = now - days * DAY
+        grouped = df.groupby("collection", sort=False)
+        table = grouped[["received", "sold", "delta"]].sum()
+        table["recent"] = df.loc[df["ts"] >= since].groupby("collection", sort=False)["sold"].sum()
+        table = table.fillna(0)
+        # A ledger younger than the window has sold over fewer days
+        span = np.clip((now - df["ts"].min()) / DAY, 1.0, days)
+        rate = table["recent"].to_numpy() / span
+        stock = table["delta"].clip(lower=0).to_numpy()
+        received = table["received"].to_numpy()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            table["sell_through"] = np.where(received > 0, table["sold"].to_numpy() / received * 100, np.nan)
+            table["cover"] = np.where(rate > 0, stock / rate, np.inf)
+        table = table.loc[self._collection_order(table.index)]
+        lines = [f"{'Коллекция':<18} {'Пост':>5} {'Прод':>5} {'%':>4} {f'{days}д':>4} {'Дней':>5}"]
+        for collection_id, row in table.iterrows():
+            sell_through = "—" if np.isnan(row["sell_through"]) else f"{row['sell_through']:.0f}"
+            if np.isinf(row["cover"]):
+                cover = "∞" if row["delta"] > 0 else "—"
+            else:
+                cover = f"{row['cover']:.0f}"
+            lines.append(
+                f"{self._collection_name(collection_id)[:18]:<18} {int(row['received']):>5} {int(row['sold']):>5} "
+                f"{sell_through:>4} {int(row['recent']):>4} {cover:>5}"
+            )
+        lines += ["", f"Дней — на сколько хватит остатка при темпе продаж за {days} дн."]
+        return render_pre(f"📈 Продажи за {days} дн.", lines)
+
+
+def render_pre(title: str, lines: list) -> str:
+    """
+    HTML message with a bold title and a monospaced table, cut to fit into one message.
+    """
+    head = f"<b>{html.escape(title)}</b>\n<pre>"
+    tail = "</pre>"
+    body = []
+    length = len(head) + len(tail)
+    for line in lines:
+        line = html.escape(line) + "\n"
+        if length + len(line) > MAX_MESSAGE_LENGTH - 2:
+            body.append("…")
+            break
+        body.append(line)
+        length += len(line)
+    return head + "".join(body).rstrip("\n") + tail
@@ -0,0 +1,248 @@
+import argparse
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+from order_ids import MAX_SHARDS
+from webhook import add_server_arguments, check_server_arguments
+
+# Update types whose payload carries the Telegram user in "from"
+USER_KEYS = ("message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+             "shipping_query", "pre_checkout_query", "poll_answer", "my_chat_member", "chat_member",
+             "chat_join_request")
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping Telegram user ids to worker ids.
+
+    Uses a stable hash (not Python's salted hash) with virtual nodes, so the
+    same user always lands on the same worker across restarts.
+    """
+
+    def __init__(self, nodes, replicas: int = 256):
+        self._ring = []
+        for node in nodes:
+            for replica in range(replicas):
+                self._ring.append((self._hash(f"{node}:{replica}"), node))
+        self._ring.sort()
+        self._keys = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def node_for(self, key) -> int:
+        pos = bisect.bisect(self._keys, self._hash(str(key))) % len(self._ring)
+        return self._ring[pos][1]
+
+
+def routing_key(data: dict):
+    """
+    Return the id of the user who caused the update, falling back to the chat or update id.
+    """
+    for name in USER_KEYS:
+        payload = data.get(name)
+        if not payload:
+            continue
+        user = payload.get("from") or payload.get("user")
+        if user:
+            return user["id"]
+        chat = payload.get("chat")
+        if chat:
+            return chat["id"]
+    return data.get("update_id", 0)
+
+
+def worker_main(worker_id: int, worker_count: int, queue, max_concurrency: int):
+    """
+    Entry point of a worker process: runs the bot handlers for its share of users.
+    """
+    os.environ["BOT_WORKER_ID"] = str(worker_id)
+    os.environ["BOT_WORKER_COUNT"] = str(worker_count)
+    # Shutdown is driven by the supervisor through the queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import main
+    from webhook import feed_dispatcher
+
+    async def run():
+        processors = {
+            "main": feed_dispatcher(main.main_dp, main.main_bot),
+            "manager": feed_dispatcher(main.manager_dp, main.manager_bot),
+        }
+        semaphore = asyncio.Semaphore(max_concurrency)
+        tasks = set()
+        loop = asyncio.get_running_loop()
+
+        async def process(name, data):
+            try:
+                await processors[name](data)
+            except Exception as e:
+                logging.exception(f"Worker {worker_id} failed to process update {data.get('update_id')}: {e}")
+            finally:
+                semaphore.release()
+
+        await main.on_startup()
+        metrics_runner = await main.start_metrics()
+        logging.info(f"Worker {worker_id} started (pid {os.getpid()})")
+        try:
+            while True:
+                item = await loop.run_in_executor(None, queue.get)
+                if item is None:
+                    break
+                await semaphore.acquire()
+                task = asyncio.create_task(process(*item))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(set(tasks))
+        finally:
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+            await main.on_shutdown()
+            await main.main_bot.session.close()
+            await main.manager_bot.session.close()
+            logging.info(f"Worker {worker_id} drained and stopped")
+
+    asyncio.run(run())
+
+
+class Supervisor:
+    """
+    Starts N worker processes and routes every update to one of them by
+    consistent hashing on the user id, so a user's FSM state stays with one
+    worker. Crashed workers are restarted; on shutdown workers finish their
+    queued updates before exiting.
+    """
+
+    def __init__(self, worker_count: int, max_concurrency: int = 100, drain_timeout: float = 30.0):
+        self.worker_count = worker_count
+        self.max_concurrency = max_concurrency
+        self.drain_timeout = drain_timeout
+        self.ring = HashRing(range(worker_count))
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue() for _ in range(worker_count)]
+        self._processes = [None] * worker_count
+        self._stopping = False
+
+    def _spawn(self, worker_id: int):
+        process = self._context.Process(
+            target=worker_main,
+            args=(worker_id, self.worker_count, self._queues[worker_id], self.max_concurrency),
+            name=f"bot-worker-{worker_id}",
+            daemon=False
+        )
+        process.start()
+        self._processes[worker_id] = process
+
+    def start(self):
+        for worker_id in range(self.worker_count):
+            self._spawn(worker_id)
+
+    def dispatch(self, bot_name: str, data: dict):
+        worker_id = self.ring.node_for(routing_key(data))
+        self._queues[worker_id].put((bot_name, data))
+
+    async def monitor(self, interval: float = 1.0):
+        """
+        Restart workers that exited unexpectedly.
+        """
+        while not self._stopping:
+            for worker_id, process in enumerate(self._processes):
+                if process is not None and not process.is_alive() and not self._stopping:
+                    logging.error(f"Worker {worker_id} exited with code {process.exitcode}, restarting")
+                    self._spawn(worker_id)
+            await asyncio.sleep(interval)
+
+    async def stop(self):
+        self._stopping = True
+        for queue in self._queues:
+            queue.put(None)
+        deadline = time.monotonic() + self.drain_timeout
+        for worker_id, process in enumerate(self._processes):
+            await asyncio.to_thread(process.join, max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.error(f"Worker {worker_id} did not drain in time, terminating")
+                process.terminate()
+                process.join()
+
+
+async def poll_updates(bot, name: str, supervisor: Supervisor):
+    """
+    Long-poll one bot and hand raw updates to the supervisor.
+    """
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Polling {name} bot failed: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            supervisor.dispatch(name, update.model_dump(mode="json", by_alias=True, exclude_none=True))
+
+
+async def run(args):
+    from aiogram import Bot
+    from webhook import WebhookServer
+
+    with open('config.json', 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    bots = {"main": Bot(token=config['api_key']), "manager": Bot(token=config['manager_bot_token'])}
+
+    supervisor = Supervisor(args.workers, args.max_concurrency)
+    supervisor.start()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    if args.mode == "webhook":
+        server = WebhookServer(args.max_concurrency)
+        for name, bot in bots.items():
+            async def forward(data, name=name):
+                supervisor.dispatch(name, data)
+            server.add_bot(f"/webhook/{name}", args.secret, forward)
+            if args.webhook_url:
+                await bot.set_webhook(f"{args.webhook_url.rstrip('/')}/webhook/{name}", secret_token=args.secret or None)
+        intake = [asyncio.create_task(server.serve(args.host, args.port))]
+    else:
+        intake = [asyncio.create_task(poll_updates(bot, name, supervisor)) for name, bot in bots.items()]
+    monitor = asyncio.create_task(supervisor.monitor())
+
+    await stop.wait()
+    logging.info("Shutting down: stopping intake and draining workers")
+    for task in intake + [monitor]:
+        task.cancel()
+    await asyncio.gather(*intake, monitor, return_exceptions=True)
+    await supervisor.stop()
+    for bot in bots.values():
+        await bot.session.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(processName)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description="Run the bots in N worker processes sharded by user id")
+    # Every worker issues order ids from its own shard, so there are at most MAX_SHARDS of them
+    parser.add_argument("--workers", type=int, default=min(os.cpu_count() or 2, MAX_SHARDS),
+                        help=f"number of worker processes, 1-{MAX_SHARDS}")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    if not 1 <= args.workers <= MAX_SHARDS:
+        parser.error(f"--workers must be between 1 and {MAX_SHARDS}")
+    check_server_arguments(parser, args)
+    asyncio.run(run(args))
@@ -0,0 +1,125 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from aiogram.utils.deep_linking import create_start_link
+
+
+class UserCache:
+    """
+    Read-through cache for Users records in front of the Airtable gateway.
+
+    Records are kept by Telegram user id and by referral code with a TTL and
+    LRU eviction. Inserts and updates go through the cache and replace the
+    cached record (write-through). Concurrent lookups for the same key share
+    one request to Airtable.
+    """
+
+    def __init__(self, gateway, maxsize: int = 2048, ttl: float = 300.0, link_maxsize: int = 2048):
+        self.gateway = gateway
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.link_maxsize = link_maxsize
+        self._entries = {"user": OrderedDict(), "code": OrderedDict()}
+        self._links = OrderedDict()
+        self._inflight = {}
+        # Bumped on every write so that lookups started before it are not cached
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "users": len(self._entries["user"]),
+            "codes": len(self._entries["code"]),
+            "links": len(self._links),
+        }
+
+    def _put(self, kind: str, key: str, record):
+        entries = self._entries[kind]
+        entries[key] = (time.monotonic() + self.ttl, record)
+        entries.move_to_end(key)
+        while len(entries) > self.maxsize:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def _store(self, record):
+        fields = record.get("fields", {})
+        if fields.get("User ID"):
+            self._put("user", str(fields["User ID"]), record)
+        if fields.get("Referral Code"):
+            self._put("code", fields["Referral Code"], record)
+
+    async def _lookup(self, kind: str, key: str, loader):
+        entry = self._entries[kind].get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries[kind].move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        task = self._inflight.get((kind, key))
+        if task is None:
+            task = asyncio.ensure_future(self._load(kind, key, loader))
+            self._inflight[(kind, key)] = task
+            task.add_done_callback(lambda _: self._inflight.pop((kind, key), None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def _load(self, kind: str, key: str, loader):
+        generation = self._generation
+        record = await loader(key)
+        if generation == self._generation:
+            if record is None:
+                # Negative entries keep repeated /start checks off Airtable too
+                self._put(kind, key, None)
+            else:
+                self._store(record)
+        return record
+
+    async def get_user(self, user_id):
+        """
+        Return the Users record for a Telegram user id, or None.
+        """
+        return await self._lookup("user", str(user_id), self.gateway.find_user)
+
+    async def get_user_by_referral_code(self, referral_code: str):
+        return await self._lookup("code", referral_code, self.gateway.find_user_by_referral_code)
+
+    async def insert_user(self, fields: dict) -> dict:
+        self._generation += 1
+        record = await self.gateway.insert_user(fields)
+        self._store(record)
+        return record
+
+    async def update_user(self, record_id: str, fields: dict) -> dict:
+        self._generation += 1
+        record = await self.gateway.update_user(record_id, fields)
+        self._store(record)
+        return record
+
+    async def start_link(self, bot, payload: str) -> str:
+        """
+        Cached create_start_link: the deep link only depends on the bot and the payload.
+        """
+        key = (bot.id, payload)
+        link = self._links.get(key)
+        if link is not None:
+            self._links.move_to_end(key)
+            self.hits += 1
+            return link
+        self.misses += 1
+        link = await create_start_link(bot=bot, payload=payload, encode=True)
+        self._links[key] = link
+        while len(self._links) > self.link_maxsize:
+            self._links.popitem(last=False)
+            self.evictions += 1
+        return link
@@ -0,0 +1,293 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+import uuid
+from datetime import datetime, timezone
+
+from airtable_gateway import AirtableError
+from background import cancel_task
+from sqlite_db import open_sqlite
+
+# Indexed columns a record can be looked up by
+LOOKUP_COLUMNS = ("user_id", "referral_code", "referrer_code")
+
+
+def airtable_time(ts: float) -> str:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+class UserMirror:
+    """
+    Local SQLite copy of the Airtable Users table, shared by all worker processes.
+
+    A full load copies the whole table: on the first start and then every
+    `full_interval` seconds, which also drops deleted users. In between, every
+    `interval` seconds only the records created or modified since the last
+    sync cursor are fetched. Only the process holding the sync lease talks to
+    Airtable; the others read the same file.
+
+    Reads are served from the mirror while its last sync is at most
+    `max_staleness` seconds old. A cold or stale mirror sends them to
+    Airtable, and falls back to its own data only if Airtable fails. Writes go
+    to Airtable and are copied into the mirror at once. The methods match the
+    Users operations of AirtableGateway, so the mirror can stand in for it.
+    """
+
+    def __init__(self, path: str, gateway, interval: float = 30.0, full_interval: float = 3600.0,
+                 max_staleness: float = 120.0, overlap: float = 120.0):
+        self.gateway = gateway
+        self.interval = interval
+        self.full_interval = full_interval
+        self.max_staleness = max_staleness
+        # Delta syncs look back this far before the previous sync, for clock skew with Airtable
+        self.overlap = overlap
+        self.lease_seconds = max(5 * interval, 60.0)
+        self._owner = uuid.uuid4().hex
+        self._db = open_sqlite(path)
+        # written_at: when this copy of the record was stored, by a sync or a local write
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " record_id TEXT PRIMARY KEY,"
+            " user_id TEXT,"
+            " referral_code TEXT,"
+            " referrer_code TEXT,"
+            " record TEXT NOT NULL,"
+            " written_at REAL NOT NULL)"
+        )
+        for column in LOOKUP_COLUMNS:
+            self._db.execute(f"CREATE INDEX IF NOT EXISTS users_{column} ON users ({column})")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS mirror_meta ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL)"
+        )
+        self._task = None
+        self._stale_warned = False
+        self.local_reads = 0
+        self.remote_reads = 0
+        self.stale_reads = 0
+        self.syncs = 0
+        self.full_syncs = 0
+        self.failures = 0
+        self.last_sync_records = 0
+        self.last_sync_seconds = 0.0
+
+    def _meta(self, key: str, default=None):
+        row = self._db.execute("SELECT value FROM mirror_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key: str, value):
+        self._db.execute(
+            "INSERT INTO mirror_meta (key, value) VALUES (?, ?)"
+            " ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, str(value))
+        )
+
+    def staleness(self):
+        """
+        Seconds since the last successful sync by any process, or None if never synced.
+        """
+        synced_at = self._meta("synced_at")
+        return time.time() - float(synced_at) if synced_at is not None else None
+
+    def is_fresh(self) -> bool:
+        staleness = self.staleness()
+        fresh = staleness is not None and staleness <= self.max_staleness
+        if not fresh and staleness is not None and not self._stale_warned:
+            logging.warning(f"User mirror is {staleness:.0f}s old, reading users from Airtable")
+        self._stale_warned = staleness is not None and not fresh
+        return fresh
+
+    def stats(self) -> dict:
+        staleness = self.staleness()
+        return {
+            "users": self._db.execute("SELECT COUNT(*) FROM users").fetchone()[0],
+            "staleness": staleness if staleness is not None else -1.0,
+            "fresh": int(staleness is not None and staleness <= self.max_staleness),
+            "local_reads": self.local_reads,
+            "remote_reads": self.remote_reads,
+            "stale_reads": self.stale_reads,
+            "syncs": self.syncs,
+            "full_syncs": self.full_syncs,
+            "failures": self.failures,
+            "last_sync_records": self.last_sync_records,
+            "last_sync_seconds": self.last_sync_seconds,
+        }
+
+    def _store(self, records, since: float = None):
+        """
+        Upsert records. With `since`, rows written locally after that time are
+        newer than the fetched copy and are kept.
+        """
+        now = time.time()
+        rows = []
+        for record in records:
+            fields = record.get("fields", {})
+            rows.append((
+                record["id"],
+                str(fields["User ID"]) if fields.get("User ID") else None,
+                fields.get("Referral Code") or None,
+                fields.get("Referrer Code") or None,
+                json.dumps(record, ensure_ascii=False),
+                now,
+            ))
+        guard = " WHERE users.written_at < ?" if since is not None else ""
+        self._db.executemany(
+            "INSERT INTO users (record_id, user_id, referral_code, referrer_code, record, written_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT(record_id) DO UPDATE SET user_id = excluded.user_id,"
+            " referral_code = excluded.referral_code, referrer_code = excluded.referrer_code,"
+            " record = excluded.record, written_at = excluded.written_at" + guard,
+            [row + (since,) for row in rows] if since is not None else rows
+        )
+
+    def _acquire_lease(self) -> bool:
+        """
+        Become (or stay) the process that syncs with Airtable.
+        """
+        now = time.time()
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            owner = self._meta("lease_owner")
+            until = float(self._meta("lease_until", 0))
+            acquired = owner == self._owner or until < now
+            if acquired:
+                self._set_meta("lease_owner", self._owner)
+                self._set_meta("lease_until", now + self.lease_seconds)
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return acquired
+
+    async def sync(self, full: bool = None) -> int:
+        """
+        Pull changes from Airtable: everything on a full load, otherwise the
+        records modified since the cursor. Returns the number of records stored.
+        """
+        started = time.time()
+        if full is None:
+            full_synced_at = self._meta("full_synced_at")
+            full = full_synced_at is None or started - float(full_synced_at) >= self.full_interval
+        if full:
+            records = await self.gateway.all_users()
+        else:
+            cursor = float(self._meta("cursor"))
+            records = await self.gateway.users_modified_since(airtable_time(cursor))
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._store(records, since=started)
+            if full:
+                # Rows neither fetched now nor written locally meanwhile were deleted in Airtable
+                self._db.execute("DELETE FROM users WHERE written_at < ?", (started,))
+                self._set_meta("full_synced_at", started)
+            self._set_meta("cursor", started - self.overlap)
+            self._set_meta("synced_at", started)
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self.syncs += 1
+        self.full_syncs += int(full)
+        self.last_sync_records = len(records)
+        self.last_sync_seconds = time.time() - started
+        logging.log(
+            logging.INFO if full else logging.DEBUG,
+            f"User mirror {'loaded' if full else 'synced'}: {len(records)} records in {self.last_sync_seconds:.2f}s"
+        )
+        return len(records)
+
+    async def run(self):
+        while True:
+            try:
+                if self._acquire_lease():
+                    await self.sync()
+            except (AirtableError, sqlite3.Error) as e:
+                self.failures += 1
+                logging.error(f"Failed to sync user mirror: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def wait_fresh(self, timeout: float = 30.0) -> bool:
+        """
+        Wait until this or another process has synced the mirror recently enough to serve reads.
+        """
+        deadline = time.monotonic() + timeout
+        while not self.is_fresh():
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.2)
+        return True
+
+    async def stop(self):
+        await cancel_task(self._task)
+        self._task = None
+        # Let another process take over the sync right away
+        self._db.execute(
+            "UPDATE mirror_meta SET value = '0' WHERE key = 'lease_until'"
+            " AND EXISTS (SELECT 1 FROM mirror_meta WHERE key = 'lease_owner' AND value = ?)",
+            (self._owner,)
+        )
+        self._db.close()
+
+    def _select(self, column: str, value) -> list:
+        rows = self._db.execute(f"SELECT record FROM users WHERE {column} = ?", (str(value),)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    async def _read(self, local, remote):
+        if self.is_fresh():
+            self.local_reads += 1
+            return local()
+        try:
+            result = await remote()
+        except AirtableError as e:
+            if self.staleness() is None:
+                raise
+            self.stale_reads += 1
+            logging.warning(f"Airtable unavailable, serving users from the stale mirror: {e}")
+            return local()
+        self.remote_reads += 1
+        return result
+
+    # Users operations of AirtableGateway
+
+    async def find_user(self, user_id):
+        """
+        Return the Users record with the given Telegram user id, or None.
+        """
+        def local():
+            records = self._select("user_id", user_id)
+            return records[0] if records else None
+        return await self._read(local, lambda: self.gateway.find_user(user_id))
+
+    async def find_user_by_referral_code(self, referral_code: str):
+        def local():
+            records = self._select("referral_code", referral_code)
+            return records[0] if records else None
+        return await self._read(local, lambda: self.gateway.find_user_by_referral_code(referral_code))
+
+    async def find_users_by_referrer_code(self, referral_code: str) -> list:
+        return await self._read(
+            lambda: self._select("referrer_code", referral_code),
+            lambda: self.gateway.find_users_by_referrer_code(referral_code)
+        )
+
+    async def all_users(self, fields=None) -> list:
+        return await self._read(
+            lambda: [json.loads(row[0]) for row in self._db.execute("SELECT record FROM users")],
+            lambda: self.gateway.all_users(fields=fields)
+        )
+
+    async def insert_user(self, fields: dict) -> dict:
+        record = await self.gateway.insert_user(fields)
+        self._store([record])
+        return record
+
+    async def update_user(self, record_id: str, fields: dict) -> dict:
+        record = await self.gateway.update_user(record_id, fields)
+        self._store([record])
+        return record
@@ -0,0 +1,137 @@
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import os
+
+from aiohttp import ClientSession, web
+from aiogram import types
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def feed_dispatcher(dispatcher, bot):
+    """
+    Return an update processor that feeds raw update JSON into an aiogram dispatcher.
+    """
+    async def process(data: dict):
+        update = types.Update.model_validate(data, context={"bot": bot})
+        await dispatcher.feed_update(bot, update)
+    return process
+
+
+class WebhookServer:
+    """
+    One aiohttp application receiving webhook updates for several bots.
+
+    Each bot gets its own path and secret token. Updates are acknowledged as
+    soon as they are accepted and processed in background tasks; at most
+    `max_concurrency` updates are in flight, after which new requests wait,
+    which in turn slows Telegram's delivery down.
+    """
+
+    def __init__(self, max_concurrency: int = 100):
+        self.app = web.Application()
+        self._routes = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks = set()
+
+    def add_bot(self, path: str, secret: str, process):
+        self._routes[path] = (secret, process)
+        self.app.router.add_post(path, self._handle)
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        secret, process = self._routes[request.path]
+        if secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._run(process, data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _run(self, process, data: dict):
+        try:
+            await process(data)
+        except Exception as e:
+            logging.exception(f"Failed to process update {data.get('update_id')}: {e}")
+        finally:
+            self._semaphore.release()
+
+    async def drain(self, timeout: float = 30.0):
+        """
+        Wait for in-flight updates to finish.
+        """
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+    async def serve(self, host: str, port: int):
+        """
+        Serve until cancelled, then drain in-flight updates.
+        """
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logging.info(f"Webhook server listening on {host}:{port}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.shutdown()
+            await self.drain()
+            await runner.cleanup()
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    """
+    Add the polling/webhook options shared by main.py and supervisor.py.
+    """
+    parser.add_argument("--mode", choices=["polling", "webhook"], default=os.environ.get("BOT_MODE", "polling"))
+    parser.add_argument("--host", default=os.environ.get("WEBHOOK_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8080)))
+    parser.add_argument("--webhook-url", default=os.environ.get("WEBHOOK_URL"),
+                        help="public base URL; when set, webhooks are registered with Telegram")
+    parser.add_argument("--secret", default=os.environ.get("WEBHOOK_SECRET", ""),
+                        help="secret token Telegram sends with every update; required with --webhook-url")
+    parser.add_argument("--max-concurrency", type=int, default=100)
+
+
+def check_server_arguments(parser: argparse.ArgumentParser, args):
+    """
+    Exit with a usage error for option combinations the bot must not run with.
+    """
+    # Without a secret anyone who finds the public URL could post forged updates
+    if args.mode == "webhook" and args.webhook_url and not args.secret:
+        parser.error("--secret (or WEBHOOK_SECRET) is required with --webhook-url")
+
+
+async def replay_updates(path: str, url: str, secret: str = "", concurrency: int = 10):
+    """
+    POST recorded updates (one JSON object per line) to a webhook URL.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    semaphore = asyncio.Semaphore(concurrency)
+    async with ClientSession(headers={SECRET_HEADER: secret}) as session:
+        async def post(update):
+            async with semaphore:
+                async with session.post(url, json=update) as resp:
+                    if resp.status != 200:
+                        logging.error(f"Update {update.get('update_id')} rejected with {resp.status}")
+        await asyncio.gather(*(post(update) for update in updates))
+    logging.info(f"Replayed {len(updates)} updates to {url}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Replay recorded Telegram updates against a local webhook server.")
+    parser.add_argument("updates", help="file with one update JSON object per line")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhook/main")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(replay_updates(args.updates, args.url, args.secret, args.concurrency))